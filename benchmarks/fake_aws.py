@@ -0,0 +1,408 @@
+"""
+an in-memory fake of the ECS, EC2 and Route53 endpoints used by the registrator.
+
+The fake is installed on boto3 clients at the HTTP level, through the botocore
+`before-send` event. Requests are still serialized, signed, retried and parsed by
+botocore, so the cost of the client side is measured realistically. Every request can be
+delayed by a configurable latency, and requests can be throttled at random or above a
+maximum request rate per service.
+"""
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List
+from xml.sax.saxutils import escape
+
+from botocore.awsrequest import AWSResponse
+
+THROTTLING_ERRORS = {
+    "ecs": (400, "ThrottlingException"),
+    "ec2": (503, "RequestLimitExceeded"),
+    "route53": (400, "Throttling"),
+}
+
+
+class FakeError(Exception):
+    def __init__(self, status: int, code: str, message: str):
+        super(FakeError, self).__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+class Raw(object):
+    def __init__(self, body: bytes):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+class FakeAWS(object):
+    """
+    the state and behaviour of the fake endpoints.
+    """
+
+    def __init__(self, latency: float = 0.0, throttle_rate: float = 0.0, max_rps: Dict[str, float] = None):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.max_rps = max_rps if max_rps else {}
+        self.task_definitions = {}
+        self.tasks = {}
+        self.network_interfaces = {}
+        self.container_instances = {}
+        self.instances = {}
+        self.zones = defaultdict(dict)
+        self.changes = {}
+        self.propagation_delay = 0.0
+        self.calls = Counter()
+        self.throttled = Counter()
+        self._windows = {}
+        self._local = threading.local()
+        self._lock = threading.RLock()
+
+    # state
+
+    def add_task_definition(self, arn: str, containers: List[dict]):
+        self.task_definitions[arn] = {
+            "taskDefinitionArn": arn,
+            "family": arn.split("/")[-1].split(":")[0],
+            "revision": int(arn.split(":")[-1]),
+            "containerDefinitions": containers,
+        }
+
+    def add_task(self, cluster_arn: str, task_arn: str, task_definition_arn: str, private_ip: str, public_ip: str = None):
+        eni_id = "eni-{}".format(uuid.uuid4().hex[:17])
+        self.network_interfaces[eni_id] = {"NetworkInterfaceId": eni_id, "PrivateIpAddress": private_ip}
+        if public_ip:
+            self.network_interfaces[eni_id]["Association"] = {"PublicIp": public_ip}
+        task = {
+            "taskArn": task_arn,
+            "clusterArn": cluster_arn,
+            "taskDefinitionArn": task_definition_arn,
+            "desiredStatus": "RUNNING",
+            "lastStatus": "RUNNING",
+            "version": 1,
+            "attachments": [
+                {
+                    "id": str(uuid.uuid4()),
+                    "type": "ElasticNetworkInterface",
+                    "status": "ATTACHED",
+                    "details": [
+                        {"name": "networkInterfaceId", "value": eni_id},
+                        {"name": "privateIPv4Address", "value": private_ip},
+                    ],
+                }
+            ],
+        }
+        self.tasks[task_arn] = task
+        return task
+
+    def add_container_instance(self, cluster_arn: str, private_ip: str, public_ip: str = None) -> str:
+        """
+        adds an EC2 container instance to the cluster, and returns its arn.
+        """
+        instance_id = "i-{}".format(uuid.uuid4().hex[:17])
+        arn = "{}:container-instance/{}/{}".format(
+            cluster_arn.split(":cluster/")[0], cluster_arn.split("/")[-1], uuid.uuid4().hex
+        )
+        self.container_instances[arn] = {"containerInstanceArn": arn, "ec2InstanceId": instance_id, "status": "ACTIVE"}
+        self.instances[instance_id] = {
+            "InstanceId": instance_id,
+            "PrivateIpAddress": private_ip,
+            "PrivateDnsName": "ip-{}.ec2.internal".format(private_ip.replace(".", "-")),
+        }
+        if public_ip:
+            self.instances[instance_id]["PublicIpAddress"] = public_ip
+            self.instances[instance_id]["PublicDnsName"] = "ec2-{}.compute.amazonaws.com".format(public_ip.replace(".", "-"))
+        return arn
+
+    def add_host_task(
+        self, cluster_arn: str, task_arn: str, task_definition_arn: str, container_instance_arn: str, host_ports: dict
+    ):
+        """
+        adds a task in bridge network mode, with the host port per container name.
+        """
+        task = {
+            "taskArn": task_arn,
+            "clusterArn": cluster_arn,
+            "taskDefinitionArn": task_definition_arn,
+            "containerInstanceArn": container_instance_arn,
+            "desiredStatus": "RUNNING",
+            "lastStatus": "RUNNING",
+            "version": 1,
+            "attachments": [],
+            "containers": [
+                {
+                    "name": name,
+                    "networkBindings": [
+                        {"bindIP": "0.0.0.0", "containerPort": 8080, "hostPort": port, "protocol": "tcp"}
+                    ],
+                }
+                for name, port in host_ports.items()
+            ],
+        }
+        self.tasks[task_arn] = task
+        return task
+
+    def stop_task(self, task_arn: str):
+        task = self.tasks[task_arn]
+        task["desiredStatus"] = task["lastStatus"] = "STOPPED"
+        task["version"] += 1
+        for attachment in task["attachments"]:
+            attachment["status"] = "DELETED"
+        return task
+
+    def event(self, task_arn: str, desired_status: str = None, last_status: str = None) -> dict:
+        """
+        returns an ECS task state change event for the task.
+        """
+        detail = json.loads(json.dumps(self.tasks[task_arn]))
+        if desired_status:
+            detail["desiredStatus"] = desired_status
+        if last_status:
+            detail["lastStatus"] = last_status
+        return {
+            "id": str(uuid.uuid4()),
+            "detail-type": "ECS Task State Change",
+            "source": "aws.ecs",
+            "time": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "detail": detail,
+        }
+
+    def add_record(self, hosted_zone_id: str, rr_set: dict):
+        self.zones[hosted_zone_id][(rr_set["Name"], rr_set["Type"], rr_set.get("SetIdentifier", ""))] = rr_set
+
+    def records(self, hosted_zone_id: str) -> List[dict]:
+        return [self.zones[hosted_zone_id][k] for k in sorted(self.zones[hosted_zone_id].keys())]
+
+    # installation
+
+    def install(self, client):
+        """
+        routes all requests of the boto3 `client` to this fake.
+        """
+        service = client.meta.service_model.service_name
+        model = client.meta.service_model
+
+        def before_parameter_build(params, model, **kwargs):
+            self._local.params = params
+
+        def before_send(request, **kwargs):
+            operation = kwargs["event_name"].split(".")[-1]
+            return self._send(service, model.operation_model(operation), self._local.params, request)
+
+        client.meta.events.register("before-parameter-build", before_parameter_build)
+        client.meta.events.register_last("before-send", before_send)
+        return client
+
+    def _send(self, service: str, operation_model, params: dict, request) -> AWSResponse:
+        if self.latency:
+            time.sleep(self.latency)
+        operation = operation_model.name
+        with self._lock:
+            self.calls["{}.{}".format(service, operation)] += 1
+            throttled = self._is_throttled(service)
+            if throttled:
+                self.throttled["{}.{}".format(service, operation)] += 1
+        try:
+            if throttled:
+                status, code = THROTTLING_ERRORS[service]
+                raise FakeError(status, code, "Rate exceeded")
+            handler = getattr(self, "{}_{}".format(service, operation), None)
+            if not handler:
+                raise FakeError(400, "InvalidAction", "{} not supported by the fake".format(operation))
+            with self._lock:
+                result = handler(params)
+            status, body = 200, serialize(operation_model, result)
+        except FakeError as e:
+            status, body = e.status, serialize_error(operation_model, e)
+        return AWSResponse(request.url, status, {"x-amzn-RequestId": str(uuid.uuid4())}, Raw(body))
+
+    def _is_throttled(self, service: str) -> bool:
+        if self.throttle_rate and random.random() < self.throttle_rate:
+            return True
+        max_rps = self.max_rps.get(service)
+        if not max_rps:
+            return False
+        window = int(time.time())
+        count = self._windows.get((service, window), 0) + 1
+        self._windows = {k: v for k, v in self._windows.items() if k[1] >= window}
+        self._windows[(service, window)] = count
+        return count > max_rps
+
+    # ecs
+
+    def ecs_DescribeTaskDefinition(self, params):
+        task_definition = self.task_definitions.get(params["taskDefinition"])
+        if not task_definition:
+            raise FakeError(400, "ClientException", "Unable to describe task definition.")
+        return {"taskDefinition": task_definition}
+
+    def ecs_DescribeTasks(self, params):
+        tasks = [self.tasks[arn] for arn in params["tasks"] if arn in self.tasks]
+        failures = [{"arn": arn, "reason": "MISSING"} for arn in params["tasks"] if arn not in self.tasks]
+        return {"tasks": tasks, "failures": failures}
+
+    def ecs_DescribeContainerInstances(self, params):
+        arns = params["containerInstances"]
+        return {
+            "containerInstances": [self.container_instances[a] for a in arns if a in self.container_instances],
+            "failures": [{"arn": a, "reason": "MISSING"} for a in arns if a not in self.container_instances],
+        }
+
+    def ecs_ListClusters(self, params):
+        return {"clusterArns": sorted({t["clusterArn"] for t in self.tasks.values()})}
+
+    def ecs_ListTasks(self, params):
+        arns = sorted(
+            arn
+            for arn, task in self.tasks.items()
+            if task["clusterArn"] == params["cluster"]
+            and task["desiredStatus"] == params.get("desiredStatus", task["desiredStatus"])
+            and task.get("containerInstanceArn") == params.get("containerInstance", task.get("containerInstanceArn"))
+        )
+        start = int(params.get("nextToken", "0"))
+        end = start + params.get("maxResults", 100)
+        return dict({"taskArns": arns[start:end]}, **({"nextToken": str(end)} if end < len(arns) else {}))
+
+    # ec2
+
+    def ec2_DescribeNetworkInterfaces(self, params):
+        eni_ids = list(params.get("NetworkInterfaceIds", []))
+        for f in params.get("Filters", []):
+            if f["Name"] == "network-interface-id":
+                eni_ids.extend(f["Values"])
+        missing = [i for i in params.get("NetworkInterfaceIds", []) if i not in self.network_interfaces]
+        if missing:
+            raise FakeError(400, "InvalidNetworkInterfaceID.NotFound", "{} does not exist".format(missing[0]))
+        return {"NetworkInterfaces": [self.network_interfaces[i] for i in eni_ids if i in self.network_interfaces]}
+
+    def ec2_DescribeInstances(self, params):
+        missing = [i for i in params.get("InstanceIds", []) if i not in self.instances]
+        if missing:
+            raise FakeError(400, "InvalidInstanceID.NotFound", "{} does not exist".format(missing[0]))
+        instances = [self.instances[i] for i in params.get("InstanceIds", [])]
+        return {"Reservations": [{"ReservationId": "r-fake", "Instances": instances}]}
+
+    # route53
+
+    def route53_ChangeResourceRecordSets(self, params):
+        zone = self.zones[params["HostedZoneId"].split("/")[-1]]
+        changes = params["ChangeBatch"]["Changes"]
+        size = sum(len(c["ResourceRecordSet"].get("ResourceRecords", [])) * (2 if c["Action"] == "UPSERT" else 1) for c in changes)
+        if size > 1000:
+            raise FakeError(400, "InvalidChangeBatch", "Number of records limit of 1000 exceeded.")
+        updated = dict(zone)
+        for change in changes:
+            rr_set = change["ResourceRecordSet"]
+            key = (rr_set["Name"], rr_set["Type"], rr_set.get("SetIdentifier", ""))
+            if change["Action"] == "DELETE":
+                if key not in updated:
+                    raise conflict("delete", rr_set, "it was not found")
+                if updated[key] != rr_set:
+                    raise conflict("delete", rr_set, "the values provided do not match the current values")
+                del updated[key]
+            elif change["Action"] == "CREATE" and key in updated:
+                raise conflict("create", rr_set, "it already exists")
+            else:
+                updated[key] = rr_set
+        zone.clear()
+        zone.update(updated)
+        change_id = uuid.uuid4().hex[:14].upper()
+        self.changes[change_id] = time.time()
+        return {"ChangeInfo": self._change_info(change_id)}
+
+    def route53_GetChange(self, params):
+        change_id = params["Id"].split("/")[-1]
+        if change_id not in self.changes:
+            raise FakeError(404, "NoSuchChange", "change {} not found".format(change_id))
+        return {"ChangeInfo": self._change_info(change_id)}
+
+    def _change_info(self, change_id):
+        submitted_at = self.changes[change_id]
+        in_sync = time.time() - submitted_at >= self.propagation_delay
+        return {
+            "Id": "/change/{}".format(change_id),
+            "Status": "INSYNC" if in_sync else "PENDING",
+            "SubmittedAt": datetime.fromtimestamp(submitted_at, timezone.utc),
+        }
+
+    def route53_ListResourceRecordSets(self, params):
+        zone = self.zones[params["HostedZoneId"].split("/")[-1]]
+        start = (params.get("StartRecordName", ""), params.get("StartRecordType", ""), params.get("StartRecordIdentifier", ""))
+        keys = [k for k in sorted(zone.keys()) if k >= start]
+        max_items = int(params.get("MaxItems", "100"))
+        result = {
+            "ResourceRecordSets": [zone[k] for k in keys[:max_items]],
+            "IsTruncated": len(keys) > max_items,
+            "MaxItems": str(max_items),
+        }
+        if len(keys) > max_items:
+            name, record_type, set_identifier = keys[max_items]
+            result.update({"NextRecordName": name, "NextRecordType": record_type})
+            if set_identifier:
+                result["NextRecordIdentifier"] = set_identifier
+        return result
+
+
+def conflict(action: str, rr_set: dict, reason: str) -> FakeError:
+    """
+    returns the error of Route53 on a change of a record set which was changed concurrently.
+    """
+    message = "Tried to {} resource record set [name='{}', type='{}'] but {}".format(action, rr_set["Name"], rr_set["Type"], reason)
+    return FakeError(400, "InvalidChangeBatch", message)
+
+
+def serialize(operation_model, result: dict) -> bytes:
+    """
+    serializes the `result` in the wire protocol of the service.
+    """
+    protocol = operation_model.metadata["protocol"]
+    if protocol == "json":
+        return json.dumps(result, default=lambda d: d.timestamp()).encode("utf-8")
+
+    name = "{}Response".format(operation_model.name)
+    namespace = operation_model.metadata.get("xmlNamespace", "")
+    if isinstance(namespace, dict):
+        namespace = namespace.get("uri", "")
+    body = serialize_xml(operation_model.output_shape, result)
+    return '<?xml version="1.0"?><{0} xmlns="{1}">{2}</{0}>'.format(name, namespace, body).encode("utf-8")
+
+
+def serialize_xml(shape, value) -> str:
+    if shape.type_name == "structure":
+        result = []
+        for member_name, member in shape.members.items():
+            if member_name not in value:
+                continue
+            name = member.serialization.get("name", member_name)
+            result.append("<{0}>{1}</{0}>".format(name, serialize_xml(member, value[member_name])))
+        return "".join(result)
+    if shape.type_name == "list":
+        name = shape.member.serialization.get("name", "member")
+        return "".join("<{0}>{1}</{0}>".format(name, serialize_xml(shape.member, v)) for v in value)
+    if shape.type_name == "boolean":
+        return "true" if value else "false"
+    if shape.type_name == "timestamp":
+        return value.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    return escape(str(value))
+
+
+def serialize_error(operation_model, error: FakeError) -> bytes:
+    protocol = operation_model.metadata["protocol"]
+    if protocol == "json":
+        return json.dumps({"__type": error.code, "message": error.message}).encode("utf-8")
+    if protocol == "ec2":
+        return (
+            "<Response><Errors><Error><Code>{}</Code><Message>{}</Message></Error></Errors>"
+            "<RequestID>{}</RequestID></Response>".format(error.code, escape(error.message), uuid.uuid4())
+        ).encode("utf-8")
+    return (
+        "<ErrorResponse><Error><Type>Sender</Type><Code>{}</Code><Message>{}</Message></Error>"
+        "<RequestId>{}</RequestId></ErrorResponse>".format(error.code, escape(error.message), uuid.uuid4())
+    ).encode("utf-8")
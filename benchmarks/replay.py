@@ -0,0 +1,338 @@
+"""
+captures ECS task state change events, and replays them through the handlers against the
+in-memory fake of ECS, EC2 and Route53.
+
+A capture is a gzip compressed JSON lines file. Each event line holds the time the event
+was sent and the event itself; the task definitions referenced by the events are captured
+as well, so that the replay registers the same names:
+
+    {"type": "event", "time": 1700000000.123, "event": {...}}
+    {"type": "task_definition", "taskDefinition": {...}}
+
+Events are captured from an SQS queue targeted by the EventBridge rule, from files or
+stdin with one event per line, or generated from a benchmark scenario. The replay sends
+the events at their original timing, at a scaled speed, or as fast as possible, through
+the task or the batch handler with a number of concurrent workers. It reports the
+throughput, the queueing delay and latency per event, the AWS calls made and the resulting
+DNS records, so that handler versions can be compared on identical traffic.
+
+usage:
+    python benchmarks/replay.py capture --queue-url URL --output capture.jsonl.gz
+    python benchmarks/replay.py capture --scenario rolling_deploy --rate 100 --output capture.jsonl.gz
+    python benchmarks/replay.py replay capture.jsonl.gz [--speed 10 | --flat-out] [--concurrency 8]
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Iterator, List
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# scenarios puts the handlers on the path.
+import scenarios  # noqa: E402
+from fake_aws import FakeAWS  # noqa: E402
+
+import aws_clients  # noqa: E402
+import batch_event  # noqa: E402
+import metrics  # noqa: E402
+import task_event  # noqa: E402
+
+log = logging.getLogger()
+
+REPLAY_HOSTED_ZONE_ID = "ZREPLAY"
+
+
+class Capture(object):
+    """
+    writes a capture file.
+    """
+
+    def __init__(self, path: str):
+        self.file = gzip.open(path, "wt")
+        self.task_definitions = set()
+        self.events = 0
+
+    def add_event(self, event: dict, sent_at: float = None):
+        if sent_at is None:
+            sent_at = get_event_time(event)
+        self.file.write(json.dumps({"type": "event", "time": sent_at, "event": event}) + "\n")
+        self.events += 1
+
+    def add_task_definition(self, task_definition: dict):
+        if task_definition["taskDefinitionArn"] in self.task_definitions:
+            return
+        self.task_definitions.add(task_definition["taskDefinitionArn"])
+        self.file.write(json.dumps({"type": "task_definition", "taskDefinition": task_definition}, default=str) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+def get_event_time(event: dict) -> float:
+    try:
+        return datetime.strptime(event["time"], "%Y-%m-%dT%H:%M:%SZ").timestamp()
+    except (KeyError, ValueError):
+        return time.time()
+
+
+def read_capture(path: str) -> Iterator[dict]:
+    with gzip.open(path, "rt") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def capture_queue(capture: Capture, queue_url: str, max_events: int, delete: bool, wait_time: int = 5):
+    """
+    receives the events from the SQS queue, until it is empty or `max_events` are captured.
+    Without `delete`, the messages become visible again after their visibility timeout.
+    """
+    sqs = aws_clients.get_client("sqs")
+    ecs = aws_clients.get_client("ecs")
+    while capture.events < max_events:
+        response = sqs.receive_message(
+            QueueUrl=queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=wait_time, AttributeNames=["SentTimestamp"]
+        )
+        messages = response.get("Messages", [])
+        if not messages:
+            break
+        for message in messages:
+            event = json.loads(message["Body"])
+            capture.add_event(event, int(message["Attributes"]["SentTimestamp"]) / 1000.0)
+            capture_task_definition(capture, ecs, event)
+        if delete:
+            sqs.delete_message_batch(
+                QueueUrl=queue_url,
+                Entries=[{"Id": str(i), "ReceiptHandle": m["ReceiptHandle"]} for i, m in enumerate(messages)],
+            )
+
+
+def capture_task_definition(capture: Capture, ecs, event: dict):
+    arn = event.get("detail", {}).get("taskDefinitionArn")
+    if not arn or arn in capture.task_definitions:
+        return
+    try:
+        capture.add_task_definition(ecs.describe_task_definition(taskDefinition=arn)["taskDefinition"])
+    except Exception as e:
+        log.warning("failed to capture task definition %s, %s", arn, e)
+
+
+def capture_files(capture: Capture, paths: List[str]):
+    """
+    captures the events from files with one JSON event per line, or from stdin.
+    """
+    for path in paths or ["-"]:
+        f = sys.stdin if path == "-" else open(path)
+        try:
+            for line in f:
+                if line.strip():
+                    capture.add_event(json.loads(line))
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+
+def capture_scenario(capture: Capture, name: str, tasks: int, rate: float):
+    """
+    captures the events of a benchmark scenario, sent at `rate` events per second.
+    """
+    create, default_tasks = scenarios.SCENARIOS[name]
+    fake = FakeAWS()
+    events = create(fake, tasks if tasks else default_tasks)
+    for task_definition in fake.task_definitions.values():
+        capture.add_task_definition(task_definition)
+    start = time.time()
+    for i, event in enumerate(events):
+        capture.add_event(event, start + i / rate)
+
+
+class Replay(object):
+    """
+    replays the events of a capture against a fresh fake.
+    """
+
+    def __init__(self, path: str, latency: float = 0.0):
+        self.fake = FakeAWS(latency=latency)
+        self.events = []
+        for item in read_capture(path):
+            if item["type"] == "task_definition":
+                task_definition = item["taskDefinition"]
+                self.fake.add_task_definition(task_definition["taskDefinitionArn"], task_definition["containerDefinitions"])
+            elif item["type"] == "event":
+                self.events.append((item["time"], item["event"]))
+        self.events.sort(key=lambda e: e[0])
+        for _, event in self.events:
+            self.add_task(event["detail"])
+        self._lock = threading.Lock()
+
+    def add_task(self, detail: dict):
+        """
+        makes the task of the event known to the fake, with its network interfaces and
+        task definition.
+        """
+        if detail["taskArn"] not in self.fake.tasks:
+            self.fake.tasks[detail["taskArn"]] = detail
+        for attachment in detail.get("attachments", []):
+            eni_id = task_event.get_attachment_detail(attachment, "networkInterfaceId")
+            ip_address = task_event.get_attachment_detail(attachment, "privateIPv4Address")
+            if eni_id and ip_address:
+                self.fake.network_interfaces.setdefault(
+                    eni_id, {"NetworkInterfaceId": eni_id, "PrivateIpAddress": ip_address}
+                )
+        arn = detail["taskDefinitionArn"]
+        if arn not in self.fake.task_definitions:
+            family = arn.split("/")[-1].split(":")[0]
+            labels = {
+                "DNSHostedZoneId": REPLAY_HOSTED_ZONE_ID,
+                "DNSName": "{}.replay".format(family),
+                "DNSRegisterPublicIp": "false",
+            }
+            log.warning("task definition %s not captured, registering %s", arn, labels["DNSName"])
+            self.fake.add_task_definition(arn, [{"name": family, "dockerLabels": labels}])
+
+    def run(self, speed: float = 1.0, concurrency: int = 1, mode: str = "event", batch_size: int = 10) -> dict:
+        """
+        replays the events at `speed` times the original rate, or as fast as possible if
+        `speed` is 0.
+        """
+        scenarios.install(self.fake)
+        batches = [[e] for e in self.events] if mode == "event" else chunk(self.events, batch_size)
+        delays, latencies = [], []
+        failures = [0]
+        first = self.events[0][0] if self.events else 0.0
+
+        def process(scheduled: float, batch: list):
+            started = time.perf_counter()
+            try:
+                with self._lock:
+                    for _, event in batch:
+                        self.fake.tasks[event["detail"]["taskArn"]] = event["detail"]
+                if mode == "event":
+                    task_event.handler(batch[0][1], None)
+                else:
+                    failed = batch_event.handler([e for _, e in batch], None)["batchItemFailures"]
+                    with self._lock:
+                        failures[0] += len(failed)
+            except Exception as e:
+                log.error("replay of event failed, %s", e)
+                with self._lock:
+                    failures[0] += len(batch)
+            finished = time.perf_counter()
+            with self._lock:
+                delays.extend([started - scheduled] * len(batch))
+                latencies.extend([(finished - started) / len(batch)] * len(batch))
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for batch in batches:
+                scheduled = start
+                if speed:
+                    scheduled = start + (batch[-1][0] - first) / speed
+                    wait = scheduled - time.perf_counter()
+                    if wait > 0:
+                        time.sleep(wait)
+                executor.submit(process, scheduled, batch)
+        wall_time = time.perf_counter() - start
+
+        records = {zone: self.fake.records(zone) for zone in sorted(self.fake.zones.keys())}
+        return {
+            "mode": mode,
+            "speed": speed,
+            "concurrency": concurrency,
+            "events": len(self.events),
+            "failures": failures[0],
+            "wall_time_s": wall_time,
+            "throughput_eps": len(self.events) / wall_time if wall_time else 0.0,
+            "queueing_delay_p50_ms": scenarios.percentile(delays, 50) * 1000,
+            "queueing_delay_p99_ms": scenarios.percentile(delays, 99) * 1000,
+            "queueing_delay_max_ms": max(delays) * 1000 if delays else 0.0,
+            "latency_p50_ms": scenarios.percentile(latencies, 50) * 1000,
+            "latency_p99_ms": scenarios.percentile(latencies, 99) * 1000,
+            "calls": sum(self.fake.calls.values()),
+            "calls_by_operation": dict(sorted(self.fake.calls.items())),
+            "records": {zone: len(rr_sets) for zone, rr_sets in records.items()},
+            "dns_state_digest": get_digest(records),
+        }
+
+
+def chunk(events: list, size: int) -> List[list]:
+    return [events[i : i + size] for i in range(0, len(events), size)]
+
+
+def get_digest(records: dict) -> str:
+    """
+    returns a digest of the DNS records, which is equal for runs with the same outcome.
+    """
+    return hashlib.sha256(json.dumps(records, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="capture and replay ECS task state change events")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    capture = commands.add_parser("capture", help="capture events to a compressed JSON lines file")
+    source = capture.add_mutually_exclusive_group(required=True)
+    source.add_argument("--queue-url", help="SQS queue to receive the events from")
+    source.add_argument("--scenario", choices=sorted(scenarios.SCENARIOS.keys()), help="benchmark scenario to capture")
+    source.add_argument("--file", dest="files", action="append", help="file with one JSON event per line, - for stdin")
+    capture.add_argument("--max-events", type=int, default=100000)
+    capture.add_argument("--delete", action="store_true", help="delete the captured messages from the queue")
+    capture.add_argument("--tasks", type=int, help="number of tasks of the scenario")
+    capture.add_argument("--rate", type=float, default=100.0, help="events per second of the scenario")
+    capture.add_argument("--output", required=True)
+
+    replay = commands.add_parser("replay", help="replay a capture through the handlers")
+    replay.add_argument("capture")
+    speed = replay.add_mutually_exclusive_group()
+    speed.add_argument("--speed", type=float, default=1.0, help="speed relative to the original timing")
+    speed.add_argument("--flat-out", action="store_true", help="send the events as fast as possible")
+    replay.add_argument("--concurrency", type=int, default=1)
+    replay.add_argument("--mode", choices=["event", "batch"], default="event")
+    replay.add_argument("--batch-size", type=int, default=10)
+    replay.add_argument("--latency", type=float, default=0.0, help="latency per AWS call in milliseconds")
+    replay.add_argument("--metrics", action="store_true", help="write the metrics of each invocation")
+    replay.add_argument("--dns-state", help="write the resulting DNS records as JSON to this file")
+    replay.add_argument("--output", help="write the report as JSON to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.command == "capture":
+        result = Capture(args.output)
+        try:
+            if args.queue_url:
+                capture_queue(result, args.queue_url, args.max_events, args.delete)
+            elif args.scenario:
+                capture_scenario(result, args.scenario, args.tasks, args.rate)
+            else:
+                capture_files(result, args.files)
+        finally:
+            result.close()
+        sys.stderr.write("captured {} events to {}\n".format(result.events, args.output))
+        return
+
+    metrics.collector.enabled = args.metrics
+    runner = Replay(args.capture, args.latency / 1000.0)
+    report = runner.run(0.0 if args.flat_out else args.speed, args.concurrency, args.mode, args.batch_size)
+    report["revision"] = scenarios.git_revision()
+    if args.dns_state:
+        with open(args.dns_state, "w") as f:
+            json.dump({zone: runner.fake.records(zone) for zone in sorted(runner.fake.zones.keys())}, f, indent=2)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
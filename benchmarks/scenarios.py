@@ -0,0 +1,300 @@
+"""
+offline benchmark of the handlers, against the in-memory fake of ECS, EC2 and Route53.
+
+Each scenario drives synthetic ECS task state change events through the handler and
+reports the number of AWS calls per event, the wall time, the p50 and p99 latency per
+event and the peak memory allocated. The memory is traced in a separate run, so that the
+tracing does not inflate the timings. The results are written as JSON, so that runs of
+different versions can be compared.
+
+usage: PYTHONPATH=src python benchmarks/scenarios.py [--tasks N] [--latency MS] [--output FILE]
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import uuid
+from typing import Callable, List, Tuple
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-central-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+os.environ.setdefault("ROUTE53_CHANGE_COMPLETION", "wait")
+os.environ.setdefault("RATE_LIMITS", "")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import aws_clients  # noqa: E402
+import batch_event  # noqa: E402
+import metrics  # noqa: E402
+import rate_limit  # noqa: E402
+import record_index  # noqa: E402
+import task_event  # noqa: E402
+from fake_aws import FakeAWS  # noqa: E402
+
+CLUSTER_ARN = "arn:aws:ecs:eu-central-1:123456789012:cluster/benchmark"
+HOSTED_ZONE_ID = "ZBENCHMARK"
+
+
+def task_arn() -> str:
+    return "arn:aws:ecs:eu-central-1:123456789012:task/benchmark/{}".format(uuid.uuid4().hex)
+
+
+def task_definition_arn(family: str, revision: int = 1) -> str:
+    return "arn:aws:ecs:eu-central-1:123456789012:task-definition/{}:{}".format(family, revision)
+
+
+def labels(name: str, hosted_zone_id: str = HOSTED_ZONE_ID, public_ip: bool = False) -> dict:
+    return {
+        "DNSHostedZoneId": hosted_zone_id,
+        "DNSName": name,
+        "DNSRegisterPublicIp": "true" if public_ip else "false",
+    }
+
+
+def record(name: str, arn: str, ip: str) -> dict:
+    return {
+        "Name": name,
+        "Type": "A",
+        "SetIdentifier": arn.split("/")[-1],
+        "Weight": 100,
+        "TTL": 30,
+        "ResourceRecords": [{"Value": ip}],
+    }
+
+
+def ip_address(i: int) -> str:
+    return "10.{}.{}.{}".format((i >> 16) & 255, (i >> 8) & 255, i & 255)
+
+
+def single_task(fake: FakeAWS, tasks: int) -> List[dict]:
+    arn = task_definition_arn("single")
+    fake.add_task_definition(arn, [{"name": "app", "dockerLabels": labels("single.example")}])
+    task = fake.add_task(CLUSTER_ARN, task_arn(), arn, ip_address(1))
+    events = [fake.event(task["taskArn"])]
+    fake.stop_task(task["taskArn"])
+    events.append(fake.event(task["taskArn"]))
+    return events
+
+
+def rolling_deploy(fake: FakeAWS, tasks: int) -> List[dict]:
+    """
+    replaces `tasks` tasks of revision 1 with tasks of revision 2, including the
+    PROVISIONING, PENDING and DEACTIVATING events.
+    """
+    old, new = task_definition_arn("service", 1), task_definition_arn("service", 2)
+    fake.add_task_definition(old, [{"name": "app", "dockerLabels": labels("service.example")}])
+    fake.add_task_definition(new, [{"name": "app", "dockerLabels": labels("service.example")}])
+    events = []
+    for i in range(tasks):
+        started = fake.add_task(CLUSTER_ARN, task_arn(), new, ip_address(i))
+        stopped = fake.add_task(CLUSTER_ARN, task_arn(), old, ip_address(i + tasks))
+        fake.add_record(HOSTED_ZONE_ID, record("service.example.", stopped["taskArn"], ip_address(i + tasks)))
+        events.append(fake.event(started["taskArn"], "RUNNING", "PROVISIONING"))
+        events.append(fake.event(started["taskArn"], "RUNNING", "PENDING"))
+        events.append(fake.event(started["taskArn"]))
+        events.append(fake.event(stopped["taskArn"], "STOPPED", "DEACTIVATING"))
+        fake.stop_task(stopped["taskArn"])
+        events.append(fake.event(stopped["taskArn"]))
+    return events
+
+
+def unlabelled_noise(fake: FakeAWS, tasks: int) -> List[dict]:
+    events = []
+    for family in range(10):
+        arn = task_definition_arn("unlabelled-{}".format(family))
+        fake.add_task_definition(arn, [{"name": "app", "dockerLabels": {}}])
+    for i in range(tasks):
+        arn = task_definition_arn("unlabelled-{}".format(i % 10))
+        task = fake.add_task(CLUSTER_ARN, task_arn(), arn, ip_address(i))
+        events.append(fake.event(task["taskArn"]))
+    return events
+
+
+def multi_container(fake: FakeAWS, tasks: int) -> List[dict]:
+    arn = task_definition_arn("multi")
+    fake.add_task_definition(
+        arn,
+        [
+            {"name": "app", "dockerLabels": labels("app.example")},
+            {"name": "sidecar", "dockerLabels": labels("sidecar.example")},
+            {"name": "admin", "dockerLabels": labels("admin.example", "ZADMIN")},
+        ],
+    )
+    events = []
+    for i in range(tasks):
+        task = fake.add_task(CLUSTER_ARN, task_arn(), arn, ip_address(i))
+        events.append(fake.event(task["taskArn"]))
+    return events
+
+
+SCENARIOS = {
+    "single_task": (single_task, 1),
+    "rolling_deploy": (rolling_deploy, 1000),
+    "unlabelled_noise": (unlabelled_noise, 1000),
+    "multi_container": (multi_container, 100),
+}
+
+
+def install(fake: FakeAWS):
+    """
+    replaces the shared clients by clients of the fake, and resets the caches.
+    """
+    limiter = rate_limit.from_environment()
+    provider = aws_clients.ClientProvider(rate_limiter=limiter, metrics=metrics.collector)
+    for service in ["ecs", "ec2", "route53"]:
+        fake.install(provider.get(service))
+    aws_clients.clients = provider
+    task_event.task_definition_cache.clear()
+    record_index.record_index.records.clear()
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+
+def run(
+    name: str,
+    create: Callable,
+    tasks: int,
+    latency: float,
+    throttle_rate: float,
+    mode: str,
+    batch_size: int,
+    emit_metrics: bool = False,
+) -> dict:
+    """
+    runs the scenario and returns its results. The metrics of each invocation are only
+    written with `emit_metrics`, as they would be timed with the handler.
+    """
+    enabled = metrics.collector.enabled
+    metrics.collector.enabled = emit_metrics
+    try:
+        return measure(name, create, tasks, latency, throttle_rate, mode, batch_size)
+    finally:
+        metrics.collector.enabled = enabled
+
+
+def measure(name: str, create: Callable, tasks: int, latency: float, throttle_rate: float, mode: str, batch_size: int) -> dict:
+    """
+    replays the events of the scenario untraced to time them, and once more with tracemalloc,
+    without latency, to measure the peak memory.
+    """
+    fake = FakeAWS(latency=latency, throttle_rate=throttle_rate)
+    events = create(fake, tasks)
+    install(fake)
+    start = time.perf_counter()
+    failures, latencies = replay(events, mode, batch_size)
+    wall_time = time.perf_counter() - start
+    calls = sum(fake.calls.values())
+
+    traced = FakeAWS(throttle_rate=throttle_rate)
+    traced_events = create(traced, tasks)
+    install(traced)
+    tracemalloc.start()
+    try:
+        replay(traced_events, mode, batch_size)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "scenario": name,
+        "mode": mode,
+        "events": len(events),
+        "failures": failures,
+        "calls": calls,
+        "calls_per_event": calls / float(len(events)),
+        "calls_by_operation": dict(sorted(fake.calls.items())),
+        "throttled": sum(fake.throttled.values()),
+        "wall_time_s": wall_time,
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p99_ms": percentile(latencies, 99) * 1000,
+        "peak_memory_kb": peak / 1024.0,
+        "records": sum(len(zone) for zone in fake.zones.values()),
+    }
+
+
+def replay(events: List[dict], mode: str, batch_size: int) -> Tuple[int, List[float]]:
+    """
+    passes the events to the handler of `mode`, and returns the number of failed events and
+    the latency of each event.
+    """
+    failures = 0
+    latencies = []
+    if mode == "batch":
+        for i in range(0, len(events), batch_size):
+            batch = events[i : i + batch_size]
+            event_start = time.perf_counter()
+            failures += len(batch_event.handler(batch, None)["batchItemFailures"])
+            latencies.extend([(time.perf_counter() - event_start) / len(batch)] * len(batch))
+    else:
+        for event in events:
+            event_start = time.perf_counter()
+            try:
+                task_event.handler(event, None)
+            except Exception:
+                failures += 1
+            latencies.append(time.perf_counter() - event_start)
+    return failures, latencies
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="offline benchmark of the ecs-dns-registrator handlers")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS.keys()), help="default all")
+    parser.add_argument("--tasks", type=int, help="number of tasks per scenario, overrides the default")
+    parser.add_argument("--latency", type=float, default=0.0, help="latency per AWS call in milliseconds")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of AWS calls throttled")
+    parser.add_argument("--mode", choices=["event", "batch", "both"], default="both")
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--metrics", action="store_true", help="write the metrics of each invocation")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    modes = ["event", "batch"] if args.mode == "both" else [args.mode]
+    results = []
+    for name in args.scenario or sorted(SCENARIOS.keys()):
+        create, tasks = SCENARIOS[name]
+        for mode in modes:
+            result = run(
+                name, create, args.tasks or tasks, args.latency / 1000.0, args.throttle_rate, mode, args.batch_size, args.metrics
+            )
+            results.append(result)
+            sys.stderr.write(
+                "{scenario:<18} {mode:<6} {events:>6} events {calls_per_event:6.2f} calls/event "
+                "p50 {latency_p50_ms:8.2f} ms p99 {latency_p99_ms:8.2f} ms "
+                "wall {wall_time_s:7.2f} s peak {peak_memory_kb:9.1f} KiB\n".format(**result)
+            )
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "latency_ms": args.latency,
+        "throttle_rate": args.throttle_rate,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+measures the cold import time of the handler module and the latency of the first and
+subsequent events, with and without reuse of the boto3 clients.
+
+All AWS calls are answered by a botocore Stubber, so the benchmark runs offline and
+measures client construction and request serialization only.
+
+usage: PYTHONPATH=src python benchmarks/startup.py [--runs N]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-central-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+TASK_ARN = "arn:aws:ecs:eu-central-1:1234567890:task/5568b6f6-78ec-43b2-8c05-be3bc117c96e"
+CLUSTER_ARN = "arn:aws:ecs:eu-central-1:1234567890:cluster/benchmark"
+TASK_DEFINITION_ARN = "arn:aws:ecs:eu-central-1:1234567890:task-definition/paas-monitor:25"
+
+EVENT = {
+    "detail-type": "ECS Task State Change",
+    "source": "aws.ecs",
+    "detail": {
+        "taskArn": TASK_ARN,
+        "clusterArn": CLUSTER_ARN,
+        "taskDefinitionArn": TASK_DEFINITION_ARN,
+        "desiredStatus": "RUNNING",
+        "lastStatus": "RUNNING",
+    },
+}
+
+
+def stub_event(provider):
+    """
+    creates the clients through `provider` and queues the responses for a single registration.
+    """
+    from botocore.stub import Stubber
+
+    stubbers = []
+    ecs = Stubber(provider.get("ecs"))
+    ecs.add_response(
+        "describe_task_definition",
+        {
+            "taskDefinition": {
+                "taskDefinitionArn": TASK_DEFINITION_ARN,
+                "containerDefinitions": [
+                    {
+                        "name": "paas-monitor",
+                        "dockerLabels": {
+                            "DNSHostedZoneId": "Z3AUN8X7OGVNVQ",
+                            "DNSName": "paas-monitor.fargate.example",
+                            "DNSRegisterPublicIp": "false",
+                        },
+                    }
+                ],
+            }
+        },
+    )
+    ecs.add_response(
+        "describe_tasks",
+        {
+            "tasks": [
+                {
+                    "taskArn": TASK_ARN,
+                    "attachments": [
+                        {
+                            "type": "ElasticNetworkInterface",
+                            "status": "ATTACHED",
+                            "details": [
+                                {"name": "networkInterfaceId", "value": "eni-9890d6c7"},
+                                {"name": "privateIPv4Address", "value": "172.31.93.207"},
+                            ],
+                        }
+                    ],
+                }
+            ]
+        },
+    )
+    stubbers.append(ecs)
+    ec2 = Stubber(provider.get("ec2"))
+    ec2.add_response(
+        "describe_network_interfaces",
+        {"NetworkInterfaces": [{"NetworkInterfaceId": "eni-9890d6c7", "PrivateIpAddress": "172.31.93.207"}]},
+    )
+    stubbers.append(ec2)
+    route53 = Stubber(provider.get("route53"))
+    route53.add_response(
+        "change_resource_record_sets",
+        {"ChangeInfo": {"Id": "/change/C1", "Status": "INSYNC", "SubmittedAt": "2019-01-01T00:00:00Z"}},
+    )
+    stubbers.append(route53)
+    for stubber in stubbers:
+        stubber.activate()
+    return stubbers
+
+
+def import_time(statement: str, runs: int) -> float:
+    """
+    returns the median wall time in milliseconds of executing `statement` in a fresh interpreter.
+    """
+    code = "import time; s = time.perf_counter(); {}; print(time.perf_counter() - s)".format(statement)
+    env = dict(os.environ, PYTHONPATH=SRC)
+    timings = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, "-c", code], env=env)
+        timings.append(float(output) * 1000)
+    return statistics.median(timings)
+
+
+def event_latency(runs: int, reuse_clients: bool) -> dict:
+    """
+    returns the latency in milliseconds of the first and the median of the subsequent events.
+    """
+    sys.path.insert(0, SRC)
+    import aws_clients
+    import task_event
+
+    timings = []
+    for _ in range(runs):
+        if not reuse_clients:
+            aws_clients.clients.clear()
+        start = time.perf_counter()
+        stubbers = stub_event(aws_clients.clients)
+        task_event.handler(EVENT, None)
+        timings.append((time.perf_counter() - start) * 1000)
+        for stubber in stubbers:
+            stubber.deactivate()
+    aws_clients.clients.clear()
+    return {"first_event_ms": timings[0], "warm_event_ms": statistics.median(timings[1:])}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="handler startup benchmark")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    result = {
+        "import_with_boto3_ms": import_time("import boto3, task_event", args.runs),
+        "import_deferred_ms": import_time("import task_event", args.runs),
+        "new_clients_per_event": event_latency(args.runs, reuse_clients=False),
+        "reused_clients": event_latency(args.runs, reuse_clients=True),
+    }
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
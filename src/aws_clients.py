@@ -0,0 +1,201 @@
+"""
+process wide provider of boto3 clients.
+
+clients are created lazily on first use and reused across warm Lambda invocations, so
+endpoint resolution, credential lookup and the TLS handshake are paid once per container
+instead of once per event. boto3 itself is imported on first use, which keeps the import
+of the handler module cheap.
+
+Clients for other regions and for assumed roles are created on demand as well. The
+credentials of an assumed role are cached per role and refreshed by botocore shortly
+before they expire, so a role is assumed once per hour instead of once per event. The
+role is first assumed when a request is signed, not while the client is created, so other
+threads are not held up by the call to STS.
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import metrics
+import rate_limit
+
+log = logging.getLogger()
+
+
+def client_config():
+    """
+    returns the botocore configuration used for all clients, tunable through the environment.
+    """
+    from botocore.config import Config
+
+    return Config(
+        max_pool_connections=int(os.getenv("AWS_MAX_POOL_CONNECTIONS", "10")),
+        connect_timeout=float(os.getenv("AWS_CONNECT_TIMEOUT", "2")),
+        read_timeout=float(os.getenv("AWS_READ_TIMEOUT", "10")),
+        tcp_keepalive=True,
+        retries={
+            "mode": os.getenv("AWS_RETRY_MODE", "standard"),
+            "max_attempts": int(os.getenv("AWS_MAX_ATTEMPTS", "5")),
+        },
+    )
+
+
+class AssumedRoleSessions(object):
+    """
+    boto3 sessions with the refreshable credentials of assumed roles, one per role.
+    """
+
+    def __init__(self, session_name: str = "ecs-dns-registrator", duration: int = 3600):
+        self.session_name = session_name
+        self.duration = duration
+        self.hits = 0
+        self.misses = 0
+        self.assumed = 0
+        self.sts_latency = deque(maxlen=metrics.MAX_VALUES)
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+    def get(self, role_arn: str, sts, region_name: str = None):
+        """
+        returns the session for `role_arn`, whose credentials are obtained with the `sts`
+        client on first use.
+        """
+        session = self._sessions.get(role_arn)
+        if session is not None:
+            with self._stats_lock:
+                self.hits += 1
+            return session
+        with self._lock:
+            session = self._sessions.get(role_arn)
+            if session is None:
+                with self._stats_lock:
+                    self.misses += 1
+                session = self._create(role_arn, sts, region_name)
+                self._sessions[role_arn] = session
+        return session
+
+    def _create(self, role_arn: str, sts, region_name: str):
+        import boto3
+        import botocore.session
+        from botocore.credentials import CredentialProvider, CredentialResolver, DeferredRefreshableCredentials
+
+        def refresh() -> dict:
+            start = time.perf_counter()
+            credentials = sts.assume_role(
+                RoleArn=role_arn, RoleSessionName=self.session_name, DurationSeconds=self.duration
+            )["Credentials"]
+            with self._stats_lock:
+                self.assumed += 1
+                self.sts_latency.append(time.perf_counter() - start)
+            log.info('assumed role "%s", valid until %s', role_arn, credentials["Expiration"])
+            return {
+                "access_key": credentials["AccessKeyId"],
+                "secret_key": credentials["SecretAccessKey"],
+                "token": credentials["SessionToken"],
+                "expiry_time": credentials["Expiration"].isoformat(),
+            }
+
+        class AssumedRoleProvider(CredentialProvider):
+            METHOD = "sts-assume-role"
+
+            def load(self):
+                return DeferredRefreshableCredentials(refresh_using=refresh, method=self.METHOD)
+
+        botocore_session = botocore.session.get_session()
+        botocore_session.register_component("credential_provider", CredentialResolver([AssumedRoleProvider()]))
+        return boto3.session.Session(botocore_session=botocore_session, region_name=region_name)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            latencies = sorted(self.sts_latency)
+            hits, misses, assumed = self.hits, self.misses, self.assumed
+        return {
+            "sessions": len(self._sessions),
+            "hits": hits,
+            "misses": misses,
+            "assumed": assumed,
+            "sts_latency_p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else 0.0,
+            "sts_latency_max_ms": latencies[-1] * 1000 if latencies else 0.0,
+        }
+
+
+class ClientProvider(object):
+    """
+    lazily creates one boto3 client per service name, region and role, and hands out the
+    same instance on every subsequent request. The clients share a single boto3 session,
+    or the session of their assumed role. If a rate limiter or a metrics collector is
+    specified, it is registered on every client created.
+    """
+
+    def __init__(self, config=None, rate_limiter: rate_limit.RateLimiter = None, metrics: metrics.Metrics = None):
+        self._config = config
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics
+        self.sessions = AssumedRoleSessions()
+        self._session = None
+        self._clients = {}
+        self._lock = threading.RLock()
+
+    def get(self, service_name: str, region_name: str = None, role_arn: str = None):
+        """
+        returns the client for `service_name` in `region_name` with the credentials of
+        `role_arn`, defaulting to the region and credentials of the Lambda.
+        """
+        key = (service_name, region_name, role_arn)
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                if region_name and region_name == self.get_session().region_name:
+                    return self.get(service_name, None, role_arn)
+                client = self._clients.get(key)
+                if client is None:
+                    client = self._create(service_name, region_name, role_arn)
+                    self._clients[key] = client
+        return client
+
+    def set(self, service_name: str, client, region_name: str = None, role_arn: str = None):
+        """
+        installs `client` for `service_name`, e.g. a stubbed client in tests.
+        """
+        with self._lock:
+            self._clients[(service_name, region_name, role_arn)] = client
+
+    def clear(self):
+        with self._lock:
+            self._clients = {}
+            self._session = None
+            self.sessions = AssumedRoleSessions()
+
+    def get_session(self):
+        if self._session is None:
+            import boto3
+
+            self._session = boto3.session.Session()
+        return self._session
+
+    def _create(self, service_name: str, region_name: str = None, role_arn: str = None):
+        session = self.get_session()
+        if role_arn:
+            misses = self.sessions.misses
+            session = self.sessions.get(role_arn, self.get("sts"), session.region_name)
+            if self.metrics:
+                self.metrics.increment("role_session_misses" if self.sessions.misses > misses else "role_session_hits")
+        if self._config is None:
+            self._config = client_config()
+        log.debug('creating boto3 client for "%s" in %s as %s', service_name, region_name, role_arn)
+        client = session.client(service_name, region_name=region_name, config=self._config)
+        if self.rate_limiter:
+            self.rate_limiter.register(client)
+        if self.metrics:
+            self.metrics.register(client)
+        return client
+
+
+clients = ClientProvider(rate_limiter=rate_limit.from_environment(), metrics=metrics.collector)
+
+
+def get_client(service_name: str):
+    return clients.get(service_name)
@@ -0,0 +1,177 @@
+"""
+batch handler for ECS task state change events.
+
+Accepts an SQS batch of EventBridge events, or a plain list of events. Superseded events
+of the same task are collapsed to the newest state, and the resulting Route53 changes are
+submitted with as few change batches per hosted zone as possible. Only the events whose
+changes failed are reported, as SQS batch item failures.
+"""
+import json
+import logging
+from collections import OrderedDict, defaultdict
+from typing import Dict, Iterator, List, Tuple
+
+from botocore.exceptions import ClientError
+
+import aws_clients
+import container_instances
+import event_filter
+import metrics
+import profiling
+import task_event
+
+log = logging.getLogger()
+
+# maximum number of ResourceRecord elements in a single change batch. Changes to aggregated
+# record sets count as a single record, they are split further once resolved.
+MAX_CHANGE_BATCH_SIZE = task_event.MAX_CHANGE_BATCH_SIZE
+
+
+def get_items(event) -> List[Tuple[str, dict]]:
+    """
+    returns the events in the batch, as a list of item identifier and event.
+    """
+    if isinstance(event, list):
+        return [(str(i), e) for i, e in enumerate(event)]
+    result = []
+    for record in event.get("Records", []):
+        try:
+            result.append((record["messageId"], json.loads(record["body"])))
+        except ValueError as e:
+            log.error("ignoring message %s with invalid body, %s", record["messageId"], e)
+    return result
+
+
+def get_event_order(event: dict) -> tuple:
+    detail = event["detail"]
+    return detail.get("version", 0), detail.get("updatedAt", ""), event.get("time", "")
+
+
+def get_latest_events(items: List[Tuple[str, dict]]) -> Dict[str, Tuple[str, dict]]:
+    """
+    returns the newest event per task arn. Events which are not ECS task state changes
+    are ignored.
+    """
+    result = OrderedDict()
+    for item_id, event in items:
+        if not task_event.is_task_state_change(event):
+            log.error("unsupported event, %s", event.get("detail-type"))
+            continue
+        task_arn = event["detail"]["taskArn"]
+        if task_arn not in result or get_event_order(event) >= get_event_order(result[task_arn][1]):
+            result[task_arn] = (item_id, event)
+    return result
+
+
+def is_irrelevant(event: dict) -> bool:
+    """
+    returns True for task state changes which do not lead to a DNS change.
+    """
+    return task_event.is_task_state_change(event) and event_filter.classify(event) == event_filter.IRRELEVANT
+
+
+def chunk_changes(changes: List[Tuple[str, dict]], max_size: int = MAX_CHANGE_BATCH_SIZE) -> Iterator[List[Tuple[str, dict]]]:
+    """
+    splits the changes into chunks which fit into a single change batch.
+    """
+    chunk, size = [], 0
+    for item_id, change in changes:
+        change_size = task_event.get_change_size(change)
+        if chunk and size + change_size > max_size:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append((item_id, change))
+        size += change_size
+    if chunk:
+        yield chunk
+
+
+def submit_chunk(route53, hosted_zone_id: str, chunk: List[Tuple[str, dict]]) -> List[str]:
+    """
+    submits the changes in a single batch. If the batch is rejected, the changes are
+    resubmitted per item, so that a single invalid change does not fail the others. Returns
+    the identifiers of the items which failed.
+    """
+    try:
+        task_event.change_resource_record_sets(route53, hosted_zone_id, [change for _, change in chunk])
+        return []
+    except ClientError as e:
+        log.error("change batch of %d changes for zone %s failed, %s", len(chunk), hosted_zone_id, e)
+
+    per_item = OrderedDict()
+    for item_id, change in chunk:
+        per_item.setdefault(item_id, []).append(change)
+    if len(per_item) == 1:
+        return list(per_item.keys())
+
+    failed = []
+    for item_id, changes in per_item.items():
+        try:
+            task_event.change_resource_record_sets(route53, hosted_zone_id, changes)
+        except ClientError as e:
+            log.error("changes for item %s in zone %s failed, %s", item_id, hosted_zone_id, e)
+            failed.append(item_id)
+    return failed
+
+
+def prefetch_container_instances(events: List[dict], clients: aws_clients.ClientProvider):
+    """
+    resolves the container instances of the tasks in bridge or host network mode with one
+    lookup per cluster, instead of one per task.
+    """
+    registrators = OrderedDict()
+    for event in events:
+        registrator = task_event.create_registrator(event, clients)
+        if registrator.uses_host_network():
+            registrators.setdefault(registrator.cluster_arn, []).append(registrator)
+    for cluster_arn, cluster_registrators in registrators.items():
+        registrator = cluster_registrators[0]
+        try:
+            container_instances.container_instance_index.resolve(
+                registrator.ecs, registrator.ec2, cluster_arn, [r.container_instance_arn for r in cluster_registrators]
+            )
+        except ClientError as e:
+            log.error('failed to describe the container instances of cluster "%s", %s', cluster_arn, e)
+
+
+def process(items: List[Tuple[str, dict]], clients: aws_clients.ClientProvider = None) -> List[str]:
+    """
+    processes the events and returns the identifiers of the items which failed.
+    """
+    clients = clients if clients else aws_clients.clients
+    failed = []
+    changes = defaultdict(list)
+    roles = {}
+    relevant = [(i, e) for i, e in items if not is_irrelevant(e)]
+    metrics.collector.increment("skipped_events", len(items) - len(relevant))
+    latest = get_latest_events(relevant)
+    metrics.collector.increment("superseded_events", len(relevant) - len(latest))
+    registering = [e for _, e in latest.values() if event_filter.classify(e) == event_filter.REGISTER]
+    prefetch_container_instances(registering, clients)
+    for item_id, event in latest.values():
+        detail = event["detail"]
+        try:
+            registrator = task_event.create_registrator(event, clients)
+            event_changes = registrator.get_changes(detail["desiredStatus"], detail["lastStatus"])
+            if not event_changes:
+                metrics.collector.increment("skipped_events")
+            for hosted_zone_id, change in event_changes:
+                changes[hosted_zone_id].append((item_id, change))
+                roles.setdefault(hosted_zone_id, registrator.get_hosted_zone_role(hosted_zone_id))
+        except Exception as e:
+            log.exception('failed to process task "%s", %s', detail["taskArn"], e)
+            failed.append(item_id)
+
+    for hosted_zone_id, zone_changes in changes.items():
+        route53 = task_event.get_route53(clients, hosted_zone_id, roles[hosted_zone_id])
+        for chunk in chunk_changes(zone_changes):
+            failed.extend(submit_chunk(route53, hosted_zone_id, chunk))
+    return list(OrderedDict.fromkeys(failed))
+
+
+def handler(event, context):
+    items = get_items(event)
+    with metrics.collector.invocation(events=len(items)), profiling.profiler.invocation(event):
+        task_event.change_completion.verify_pending()
+        failed = process(items)
+    return {"batchItemFailures": [{"itemIdentifier": item_id} for item_id in failed]}
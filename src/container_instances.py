@@ -0,0 +1,115 @@
+"""
+index of the host addresses of the EC2 container instances, for tasks in bridge or host
+network mode.
+
+These tasks have no network interface of their own, and are reached on the addresses of
+the instance they run on. The container instance of a task is resolved to its EC2 instance
+with `ecs:DescribeContainerInstances`, and the instance to its addresses with
+`ec2:DescribeInstances`, both for up to 100 container instances per call. As hundreds of
+tasks share a few hosts, the addresses are kept per container instance for
+CONTAINER_INSTANCE_TTL seconds.
+"""
+import logging
+import os
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple
+
+import metrics
+from cache import LRUCache
+
+log = logging.getLogger()
+
+# maximum number of container instances per describe call.
+BATCH_SIZE = 100
+
+
+class HostAddress(NamedTuple):
+    instance_id: str
+    private_ip: str
+    public_ip: str = None
+    private_dns_name: str = None
+    public_dns_name: str = None
+
+
+class ContainerInstanceIndex(object):
+    """
+    a cache of the host addresses by container instance arn, whose entries expire after
+    `ttl` seconds.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 600.0):
+        self.hosts = LRUCache(maxsize, ttl)
+
+    def get(self, ecs, ec2, cluster_arn: str, container_instance_arn: str) -> HostAddress:
+        """
+        returns the host address of the container instance, or None if it was not found.
+        """
+        return self.resolve(ecs, ec2, cluster_arn, [container_instance_arn]).get(container_instance_arn)
+
+    def resolve(self, ecs, ec2, cluster_arn: str, container_instance_arns: List[str]) -> Dict[str, HostAddress]:
+        """
+        returns the host addresses of the container instances of the cluster, describing the
+        ones not in the index in batches.
+        """
+        result = {}
+        missing = []
+        for arn in OrderedDict.fromkeys(filter(None, container_instance_arns)):
+            host = self.hosts.get(arn)
+            if host is None:
+                missing.append(arn)
+            else:
+                result[arn] = host
+        metrics.collector.increment("container_instance_hits", len(result))
+        if missing:
+            metrics.collector.increment("container_instance_misses", len(missing))
+        for i in range(0, len(missing), BATCH_SIZE):
+            result.update(self.describe(ecs, ec2, cluster_arn, missing[i : i + BATCH_SIZE]))
+        return result
+
+    def describe(self, ecs, ec2, cluster_arn: str, container_instance_arns: List[str]) -> Dict[str, HostAddress]:
+        response = ecs.describe_container_instances(cluster=cluster_arn, containerInstances=container_instance_arns)
+        for failure in response.get("failures", []):
+            log.warning('container instance "%s" not found, %s', failure.get("arn"), failure.get("reason"))
+        instance_ids = {
+            c["containerInstanceArn"]: c["ec2InstanceId"] for c in response["containerInstances"] if c.get("ec2InstanceId")
+        }
+        if not instance_ids:
+            return {}
+
+        instances = {}
+        response = ec2.describe_instances(InstanceIds=sorted(set(instance_ids.values())))
+        for reservation in response["Reservations"]:
+            for instance in reservation["Instances"]:
+                instances[instance["InstanceId"]] = instance
+
+        result = {}
+        for arn, instance_id in instance_ids.items():
+            instance = instances.get(instance_id)
+            if not instance:
+                log.warning('instance "%s" of container instance "%s" not found', instance_id, arn)
+                continue
+            host = HostAddress(
+                instance_id,
+                instance.get("PrivateIpAddress"),
+                instance.get("PublicIpAddress"),
+                instance.get("PrivateDnsName") or None,
+                instance.get("PublicDnsName") or None,
+            )
+            self.hosts.put(arn, host)
+            result[arn] = host
+        return result
+
+    def clear(self):
+        self.hosts.clear()
+
+
+def from_environment() -> ContainerInstanceIndex:
+    """
+    returns the index configured by CONTAINER_INSTANCE_CACHE_SIZE and CONTAINER_INSTANCE_TTL.
+    """
+    return ContainerInstanceIndex(
+        int(os.getenv("CONTAINER_INSTANCE_CACHE_SIZE", "1024")), float(os.getenv("CONTAINER_INSTANCE_TTL", "600"))
+    )
+
+
+container_instance_index = from_environment()
@@ -0,0 +1,173 @@
+"""
+classifies ECS task state change events as registration, deregistration or irrelevant,
+from the event alone, before any client is created or AWS API called.
+
+A task is registered when both its desired and last status are RUNNING, and deregistered
+when its desired status is STOPPED and its last status is one of DEREGISTER_LAST_STATUSES.
+By default, these are RUNNING, to remove the record as soon as the task is stopping, and
+STOPPED, to catch the tasks whose earlier events were missed. Events of clusters and task
+definition families excluded by the allow and deny lists are irrelevant as well.
+
+The same rules are available as EventBridge event pattern, so that irrelevant events do not
+invoke the function at all:
+
+    python src/event_filter.py [--format json|yaml]
+"""
+import json
+import os
+import re
+from fnmatch import fnmatchcase
+from typing import List
+
+REGISTER = "register"
+DEREGISTER = "deregister"
+IRRELEVANT = "irrelevant"
+
+DEFAULT_DEREGISTER_LAST_STATUSES = "RUNNING,STOPPED"
+
+
+class EventFilter(object):
+    """
+    classifies task state change events. The allow and deny lists contain cluster names or
+    task definition families, which may contain `*` wildcards. An empty allow list allows all.
+    """
+
+    def __init__(
+        self,
+        deregister_last_statuses: List[str] = None,
+        cluster_allow_list: List[str] = None,
+        cluster_deny_list: List[str] = None,
+        family_allow_list: List[str] = None,
+        family_deny_list: List[str] = None,
+    ):
+        self.deregister_last_statuses = set(
+            deregister_last_statuses if deregister_last_statuses else parse_list(DEFAULT_DEREGISTER_LAST_STATUSES)
+        )
+        self.cluster_allow_list = cluster_allow_list if cluster_allow_list else []
+        self.cluster_deny_list = cluster_deny_list if cluster_deny_list else []
+        self.family_allow_list = family_allow_list if family_allow_list else []
+        self.family_deny_list = family_deny_list if family_deny_list else []
+
+    def get_transition(self, desired_state: str, last_state: str) -> str:
+        if desired_state == "RUNNING" and last_state == "RUNNING":
+            return REGISTER
+        if desired_state == "STOPPED" and last_state in self.deregister_last_statuses:
+            return DEREGISTER
+        return IRRELEVANT
+
+    def classify(self, event: dict) -> str:
+        """
+        returns REGISTER, DEREGISTER or IRRELEVANT for the `event`.
+        """
+        if event.get("detail-type") != "ECS Task State Change":
+            return IRRELEVANT
+        detail = event.get("detail", {})
+        transition = self.get_transition(detail.get("desiredStatus"), detail.get("lastStatus"))
+        if transition == IRRELEVANT:
+            return IRRELEVANT
+        if not is_allowed(get_cluster_name(detail), self.cluster_allow_list, self.cluster_deny_list):
+            return IRRELEVANT
+        if not is_allowed(get_family(detail), self.family_allow_list, self.family_deny_list):
+            return IRRELEVANT
+        return transition
+
+    def event_pattern(self) -> dict:
+        """
+        returns the EventBridge event pattern matching the relevant events. The deny lists
+        are only applied by `classify`.
+        """
+        detail = {
+            "$or": [
+                {"desiredStatus": ["RUNNING"], "lastStatus": ["RUNNING"]},
+                {"desiredStatus": ["STOPPED"], "lastStatus": sorted(self.deregister_last_statuses)},
+            ]
+        }
+        if self.cluster_allow_list:
+            detail["clusterArn"] = [{"wildcard": "*:cluster/{}".format(c)} for c in self.cluster_allow_list]
+        if self.family_allow_list:
+            detail["taskDefinitionArn"] = [
+                {"wildcard": "*:task-definition/{}:*".format(f)} for f in self.family_allow_list
+            ]
+        return {"source": ["aws.ecs"], "detail-type": ["ECS Task State Change"], "detail": detail}
+
+
+def get_cluster_name(detail: dict) -> str:
+    return detail.get("clusterArn", "").split("/")[-1]
+
+
+def get_family(detail: dict) -> str:
+    return detail.get("taskDefinitionArn", "").split("/")[-1].split(":")[0]
+
+
+def is_allowed(name: str, allow_list: List[str], deny_list: List[str]) -> bool:
+    if allow_list and not any(fnmatchcase(name, p) for p in allow_list):
+        return False
+    return not any(fnmatchcase(name, p) for p in deny_list)
+
+
+def parse_list(value: str) -> List[str]:
+    return list(filter(None, map(str.strip, value.split(","))))
+
+
+def from_environment() -> EventFilter:
+    """
+    returns the filter configured by DEREGISTER_LAST_STATUSES, CLUSTER_ALLOW_LIST,
+    CLUSTER_DENY_LIST, FAMILY_ALLOW_LIST and FAMILY_DENY_LIST.
+    """
+    return EventFilter(
+        parse_list(os.getenv("DEREGISTER_LAST_STATUSES", DEFAULT_DEREGISTER_LAST_STATUSES)),
+        parse_list(os.getenv("CLUSTER_ALLOW_LIST", "")),
+        parse_list(os.getenv("CLUSTER_DENY_LIST", "")),
+        parse_list(os.getenv("FAMILY_ALLOW_LIST", "")),
+        parse_list(os.getenv("FAMILY_DENY_LIST", "")),
+    )
+
+
+event_filter = from_environment()
+
+
+def classify(event: dict) -> str:
+    return event_filter.classify(event)
+
+
+def to_yaml(value, indent: int = 0) -> str:
+    """
+    returns the event pattern as YAML, to be pasted under `EventPattern` in the template.
+    """
+    prefix = " " * indent
+    lines = []
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if isinstance(item, (dict, list)):
+                lines.append("{}{}:".format(prefix, key))
+                lines.append(to_yaml(item, indent + 2))
+            else:
+                lines.append("{}{}: {}".format(prefix, key, to_yaml_scalar(item)))
+    else:
+        for item in value:
+            if isinstance(item, (dict, list)):
+                nested = to_yaml(item, indent + 2)
+                lines.append("{}- {}".format(prefix, nested.lstrip()))
+            else:
+                lines.append("{}- {}".format(prefix, to_yaml_scalar(item)))
+    return "\n".join(lines)
+
+
+def to_yaml_scalar(value) -> str:
+    if isinstance(value, str) and re.match(r"^[A-Za-z][\w. /-]*$", value):
+        return value
+    return json.dumps(value)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="print the EventBridge event pattern of the relevant events")
+    parser.add_argument("--format", choices=["json", "yaml"], default="yaml")
+    args = parser.parse_args()
+    pattern = event_filter.event_pattern()
+    print(json.dumps(pattern, indent=2) if args.format == "json" else to_yaml(pattern))
+
+
+if __name__ == "__main__":
+    main()
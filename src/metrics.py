@@ -0,0 +1,230 @@
+"""
+instrumentation of the hot path, emitted in the CloudWatch Embedded Metric Format (EMF).
+
+Every AWS call made by a registered boto3 client is timed, from the start of the call until
+the parsed response, including retries. Retries and throttled attempts are counted, and the
+handlers add counters such as skipped events and cache hits. At the end of an invocation
+a single EMF JSON record is written to stdout, from which CloudWatch extracts the metrics.
+The metrics are collected per invocation in a context variable, so that concurrent
+invocations in one process each write their own record.
+
+The cost is a clock read and a dictionary update per AWS call, so the instrumentation can
+be left on in production. Set METRICS_ENABLED to "false" to disable it.
+"""
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+
+from rate_limit import THROTTLING_ERROR_CODES
+
+# maximum number of values per metric in a single EMF record. Timings with more samples are
+# reduced to as many evenly spaced quantiles.
+MAX_VALUES = 100
+
+# maximum number of metrics in a single EMF record.
+MAX_METRICS = 100
+
+
+class Collected(object):
+    """
+    the timings, counters and properties collected in a single invocation.
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+        self.properties = {}
+        self.lock = threading.Lock()
+
+
+class Metrics(object):
+    """
+    a thread safe collector of the timings and counters of an invocation. Metrics recorded
+    outside of an invocation are collected for the process, until the next flush.
+    """
+
+    def __init__(self, namespace: str = "ECSDNSRegistrator", enabled: bool = True, dimensions: Dict[str, str] = None):
+        self.namespace = namespace
+        self.enabled = enabled
+        self.dimensions = dimensions if dimensions else {}
+        self._process = Collected()
+        self._current = contextvars.ContextVar("metrics", default=None)
+
+    @property
+    def collected(self) -> Collected:
+        current = self._current.get()
+        return current if current is not None else self._process
+
+    @property
+    def timings(self) -> Dict[str, list]:
+        return self.collected.timings
+
+    @property
+    def counters(self) -> Dict[str, int]:
+        return self.collected.counters
+
+    def increment(self, name: str, value: int = 1):
+        if not self.enabled:
+            return
+        collected = self.collected
+        with collected.lock:
+            collected.counters[name] = collected.counters.get(name, 0) + value
+
+    def record(self, name: str, milliseconds: float):
+        if not self.enabled:
+            return
+        collected = self.collected
+        with collected.lock:
+            collected.timings.setdefault(name, []).append(milliseconds)
+
+    def set_property(self, name: str, value):
+        if self.enabled:
+            self.collected.properties[name] = value
+
+    @contextmanager
+    def span(self, name: str):
+        """
+        records the elapsed time of the block as timing `name`, in milliseconds.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - start) * 1000)
+
+    def register(self, client):
+        """
+        times every call of `client`, and counts the retries and throttled attempts.
+        """
+        if not self.enabled:
+            return
+        from botocore import xform_name
+
+        names = {}
+
+        def before_call(model, context, **kwargs):
+            context["metrics_start"] = time.perf_counter()
+
+        def after_call(http_response, parsed, model, context, **kwargs):
+            start = context.get("metrics_start")
+            if start is None:
+                return
+            name = names.get(model.name)
+            if name is None:
+                name = names.setdefault(model.name, xform_name(model.name))
+            self.record(name, (time.perf_counter() - start) * 1000)
+            self.increment("aws_calls")
+            retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+            if retries:
+                self.increment("retries", retries)
+            if "Error" in parsed:
+                self.increment("aws_errors")
+
+        def needs_retry(response=None, **kwargs):
+            if response is not None and response[1].get("Error", {}).get("Code") in THROTTLING_ERROR_CODES:
+                self.increment("throttles")
+
+        client.meta.events.register("before-call", before_call)
+        client.meta.events.register("after-call", after_call)
+        client.meta.events.register("needs-retry", needs_retry)
+
+    def reset(self):
+        collected = self.collected
+        with collected.lock:
+            collected.timings = {}
+            collected.counters = {}
+            collected.properties = {}
+
+    def to_emf(self) -> dict:
+        """
+        returns the collected metrics as an EMF record.
+        """
+        collected = self.collected
+        with collected.lock:
+            timings = {k: get_quantiles(v, MAX_VALUES) for k, v in collected.timings.items()}
+            counters = dict(collected.counters)
+            properties = dict(collected.properties)
+            dropped = sum(len(v) - MAX_VALUES for v in collected.timings.values() if len(v) > MAX_VALUES)
+        if dropped:
+            counters["dropped_values"] = counters.get("dropped_values", 0) + dropped
+
+        definitions = [{"Name": k, "Unit": "Milliseconds"} for k in sorted(timings.keys())]
+        definitions.extend({"Name": k, "Unit": "Count"} for k in sorted(counters.keys()))
+        record = dict(properties)
+        record.update(self.dimensions)
+        record.update(timings)
+        record.update(counters)
+        record["_aws"] = {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": self.namespace,
+                    "Dimensions": [sorted(self.dimensions.keys())],
+                    "Metrics": definitions[:MAX_METRICS],
+                }
+            ],
+        }
+        return record
+
+    def flush(self, stream=None):
+        """
+        writes the collected metrics as a single EMF record, and resets the collector.
+        """
+        if not self.enabled:
+            return
+        collected = self.collected
+        if collected.timings or collected.counters:
+            (stream if stream else sys.stdout).write(json.dumps(self.to_emf(), separators=(",", ":")) + "\n")
+        self.reset()
+
+    @contextmanager
+    def invocation(self, **properties):
+        """
+        collects the metrics of the block, separate from other invocations, and flushes
+        them as a single record.
+        """
+        token = self._current.set(Collected())
+        try:
+            for name, value in properties.items():
+                self.set_property(name, value)
+            yield self
+        finally:
+            try:
+                self.flush()
+            finally:
+                self._current.reset(token)
+
+
+def get_quantiles(values: List[float], count: int) -> List[float]:
+    """
+    returns the `values`, or `count` evenly spaced quantiles of them if there are more.
+    """
+    if len(values) <= count:
+        return list(values)
+    ordered = sorted(values)
+    return [ordered[i * (len(ordered) - 1) // (count - 1)] for i in range(count)]
+
+
+def get_dimensions() -> Dict[str, str]:
+    function_name = os.getenv("AWS_LAMBDA_FUNCTION_NAME")
+    return {"FunctionName": function_name} if function_name else {}
+
+
+def from_environment() -> Metrics:
+    """
+    returns the collector configured by METRICS_ENABLED and METRICS_NAMESPACE.
+    """
+    return Metrics(
+        namespace=os.getenv("METRICS_NAMESPACE", "ECSDNSRegistrator"),
+        enabled=os.getenv("METRICS_ENABLED", "true") == "true",
+        dimensions=get_dimensions(),
+    )
+
+
+collector = from_environment()
+
@@ -0,0 +1,290 @@
+"""
+sampled profiling of the handler invocations.
+
+With PROFILE_SAMPLE_RATE above 0, that fraction of the invocations is run under cProfile
+and tracemalloc. For each sampled invocation, the following files are written to
+PROFILE_DIR, named after the time, the event type and the task id of the invocation:
+
+    <name>.pstats           cProfile statistics, for `python -m pstats` or snakeviz
+    <name>.collapsed        collapsed stacks in microseconds, for flamegraph.pl or speedscope
+    <name>.allocations.txt  the PROFILE_TOP_ALLOCATIONS lines allocating the most memory
+    <name>.json             the task arn, event type, duration and peak memory
+
+Only the thread running the handler is profiled, so the concurrent lookups show up as the
+time waiting for their result. An invocation which is not sampled costs a comparison and
+a shared null context, and the profiling modules are only imported once an invocation is
+sampled, so they do not add to the cold start. The profiles of many invocations are merged
+into a single flame graph input with:
+
+    python src/profiling.py merge PROFILE_DIR [--output FILE] [--pstats FILE]
+"""
+import json
+import logging
+import os
+import random
+import re
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List, Tuple
+
+log = logging.getLogger()
+
+# maximum depth of the collapsed stacks.
+MAX_DEPTH = 64
+
+# minimum time in seconds for a call path to be included in the collapsed stacks.
+MIN_TIME = 1e-6
+
+# the context of the invocations which are not sampled.
+NOT_PROFILED = nullcontext()
+
+
+class Profiler(object):
+    """
+    profiles a sample of `sample_rate` of the invocations, and writes the profiles to
+    `directory`.
+    """
+
+    def __init__(self, directory: str = "/tmp/profiles", sample_rate: float = 0.0, top_allocations: int = 25):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.top_allocations = top_allocations
+        self.profiled = 0
+
+    def invocation(self, event):
+        """
+        returns the context in which to run the invocation of `event`, which profiles it if
+        it is sampled.
+        """
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return NOT_PROFILED
+        return self.profile(event)
+
+    @contextmanager
+    def profile(self, event):
+        import cProfile
+        import tracemalloc
+
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # another profiler is active
+            log.warning("not profiling the invocation, %s", e)
+            profile = None
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+            duration = time.perf_counter() - start
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if not tracing:
+                tracemalloc.stop()
+            try:
+                if profile:
+                    self.write(event, profile, snapshot, duration, peak)
+            except (OSError, ValueError) as e:
+                log.error("failed to write profile, %s", e)
+
+    def write(self, event, profile, snapshot, duration: float, peak: int):
+        """
+        writes the cProfile `profile` and the tracemalloc `snapshot` of the invocation.
+        """
+        import pstats
+        import uuid
+
+        task_arn, event_type = get_tags(event)
+        os.makedirs(self.directory, exist_ok=True)
+        name = "{}-{}-{}-{}".format(
+            time.strftime("%Y%m%dT%H%M%S", time.gmtime()),
+            event_type,
+            task_arn.split("/")[-1] if task_arn else "none",
+            uuid.uuid4().hex[:8],
+        )
+        path = os.path.join(self.directory, name)
+
+        profile.dump_stats(path + ".pstats")
+        stacks = get_collapsed_stacks(pstats.Stats(profile))
+        with open(path + ".collapsed", "w") as f:
+            write_collapsed_stacks(stacks, f)
+        with open(path + ".allocations.txt", "w") as f:
+            for statistic in snapshot.statistics("lineno")[: self.top_allocations]:
+                f.write("{}\n".format(statistic))
+        with open(path + ".json", "w") as f:
+            json.dump(
+                {
+                    "taskArn": task_arn,
+                    "eventType": event_type,
+                    "duration_ms": duration * 1000,
+                    "peak_memory_kb": peak / 1024.0,
+                },
+                f,
+            )
+        self.profiled += 1
+        log.info('profile of %s event of task "%s" written to %s', event_type, task_arn, path)
+
+
+def get_tags(event) -> Tuple[str, str]:
+    """
+    returns the task arn and the event type, e.g. `task-state-change-running`, of the event.
+    A batch is tagged with its size.
+    """
+    if isinstance(event, list) or (isinstance(event, dict) and "Records" in event):
+        items = event if isinstance(event, list) else event["Records"]
+        return None, "batch-{}".format(len(items))
+    detail = event.get("detail", {}) if isinstance(event, dict) else {}
+    event_type = re.sub(r"[^a-z0-9]+", "-", event.get("detail-type", "unknown").lower()).strip("-")
+    event_type = re.sub(r"^ecs-", "", event_type)
+    if detail.get("lastStatus"):
+        event_type = "{}-{}".format(event_type, detail["lastStatus"].lower())
+    return detail.get("taskArn"), event_type
+
+
+def get_label(func: tuple) -> str:
+    filename, line, name = func
+    if filename == "~":
+        return name.replace(";", ",")
+    return "{} ({}:{})".format(name, os.path.basename(filename), line).replace(";", ",")
+
+
+def get_collapsed_stacks(stats) -> Dict[str, float]:
+    """
+    returns the time in seconds per call stack, reconstructed from the caller and callee
+    times of the pstats `stats`. The time of a function is attributed to its call stacks in
+    proportion to the time spent in it from each caller.
+    """
+    callees = defaultdict(dict)
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, caller_stats in callers.items():
+            callees[caller][func] = caller_stats[3]
+
+    result = defaultdict(float)
+
+    def walk(func: tuple, stack: List[str], path: set, scale: float):
+        own_time = stats.stats[func][2]
+        stack.append(get_label(func))
+        path.add(func)
+        if own_time * scale >= MIN_TIME:
+            result[";".join(stack)] += own_time * scale
+        if len(stack) < MAX_DEPTH:
+            for callee, edge_time in callees.get(func, {}).items():
+                callee_time = stats.stats[callee][3]
+                if callee in path or callee_time <= 0 or edge_time * scale < MIN_TIME:
+                    continue
+                walk(callee, stack, path, scale * edge_time / callee_time)
+        path.discard(func)
+        stack.pop()
+
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        if not callers:
+            walk(func, [], set(), 1.0)
+    return result
+
+
+def write_collapsed_stacks(stacks: Dict[str, float], stream):
+    """
+    writes the stacks as `frame;frame;frame microseconds` lines.
+    """
+    for stack, seconds in sorted(stacks.items()):
+        microseconds = int(round(seconds * 1000000))
+        if microseconds > 0:
+            stream.write("{} {}\n".format(stack, microseconds))
+
+
+def read_collapsed_stacks(path: str) -> Dict[str, float]:
+    result = {}
+    with open(path) as f:
+        for line in f:
+            stack, _, value = line.rstrip("\n").rpartition(" ")
+            if stack:
+                result[stack] = result.get(stack, 0.0) + int(value) / 1000000.0
+    return result
+
+
+def find_profiles(paths: List[str], extension: str) -> List[str]:
+    import glob
+
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            result.extend(sorted(glob.glob(os.path.join(path, "*" + extension))))
+        elif path.endswith(extension):
+            result.append(path)
+    return result
+
+
+def merge(paths: List[str], output=None, pstats_output: str = None) -> int:
+    """
+    merges the collapsed stacks of the profiles in `paths` into `output`, and optionally the
+    cProfile statistics into `pstats_output`. Returns the number of profiles merged.
+    """
+    import pstats
+
+    stacks = defaultdict(float)
+    profiles = find_profiles(paths, ".collapsed")
+    for path in profiles:
+        for stack, seconds in read_collapsed_stacks(path).items():
+            stacks[stack] += seconds
+    write_collapsed_stacks(stacks, output if output else sys.stdout)
+
+    if pstats_output:
+        stats = None
+        for path in find_profiles(paths, ".pstats"):
+            if stats is None:
+                stats = pstats.Stats(path)
+            else:
+                stats.add(path)
+        if stats is not None:
+            stats.dump_stats(pstats_output)
+    return len(profiles)
+
+
+def from_environment() -> Profiler:
+    """
+    returns the profiler configured by PROFILE_SAMPLE_RATE, PROFILE_DIR and
+    PROFILE_TOP_ALLOCATIONS.
+    """
+    return Profiler(
+        directory=os.getenv("PROFILE_DIR", "/tmp/profiles"),
+        sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", "0")),
+        top_allocations=int(os.getenv("PROFILE_TOP_ALLOCATIONS", "25")),
+    )
+
+
+profiler = from_environment()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="merge sampled profiles into flame graph input")
+    commands = parser.add_subparsers(dest="command")
+    merging = commands.add_parser("merge", help="merge the collapsed stacks of the profiles")
+    merging.add_argument("paths", nargs="+", help="profile directories or files")
+    merging.add_argument("--output", help="write the collapsed stacks to this file, default stdout")
+    merging.add_argument("--pstats", help="write the merged cProfile statistics to this file")
+    args = parser.parse_args()
+    if args.command != "merge":
+        parser.error("a command is required")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            count = merge(args.paths, f, args.pstats)
+    else:
+        count = merge(args.paths, None, args.pstats)
+    sys.stderr.write("merged {} profiles\n".format(count))
+
+
+if __name__ == "__main__":
+    main()
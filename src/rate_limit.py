@@ -0,0 +1,208 @@
+"""
+client side rate limiting of the AWS API calls.
+
+Every HTTP request sent by a registered boto3 client takes a token from the bucket of its
+API family, which defaults to the service name. When a request is throttled, the rate of
+the bucket is halved; successful requests restore it gradually. The retries themselves
+are left to the botocore retry handler, which backs off exponentially with jitter.
+
+Concurrent Lambda invocations can be coordinated through a shared counter, which counts
+the requests per family per second. Tokens are leased from the counter a few at a time,
+so that most requests need no call to the counter. A DynamoDB table with the partition key
+`id` can be used as shared counter, or an in-process counter as a stand-in.
+"""
+import logging
+import os
+import random
+import threading
+import time
+from typing import Dict
+
+log = logging.getLogger()
+
+THROTTLING_ERROR_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+    "RequestThrottled",
+    "PriorRequestNotComplete",
+    "EC2ThrottledException",
+}
+
+# default requests per second per API family. Route53 allows five requests per second
+# per account.
+DEFAULT_RATE_LIMITS = "route53=5,ecs=20,ec2=20,sts=10"
+
+
+class TokenBucket(object):
+    """
+    a thread safe token bucket whose rate adapts to throttling.
+    """
+
+    def __init__(self, rate: float, burst: float = None, min_rate: float = 0.5):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.capacity = burst if burst else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.throttles = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self) -> float:
+        """
+        takes a token, waiting until it is available. Returns the time waited in seconds.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    def throttled(self):
+        with self._lock:
+            self.throttles += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+        log.info("throttled, reduced rate to %.2f requests per second", self.rate)
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+class LocalCounter(object):
+    """
+    in-process stand-in for a shared counter.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def increment(self, key: str, expires: int, count: int = 1) -> int:
+        with self._lock:
+            now = time.time()
+            self.counts = {k: v for k, v in self.counts.items() if v[1] >= now}
+            count = self.counts.get(key, (0, expires))[0] + count
+            self.counts[key] = (count, expires)
+            return count
+
+
+class DynamoDBCounter(object):
+    """
+    counter shared by all invocations, stored in a DynamoDB table with partition key `id`
+    and the TTL attribute `expires`.
+    """
+
+    def __init__(self, table_name: str):
+        self.table_name = table_name
+
+    def increment(self, key: str, expires: int, count: int = 1) -> int:
+        import aws_clients
+
+        response = aws_clients.get_client("dynamodb").update_item(
+            TableName=self.table_name,
+            Key={"id": {"S": key}},
+            UpdateExpression="ADD hits :count SET expires = if_not_exists(expires, :expires)",
+            ExpressionAttributeValues={":count": {"N": str(count)}, ":expires": {"N": str(expires)}},
+            ReturnValues="UPDATED_NEW",
+        )
+        return int(response["Attributes"]["hits"]["N"])
+
+
+class RateLimiter(object):
+    """
+    rate limits the requests per API family. With a shared `counter`, up to `lease_fraction`
+    of the limit of a family is leased per call to the counter; the tokens leased but not used
+    within their second are lost.
+    """
+
+    def __init__(self, limits: Dict[str, float], counter=None, lease_fraction: float = 0.25):
+        self.limits = limits
+        self.counter = counter
+        self.lease_fraction = lease_fraction
+        self.buckets = {family: TokenBucket(rate) for family, rate in limits.items()}
+        self.leases = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, family: str):
+        bucket = self.buckets.get(family)
+        if not bucket:
+            return
+        bucket.acquire()
+        if self.counter:
+            self._acquire_shared(family)
+
+    def _acquire_shared(self, family: str):
+        limit = self.limits[family]
+        size = max(1, int(limit * self.lease_fraction))
+        while True:
+            window = int(time.time())
+            with self._lock:
+                lease = self.leases.get(family)
+                if lease and lease[0] == window and lease[1] > 0:
+                    lease[1] -= 1
+                    return
+            count = self.counter.increment("{}#{}".format(family, window), window + 60, size)
+            granted = min(size, int(limit) - (count - size))
+            if granted > 0:
+                with self._lock:
+                    self.leases[family] = [window, granted - 1]
+                return
+            time.sleep(max(0.0, window + 1 - time.time()) + random.uniform(0, 0.1))
+
+    def observe(self, family: str, error_code: str):
+        bucket = self.buckets.get(family)
+        if not bucket:
+            return
+        if error_code in THROTTLING_ERROR_CODES:
+            bucket.throttled()
+        elif not error_code:
+            bucket.succeeded()
+
+    def register(self, client):
+        """
+        rate limits every request sent by `client`, including retries.
+        """
+        family = client.meta.service_model.service_name
+
+        def before_send(**kwargs):
+            self.acquire(family)
+
+        def needs_retry(response=None, **kwargs):
+            if response is not None:
+                self.observe(family, response[1].get("Error", {}).get("Code"))
+
+        client.meta.events.register("before-send", before_send)
+        client.meta.events.register_first("needs-retry", needs_retry)
+
+
+def parse_limits(limits: str) -> Dict[str, float]:
+    result = {}
+    for limit in filter(None, map(str.strip, limits.split(","))):
+        family, rate = limit.split("=")
+        result[family.strip()] = float(rate)
+    return result
+
+
+def from_environment():
+    """
+    returns the rate limiter configured by RATE_LIMITS and RATE_LIMIT_TABLE, or None
+    if rate limiting is disabled.
+    """
+    limits = parse_limits(os.getenv("RATE_LIMITS", DEFAULT_RATE_LIMITS))
+    if not limits:
+        return None
+    table_name = os.getenv("RATE_LIMIT_TABLE")
+    return RateLimiter(limits, DynamoDBCounter(table_name) if table_name else None)
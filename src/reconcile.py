@@ -0,0 +1,401 @@
+"""
+reconciles the DNS records with the tasks running in the ECS clusters.
+
+Events may get lost, leaving stale or missing records in the hosted zones. The
+reconciliation lists and describes the running tasks of each cluster once, resolves the
+records they should have, and compares them with the records in the hosted zones. Only the
+minimal set of UPSERT and DELETE changes is applied, in bulk change batches.
+
+Records are recognized as managed by the registrator when they are weighted A or SRV
+records with an ECS task id as set identifier, or aggregated A records with the name of a
+running task in aggregate mode. The tasks of each cluster are described in the region of
+the cluster, with the role of its account. By default, all clusters in the region are
+reconciled, of the account of the function and of the accounts of ACCOUNT_ROLE_ARNS.
+
+The names registered by the running tasks are taken to be registered by the reconciled
+clusters only: aggregated records get the addresses of the running tasks, and a weighted
+record of a task which is no longer running is deleted, also when ECS no longer knows the
+task. Under other names, which other clusters may register, a weighted record is only
+deleted when its task is found stopped in one of the reconciled clusters. With
+`delete_unknown`, all records of tasks not running are deleted.
+
+The hosted zones are known once the tasks are described, so the tasks are listed again after
+the records are listed, and the tasks started in between are described as well. The records
+of running tasks whose task definition or ip address could not be resolved are left as they
+are.
+"""
+import argparse
+import json
+import logging
+import re
+from collections import defaultdict
+from typing import Dict, Iterator, List, Tuple
+
+import aws_clients
+import batch_event
+import container_instances
+import task_event
+
+log = logging.getLogger()
+
+# ECS task ids are either a uuid or 32 hexadecimal characters.
+TASK_ID_PATTERN = re.compile(r"^([0-9a-f]{32}|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})$")
+
+# maximum number of tasks in a single describe_tasks call.
+DESCRIBE_TASKS_BATCH_SIZE = 100
+
+
+def get_clusters(clients: aws_clients.ClientProvider) -> List[str]:
+    """
+    returns the clusters in the region, of the account of the function and of the accounts
+    with a role in ACCOUNT_ROLE_ARNS.
+    """
+    result = []
+    for role_arn in [None] + sorted(set(task_event.account_roles.values())):
+        for page in clients.get("ecs", role_arn=role_arn).get_paginator("list_clusters").paginate():
+            result.extend(page["clusterArns"])
+    return result
+
+
+def get_running_tasks(ecs, cluster: str) -> Iterator[List[task_event.TaskView]]:
+    """
+    yields the running tasks of `cluster`, in batches of at most 100 tasks. The tasks are
+    projected as soon as each page is described, so only one page of responses is held.
+    """
+    for page in ecs.get_paginator("list_tasks").paginate(
+        cluster=cluster, desiredStatus="RUNNING", PaginationConfig={"PageSize": DESCRIBE_TASKS_BATCH_SIZE}
+    ):
+        if page["taskArns"]:
+            yield describe_running_tasks(ecs, cluster, page["taskArns"])
+
+
+def describe_running_tasks(ecs, cluster: str, task_arns: List[str]) -> List[task_event.TaskView]:
+    response = ecs.describe_tasks(cluster=cluster, tasks=task_arns)
+    return [task_event.TaskView.from_task(t) for t in response["tasks"] if t.get("lastStatus") == "RUNNING"]
+
+
+def get_tasks(clients: aws_clients.ClientProvider, clusters: List[str]) -> Dict[str, List[task_event.TaskView]]:
+    """
+    returns the running tasks per cluster.
+    """
+    result = {}
+    for cluster in clusters:
+        ecs = task_event.get_cluster_client(clients, "ecs", cluster)
+        result[cluster] = [t for tasks in get_running_tasks(ecs, cluster) for t in tasks]
+    return result
+
+
+def add_started_tasks(clients: aws_clients.ClientProvider, tasks: Dict[str, List[task_event.TaskView]]):
+    """
+    adds the tasks which were started since the `tasks` were listed, describing only those.
+    """
+    for cluster, cluster_tasks in tasks.items():
+        ecs = task_event.get_cluster_client(clients, "ecs", cluster)
+        known = {t.task_arn for t in cluster_tasks}
+        for page in ecs.get_paginator("list_tasks").paginate(
+            cluster=cluster, desiredStatus="RUNNING", PaginationConfig={"PageSize": DESCRIBE_TASKS_BATCH_SIZE}
+        ):
+            started = [a for a in page["taskArns"] if a not in known]
+            if started:
+                cluster_tasks.extend(describe_running_tasks(ecs, cluster, started))
+
+
+def get_hosted_zones(
+    clients: aws_clients.ClientProvider, tasks: Dict[str, List[task_event.TaskView]]
+) -> Tuple[Dict[str, set], Dict[str, set], Dict[str, str]]:
+    """
+    returns the hosted zones referenced by the task definitions of the running tasks, with the
+    names and types of their weighted records, the names of their aggregated records, and the
+    roles of the hosted zones in the labels.
+    """
+    names = defaultdict(set)
+    aggregated = defaultdict(set)
+    roles = {}
+    for cluster, cluster_tasks in tasks.items():
+        for task_definition_arn in sorted({t.task_definition_arn for t in cluster_tasks}):
+            registrator = task_event.DNSRegistrator(None, cluster, task_definition_arn, clients)
+            registrator.get_task_definition()
+            for dns_entry in registrator.dns_entries:
+                if dns_entry.aggregate:
+                    aggregated[dns_entry.hosted_zone_id].add(dns_entry.name.lower())
+                else:
+                    names[dns_entry.hosted_zone_id].add((dns_entry.name.lower(), "A"))
+                if dns_entry.srv_name:
+                    names[dns_entry.hosted_zone_id].add((dns_entry.srv_name.lower(), "SRV"))
+                if dns_entry.role_arn:
+                    roles.setdefault(dns_entry.hosted_zone_id, dns_entry.role_arn)
+    return names, aggregated, roles
+
+
+def get_desired_records(
+    clients: aws_clients.ClientProvider, tasks: Dict[str, List[task_event.TaskView]]
+) -> Tuple[Dict[str, Dict[tuple, dict]], set]:
+    """
+    returns the record sets the running tasks should have, per hosted zone, keyed by name, type
+    and set identifier, and the records which could not be resolved. These are the task ids
+    of the tasks without a task definition or ip address, the keys of the records missing the
+    ip address or host port of a task and, if a task definition could not be described, None.
+    """
+    result = defaultdict(dict)
+    unresolved = set()
+    for cluster, cluster_tasks in tasks.items():
+        ecs = task_event.get_cluster_client(clients, "ecs", cluster)
+        ec2 = task_event.get_cluster_client(clients, "ec2", cluster)
+        for i in range(0, len(cluster_tasks), DESCRIBE_TASKS_BATCH_SIZE):
+            registrators = []
+            for task in cluster_tasks[i : i + DESCRIBE_TASKS_BATCH_SIZE]:
+                registrator = task_event.DNSRegistrator(
+                    task.task_arn, cluster, task.task_definition_arn, clients, task=task
+                )
+                if not registrator.get_task_definition():
+                    unresolved.update((registrator.task_id, None))
+                elif registrator.dns_entry:
+                    registrators.append(registrator)
+
+            eni_ids = [
+                a.eni_id
+                for r in registrators
+                if any(e.register_public_ip for e in r.dns_entries)
+                for a in r.get_eni_attachments()
+            ]
+            network_interfaces = task_event.describe_network_interfaces(ec2, [i for i in eni_ids if i])
+            container_instances.container_instance_index.resolve(
+                ecs,
+                ec2,
+                cluster,
+                [r.container_instance_arn for r in registrators if r.uses_host_network()],
+            )
+
+            for registrator in registrators:
+                registrator.network_interfaces = [
+                    network_interfaces[a.eni_id]
+                    for a in registrator.get_eni_attachments()
+                    if a.eni_id in network_interfaces
+                ]
+                for dns_entry in registrator.dns_entries:
+                    if dns_entry.srv_name:
+                        add_srv_record(result[dns_entry.hosted_zone_id], unresolved, registrator, dns_entry)
+                    if registrator.uses_host_network():
+                        ip_addresses = registrator.get_host_ip_addresses(dns_entry.register_public_ip)
+                    elif dns_entry.register_public_ip:
+                        ip_addresses = [ip for ip in registrator.get_ip_addresses(True) if ip]
+                    else:
+                        ip_addresses = registrator.get_attachment_ip_addresses()
+                    if not ip_addresses:
+                        log.warning('no ip address was found to register "%s" for task %s', dns_entry.name, registrator.task_arn)
+                        unresolved.add((dns_entry.name.lower(), "A", None) if dns_entry.aggregate else registrator.task_id)
+                        continue
+                    if dns_entry.aggregate:
+                        add_aggregated_value(result[dns_entry.hosted_zone_id], dns_entry, ip_addresses[0])
+                        continue
+                    rr_set = registrator.get_registration_change(ip_addresses[0], dns_entry)["ResourceRecordSet"]
+                    result[dns_entry.hosted_zone_id][get_key(rr_set)] = rr_set
+    return result, unresolved
+
+
+def add_srv_record(
+    records: Dict[tuple, dict], unresolved: set, registrator: task_event.DNSRegistrator, dns_entry: task_event.DNSEntry
+):
+    change = registrator.get_srv_registration_change(dns_entry)
+    if change:
+        records[get_key(change["ResourceRecordSet"])] = change["ResourceRecordSet"]
+    else:
+        unresolved.add((dns_entry.srv_name.lower(), "SRV", registrator.task_id))
+
+
+def add_aggregated_value(records: Dict[tuple, dict], dns_entry: task_event.DNSEntry, ip_address: str):
+    key = (dns_entry.name.lower(), "A", None)
+    rr_set = records.setdefault(key, {"Name": dns_entry.name, "Type": "A", "TTL": 30, "ResourceRecords": []})
+    if {"Value": ip_address} not in rr_set["ResourceRecords"]:
+        rr_set["ResourceRecords"].append({"Value": ip_address})
+        rr_set["ResourceRecords"].sort(key=lambda r: r["Value"])
+
+
+def get_task_statuses(clients: aws_clients.ClientProvider, clusters: List[str], task_ids: List[str]) -> Dict[str, str]:
+    """
+    returns the last status of the tasks which are found in one of the clusters, by task id.
+    """
+    result = {}
+    remaining = sorted(task_ids)
+    for cluster in clusters:
+        ecs = task_event.get_cluster_client(clients, "ecs", cluster)
+        for i in range(0, len(remaining), DESCRIBE_TASKS_BATCH_SIZE):
+            response = ecs.describe_tasks(cluster=cluster, tasks=remaining[i : i + DESCRIBE_TASKS_BATCH_SIZE])
+            result.update((t["taskArn"].split("/")[-1], t.get("lastStatus")) for t in response["tasks"])
+        remaining = [t for t in remaining if t not in result]
+        if not remaining:
+            break
+    return result
+
+
+def get_orphans(
+    clients: aws_clients.ClientProvider, clusters: List[str], keys: List[tuple], registered: set
+) -> List[tuple]:
+    """
+    returns the keys of the weighted records of tasks which are not running, whose task is
+    found stopped, or is unknown to the clusters while the name is `registered` by them.
+    """
+    statuses = get_task_statuses(clients, clusters, {key[2] for key in keys})
+    return [
+        key
+        for key in keys
+        if statuses.get(key[2]) == "STOPPED" or (key[2] not in statuses and key[:2] in registered)
+    ]
+
+
+def get_actual_records(route53, hosted_zone_id: str, aggregated_names: set = frozenset()) -> Dict[tuple, dict]:
+    """
+    returns the weighted A and SRV records in the hosted zone with a task id as set identifier,
+    and the A records with one of the `aggregated_names`.
+    """
+    result = {}
+    for page in route53.get_paginator("list_resource_record_sets").paginate(HostedZoneId=hosted_zone_id):
+        for rr_set in page["ResourceRecordSets"]:
+            if is_managed_record(rr_set) or is_aggregated_record(rr_set, aggregated_names):
+                result[get_key(rr_set)] = rr_set
+    return result
+
+
+def is_managed_record(rr_set: dict) -> bool:
+    return (
+        rr_set["Type"] in ("A", "SRV")
+        and "Weight" in rr_set
+        and "AliasTarget" not in rr_set
+        and bool(TASK_ID_PATTERN.match(rr_set.get("SetIdentifier", "")))
+    )
+
+
+def is_aggregated_record(rr_set: dict, aggregated_names: set) -> bool:
+    return (
+        rr_set["Type"] == "A"
+        and "SetIdentifier" not in rr_set
+        and "AliasTarget" not in rr_set
+        and rr_set["Name"].lower() in aggregated_names
+    )
+
+
+def get_key(rr_set: dict) -> tuple:
+    return rr_set["Name"].lower(), rr_set["Type"], rr_set.get("SetIdentifier")
+
+
+def is_equal(desired: dict, actual: dict) -> bool:
+    return (
+        sorted(r["Value"] for r in desired["ResourceRecords"])
+        == sorted(r["Value"] for r in actual.get("ResourceRecords", []))
+        and desired["TTL"] == actual.get("TTL")
+        and desired.get("Weight") == actual.get("Weight")
+    )
+
+
+def is_unresolved(key: tuple, unresolved: set) -> bool:
+    """
+    returns True if the record may belong to a running task which could not be resolved.
+    """
+    set_identifier = key[2]
+    if key in unresolved:
+        return True
+    if set_identifier is None:
+        return None in unresolved
+    return set_identifier in unresolved
+
+
+def get_changes(desired: Dict[tuple, dict], actual: Dict[tuple, dict], unresolved: set = frozenset()) -> List[dict]:
+    """
+    returns the minimal list of changes to turn the `actual` records into the `desired` records,
+    leaving the `unresolved` records as they are.
+    """
+    changes = []
+    for key, rr_set in desired.items():
+        if is_unresolved(key, unresolved):
+            continue
+        if key not in actual or not is_equal(rr_set, actual[key]):
+            changes.append({"Action": "UPSERT", "ResourceRecordSet": rr_set})
+    for key, rr_set in actual.items():
+        if key not in desired and not is_unresolved(key, unresolved):
+            changes.append({"Action": "DELETE", "ResourceRecordSet": rr_set})
+    return changes
+
+
+def reconcile(
+    clusters: List[str] = None,
+    hosted_zone_ids: List[str] = None,
+    dry_run: bool = False,
+    clients=None,
+    delete_unknown: bool = False,
+) -> dict:
+    """
+    reconciles the records in the hosted zones referenced by the running tasks of the
+    `clusters`, and in `hosted_zone_ids`. Returns a report of the changes per hosted zone.
+    """
+    clients = clients if clients else aws_clients.clients
+    if not clusters:
+        clusters = get_clusters(clients)
+
+    tasks = get_tasks(clients, clusters)
+    names, aggregated, roles = get_hosted_zones(clients, tasks)
+    hosted_zones = set(names.keys()) | set(aggregated.keys()) | set(hosted_zone_ids or [])
+    route53 = {z: task_event.get_route53(clients, z, roles.get(z)) for z in sorted(hosted_zones)}
+    actual = {z: get_actual_records(route53[z], z, aggregated.get(z, set())) for z in sorted(hosted_zones)}
+
+    add_started_tasks(clients, tasks)
+    desired, unresolved = get_desired_records(clients, tasks)
+    for hosted_zone_id in sorted(set(desired.keys()) - set(actual.keys())):
+        log.info("hosted zone %s is reconciled in the next run", hosted_zone_id)
+
+    report = {"dry_run": dry_run, "clusters": clusters, "hosted_zones": {}}
+    for hosted_zone_id in sorted(actual.keys()):
+        zone_desired, zone_actual = desired.get(hosted_zone_id, {}), actual.pop(hosted_zone_id)
+        zone_unresolved = unresolved
+        if not delete_unknown:
+            keys = [key for key in zone_actual.keys() if key[2] and key not in zone_desired]
+            orphans = get_orphans(clients, clusters, keys, names.get(hosted_zone_id, set()))
+            zone_unresolved = unresolved | (set(keys) - set(orphans))
+        changes = get_changes(zone_desired, zone_actual, zone_unresolved)
+        report["hosted_zones"][hosted_zone_id] = [
+            {
+                "Action": c["Action"],
+                "Name": c["ResourceRecordSet"]["Name"],
+                "SetIdentifier": c["ResourceRecordSet"].get("SetIdentifier"),
+                "Value": c["ResourceRecordSet"]["ResourceRecords"][0]["Value"],
+            }
+            for c in changes
+        ]
+        if dry_run or not changes:
+            continue
+        for chunk in batch_event.chunk_changes([(None, c) for c in changes]):
+            task_event.change_resource_record_sets(route53[hosted_zone_id], hosted_zone_id, [c for _, c in chunk])
+    return report
+
+
+def handler(event, context):
+    """
+    reconciles the records, with an event of the form:
+
+        {"clusters": ["cluster-arn"], "hosted_zone_ids": ["Z1"], "dry_run": true, "delete_unknown": false}
+    """
+    report = reconcile(
+        event.get("clusters"),
+        event.get("hosted_zone_ids"),
+        event.get("dry_run", False),
+        delete_unknown=event.get("delete_unknown", False),
+    )
+    log.info("reconciliation %s", json.dumps(report))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="reconcile the DNS records with the running ECS tasks")
+    parser.add_argument("--cluster", dest="clusters", action="append", help="cluster to reconcile, default all")
+    parser.add_argument("--hosted-zone-id", dest="hosted_zone_ids", action="append", help="additional hosted zone")
+    parser.add_argument("--apply", action="store_true", help="apply the changes, default is a dry run")
+    parser.add_argument(
+        "--delete-unknown", action="store_true", help="delete the records of tasks not running, under any name"
+    )
+    args = parser.parse_args()
+    report = reconcile(args.clusters, args.hosted_zone_ids, dry_run=not args.apply, delete_unknown=args.delete_unknown)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
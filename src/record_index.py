@@ -0,0 +1,154 @@
+"""
+index of the resource record sets managed by the registrator.
+
+Records are keyed by hosted zone, name, type and set identifier. A missing record is
+looked up with a single targeted `list_resource_record_sets` call, positioned on the set
+identifier, instead of paging through all records with the same name. The index is kept
+up to date with the changes submitted from the warm Lambda container.
+
+As the index records what was last written, an UPSERT of an identical record set is
+skipped, and a record set is deleted without looking it up. Records may be changed outside
+of the registrator, so an UPSERT is only skipped if the entry was written less than `ttl`
+seconds ago. A stale entry used for a DELETE makes the change fail, after which the entry is
+invalidated. The records are stored in an
+in-process cache by default. A store with the same `get`, `put`, `discard` and `clear`
+methods can be plugged in, such as the `SQLiteStore`, which keeps the index in a file.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import List
+
+import metrics
+from cache import LRUCache
+
+log = logging.getLogger()
+
+
+class SQLiteStore(object):
+    """
+    a persistent store of the record index, in a SQLite database file. A `get` with `max_age`
+    treats entries written more than `max_age` seconds ago as missing.
+    """
+
+    def __init__(self, path: str):
+        # only imported when the index is persisted, to keep it out of the cold start.
+        import sqlite3
+
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            columns = [c[1] for c in self._connection.execute("PRAGMA table_info(records)")]
+            if columns and "updated" not in columns:
+                # written by a version without expiry
+                self._connection.execute("DROP TABLE records")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS records (key TEXT PRIMARY KEY, value TEXT NOT NULL, updated REAL NOT NULL)"
+            )
+
+    def get(self, key: tuple, default=None, max_age: float = None):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, updated FROM records WHERE key = ?", (json.dumps(key),)
+            ).fetchone()
+        if not row or (max_age is not None and time.time() - row[1] > max_age):
+            return default
+        return json.loads(row[0])
+
+    def put(self, key: tuple, value: dict):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO records (key, value, updated) VALUES (?, ?, ?)",
+                (json.dumps(key), json.dumps(value), time.time()),
+            )
+
+    def discard(self, key: tuple):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM records WHERE key = ?", (json.dumps(key),))
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM records")
+
+    def __contains__(self, key: tuple) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+
+class RecordIndex(object):
+    def __init__(self, maxsize: int = 4096, store=None, ttl: float = 300.0):
+        self.records = store if store is not None else LRUCache(maxsize)
+        self.ttl = ttl
+
+    def lookup(self, route53, hosted_zone_id: str, name: str, record_type: str, set_identifier: str) -> dict:
+        """
+        returns the resource record set, or None if it does not exist. Without
+        `set_identifier`, the record set is looked up as a simple record set.
+        """
+        key = (hosted_zone_id, name, record_type, set_identifier)
+        rr_set = self.records.get(key)
+        if rr_set is not None:
+            metrics.collector.increment("record_index_hits")
+            return rr_set
+
+        metrics.collector.increment("record_index_misses")
+        params = {"StartRecordIdentifier": set_identifier} if set_identifier else {}
+        response = route53.list_resource_record_sets(
+            HostedZoneId=hosted_zone_id,
+            StartRecordName=name,
+            StartRecordType=record_type,
+            MaxItems="1",
+            **params,
+        )
+        for rr_set in response["ResourceRecordSets"]:
+            if get_key(hosted_zone_id, rr_set) == key:
+                self.records.put(key, rr_set)
+                return rr_set
+        return None
+
+    def is_current(self, hosted_zone_id: str, rr_set: dict) -> bool:
+        """
+        returns True if `rr_set` is what was last written for its key, less than `ttl` seconds ago.
+        """
+        return self.records.get(get_key(hosted_zone_id, rr_set), max_age=self.ttl) == rr_set
+
+    def update(self, hosted_zone_id: str, changes: List[dict]):
+        """
+        applies the submitted `changes` to the index.
+        """
+        for change in changes:
+            key = get_key(hosted_zone_id, change["ResourceRecordSet"])
+            if change["Action"] == "DELETE":
+                self.records.discard(key)
+            else:
+                self.records.put(key, change["ResourceRecordSet"])
+
+    def invalidate(self, hosted_zone_id: str, changes: List[dict]):
+        """
+        removes the records of `changes` from the index, after the changes were rejected.
+        """
+        for change in changes:
+            self.records.discard(get_key(hosted_zone_id, change["ResourceRecordSet"]))
+
+
+def get_key(hosted_zone_id: str, rr_set: dict) -> tuple:
+    return hosted_zone_id, rr_set["Name"], rr_set["Type"], rr_set.get("SetIdentifier")
+
+
+def from_environment() -> RecordIndex:
+    """
+    returns the record index, stored in the SQLite database RECORD_INDEX_PATH if specified,
+    which skips unchanged record sets written less than RECORD_INDEX_TTL seconds ago.
+    """
+    path = os.getenv("RECORD_INDEX_PATH")
+    ttl = float(os.getenv("RECORD_INDEX_TTL", "300"))
+    return RecordIndex(int(os.getenv("RECORD_INDEX_SIZE", "4096")), SQLiteStore(path) if path else None, ttl)
+
+
+record_index = from_environment()
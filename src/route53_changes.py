@@ -0,0 +1,236 @@
+"""
+strategies for the completion of Route53 changes.
+
+Route53 reports a change as PENDING until it has propagated to all authoritative name
+servers. Waiting for INSYNC is not required for correctness, so the handler can choose to:
+
+- `none`:     fire and forget, return as soon as the change is submitted.
+- `wait`:     poll with exponential backoff and jitter, up to a maximum wait time.
+- `deferred`: hand the change id to a queue, to be verified by a later invocation.
+
+The propagation time of every change that is observed to complete is recorded.
+"""
+import abc
+import json
+import logging
+import os
+import random
+import time
+from collections import deque
+from datetime import datetime
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+import aws_clients
+
+log = logging.getLogger()
+
+
+def get_change_id(change: dict) -> str:
+    return change["ChangeInfo"]["Id"].split("/")[-1]
+
+
+def get_submitted_at(change: dict) -> float:
+    submitted_at = change["ChangeInfo"].get("SubmittedAt")
+    if isinstance(submitted_at, datetime):
+        return submitted_at.timestamp()
+    return time.time()
+
+
+class PropagationStats(object):
+    """
+    keeps the propagation time in seconds of the most recently completed changes.
+    """
+
+    def __init__(self, maxlen: int = 1000):
+        self.times = deque(maxlen=maxlen)
+
+    def record(self, change_id: str, submitted_at: float):
+        elapsed = max(0.0, time.time() - submitted_at)
+        self.times.append(elapsed)
+        log.info("change %s in sync after %.1fs", change_id, elapsed)
+        return elapsed
+
+    def stats(self) -> dict:
+        if not self.times:
+            return {"count": 0}
+        ordered = sorted(self.times)
+        return {
+            "count": len(ordered),
+            "p50": ordered[len(ordered) // 2],
+            "max": ordered[-1],
+        }
+
+
+propagation_stats = PropagationStats()
+
+
+class ChangeCompletion(abc.ABC):
+    @abc.abstractmethod
+    def __call__(self, route53, change: dict):
+        """
+        completes the submitted `change`, which never fails the invocation.
+        """
+
+    def verify_pending(self):
+        """
+        verifies changes deferred by previous invocations, if any.
+        """
+        pass
+
+
+class FireAndForget(ChangeCompletion):
+    def __call__(self, route53, change: dict):
+        log.info("change %s submitted, not waiting for completion", get_change_id(change))
+
+
+class BoundedWait(ChangeCompletion):
+    """
+    polls the change with exponential backoff and jitter, for at most `max_wait` seconds.
+    """
+
+    def __init__(self, max_wait: float = 120.0, initial_delay: float = 2.0, max_delay: float = 15.0):
+        self.max_wait = max_wait
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+
+    def get_delay(self, attempt: int) -> float:
+        """
+        returns the delay before poll `attempt`, with equal jitter.
+        """
+        delay = min(self.max_delay, self.initial_delay * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def __call__(self, route53, change: dict):
+        change_id = get_change_id(change)
+        submitted_at = get_submitted_at(change)
+        deadline = time.monotonic() + self.max_wait
+        attempt = 0
+        while change["ChangeInfo"]["Status"] != "INSYNC":
+            delay = self.get_delay(attempt)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                log.warning("change %s not in sync after %.0fs, no longer waiting", change_id, self.max_wait)
+                return
+            log.info(f"waiting for change {change_id} to complete")
+            time.sleep(min(delay, remaining))
+            change = route53.get_change(Id=change_id)
+            attempt += 1
+        propagation_stats.record(change_id, submitted_at)
+
+
+class InProcessChangeQueue(object):
+    """
+    keeps pending changes in the warm Lambda container, to be verified at the start of
+    the next invocation with the client which submitted them. Changes which are not found,
+    or not in sync after `max_age` seconds, are dropped. Verification never fails the
+    invocation.
+    """
+
+    def __init__(self, max_age: float = 900.0):
+        self.pending = {}
+        self.max_age = max_age
+
+    def put(self, change_id: str, submitted_at: float, route53=None):
+        self.pending[change_id] = (route53, submitted_at)
+
+    def verify(self):
+        for change_id, (route53, submitted_at) in list(self.pending.items()):
+            try:
+                response = (route53 if route53 else aws_clients.get_client("route53")).get_change(Id=change_id)
+                if response["ChangeInfo"]["Status"] == "INSYNC":
+                    propagation_stats.record(change_id, submitted_at)
+                    del self.pending[change_id]
+                    continue
+            except ClientError as e:
+                if e.response["Error"]["Code"] == "NoSuchChange":
+                    log.warning("change %s not found, no longer verifying", change_id)
+                    del self.pending[change_id]
+                    continue
+                log.warning("failed to verify change %s, %s", change_id, e)
+            if time.time() - submitted_at > self.max_age:
+                log.warning("change %s not in sync after %.0fs, no longer verifying", change_id, self.max_age)
+                del self.pending[change_id]
+
+
+class SQSChangeQueue(object):
+    """
+    sends pending changes to an SQS queue, to be verified by `handler`. As the change was
+    already accepted by Route53, a change which cannot be sent is not verified, instead of
+    failing the invocation.
+    """
+
+    def __init__(self, queue_url: str, delay_seconds: int = 30):
+        self.queue_url = queue_url
+        self.delay_seconds = delay_seconds
+
+    def put(self, change_id: str, submitted_at: float, route53=None):
+        try:
+            aws_clients.get_client("sqs").send_message(
+                QueueUrl=self.queue_url,
+                MessageBody=json.dumps({"ChangeId": change_id, "SubmittedAt": submitted_at}),
+                DelaySeconds=self.delay_seconds,
+            )
+        except (BotoCoreError, ClientError) as e:
+            log.error("failed to queue change %s for verification, not verifying, %s", change_id, e)
+
+    def verify(self):
+        # verification is done by the handler of the queue.
+        pass
+
+
+class DeferredVerification(ChangeCompletion):
+    def __init__(self, queue):
+        self.queue = queue
+
+    def verify_pending(self):
+        self.queue.verify()
+
+    def __call__(self, route53, change: dict):
+        change_id = get_change_id(change)
+        if change["ChangeInfo"]["Status"] == "INSYNC":
+            propagation_stats.record(change_id, get_submitted_at(change))
+        else:
+            log.info("change %s submitted, deferring verification", change_id)
+            self.queue.put(change_id, get_submitted_at(change), route53)
+
+
+def from_environment():
+    """
+    returns the change completion strategy configured by ROUTE53_CHANGE_COMPLETION.
+    """
+    strategy = os.getenv("ROUTE53_CHANGE_COMPLETION", "wait")
+    if strategy == "none":
+        return FireAndForget()
+    if strategy == "deferred":
+        queue_url = os.getenv("ROUTE53_CHANGE_QUEUE_URL")
+        return DeferredVerification(SQSChangeQueue(queue_url) if queue_url else InProcessChangeQueue())
+    if strategy != "wait":
+        log.error('unsupported ROUTE53_CHANGE_COMPLETION "%s", using "wait"', strategy)
+    return BoundedWait(max_wait=float(os.getenv("ROUTE53_CHANGE_MAX_WAIT", "120")))
+
+
+def handler(event, context):
+    """
+    verifies the pending changes sent by `SQSChangeQueue`. Changes which are not yet in
+    sync, or could not be verified, are reported as batch item failures, so that SQS will
+    redeliver them. Changes which are not found are dropped.
+    """
+    route53 = aws_clients.get_client("route53")
+    failures = []
+    for record in event.get("Records", []):
+        pending = json.loads(record["body"])
+        try:
+            response = route53.get_change(Id=pending["ChangeId"])
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchChange":
+                log.warning("change %s not found, no longer verifying", pending["ChangeId"])
+            else:
+                log.warning("failed to verify change %s, %s", pending["ChangeId"], e)
+                failures.append({"itemIdentifier": record["messageId"]})
+            continue
+        if response["ChangeInfo"]["Status"] == "INSYNC":
+            propagation_stats.record(pending["ChangeId"], pending["SubmittedAt"])
+        else:
+            failures.append({"itemIdentifier": record["messageId"]})
+    return {"batchItemFailures": failures}
@@ -0,0 +1,353 @@
+"""
+long-running service which registers the tasks of ECS task state change events read from a
+queue, as alternative to the Lambda handlers.
+
+The events are read from an SQS queue subscribed to the EventBridge rule, or from a file
+with one JSON event per line. Hundreds of events are processed concurrently, while the
+events of a single task are processed in order and the change batches per hosted zone are
+bounded. The changes are built by the same `DNSRegistrator` as the handlers. The completion
+of the Route53 changes is tracked asynchronously, without holding up the next events.
+
+On SIGTERM or SIGINT, the service stops reading, finishes the events in flight and waits
+for the submitted changes to complete, for at most ROUTE53_CHANGE_MAX_WAIT seconds.
+
+usage: python src/service.py (--queue-url URL | --file FILE) [--concurrency N]
+"""
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+import aws_clients
+import event_filter
+import metrics
+import route53_changes
+import task_event
+from batch_event import get_event_order
+from cache import LRUCache
+
+log = logging.getLogger()
+
+
+class FileSource(object):
+    """
+    reads the events from a file with one JSON event per line, as stand-in for a queue.
+    """
+
+    def __init__(self, path: str, batch_size: int = 10):
+        self.path = path
+        self.batch_size = batch_size
+        self.exhausted = False
+        self._file = None
+        self._line = 0
+
+    async def receive(self) -> List[Tuple[str, dict]]:
+        if self._file is None:
+            self._file = open(self.path)
+        items = []
+        while len(items) < self.batch_size:
+            line = self._file.readline()
+            if not line:
+                self.exhausted = True
+                self._file.close()
+                break
+            self._line += 1
+            if not line.strip():
+                continue
+            try:
+                items.append((str(self._line), json.loads(line)))
+            except ValueError as e:
+                log.error("skipping invalid event on line %d, %s", self._line, e)
+        return items
+
+    async def acknowledge(self, item_id: str):
+        pass
+
+    async def flush(self):
+        pass
+
+
+class SQSSource(object):
+    """
+    receives the events from an SQS queue with long polling. Processed messages are deleted
+    in batches.
+    """
+
+    def __init__(self, queue_url: str, clients=None, executor=None, wait_time: int = 20, batch_size: int = 10):
+        self.queue_url = queue_url
+        self.clients = clients if clients else aws_clients.clients
+        self.executor = executor
+        self.wait_time = wait_time
+        self.batch_size = batch_size
+        self.exhausted = False
+        self.processed = []
+
+    async def call(self, method, **kwargs):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, functools.partial(method, **kwargs))
+
+    async def receive(self) -> List[Tuple[str, dict]]:
+        response = await self.call(
+            self.clients.get("sqs").receive_message,
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=self.batch_size,
+            WaitTimeSeconds=self.wait_time,
+        )
+        items = []
+        for message in response.get("Messages", []):
+            try:
+                items.append((message["ReceiptHandle"], json.loads(message["Body"])))
+            except ValueError as e:
+                log.error("deleting invalid message %s, %s", message["MessageId"], e)
+                await self.acknowledge(message["ReceiptHandle"])
+        return items
+
+    async def acknowledge(self, item_id: str):
+        self.processed.append(item_id)
+        if len(self.processed) >= 10:
+            await self.flush()
+
+    async def flush(self):
+        while self.processed:
+            batch, self.processed = self.processed[:10], self.processed[10:]
+            response = await self.call(
+                self.clients.get("sqs").delete_message_batch,
+                QueueUrl=self.queue_url,
+                Entries=[{"Id": str(i), "ReceiptHandle": handle} for i, handle in enumerate(batch)],
+            )
+            for failure in response.get("Failed", []):
+                log.error("failed to delete message, %s", failure.get("Message"))
+
+
+class Service(object):
+    """
+    processes the events of `source` with at most `concurrency` events in flight, and at
+    most `zone_concurrency` change batches in flight per hosted zone.
+    """
+
+    def __init__(
+        self,
+        source,
+        clients: aws_clients.ClientProvider = None,
+        concurrency: int = 100,
+        zone_concurrency: int = 4,
+        max_wait: float = 120.0,
+        executor: ThreadPoolExecutor = None,
+        metrics_interval: float = 60.0,
+    ):
+        self.source = source
+        self.clients = clients if clients else aws_clients.clients
+        self.concurrency = concurrency
+        self.zone_concurrency = zone_concurrency
+        self.completion = route53_changes.BoundedWait(max_wait)
+        self.executor = executor if executor else ThreadPoolExecutor(max_workers=min(concurrency, 32))
+        self.metrics_interval = metrics_interval
+        self.processed = 0
+        self.failed = 0
+        self.in_flight = set()
+        self.tracking = set()
+        self.zones = {}
+        self.tasks = {}
+        self.latest = LRUCache(4096)
+        self.stopping = None
+        self._stop_requested = False
+
+    def stop(self):
+        """
+        stops reading events, after which the events in flight are finished.
+        """
+        log.info("stopping, draining %d events in flight", len(self.in_flight))
+        self._stop_requested = True
+        if self.stopping:
+            self.stopping.set()
+
+    async def call(self, method, *args, **kwargs):
+        """
+        runs the blocking `method` on the executor.
+        """
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, functools.partial(method, *args, **kwargs)
+        )
+
+    async def run(self):
+        self.stopping = asyncio.Event()
+        if self._stop_requested:
+            self.stopping.set()
+        self.slots = asyncio.Semaphore(self.concurrency)
+        reporter = asyncio.ensure_future(self.report_metrics())
+        try:
+            while not self.stopping.is_set() and not self.source.exhausted:
+                items = await self.receive()
+                for item_id, event in items:
+                    await self.slots.acquire()
+                    self.start(self.in_flight, self.process(item_id, event))
+                await self.source.flush()
+            await self.drain()
+        finally:
+            reporter.cancel()
+            metrics.collector.flush()
+        log.info("stopped after processing %d events, %d failed", self.processed, self.failed)
+
+    async def receive(self) -> List[Tuple[str, dict]]:
+        """
+        returns the next events of the source, or none if the service is stopped first.
+        Events received after the stop are not acknowledged, and are delivered again.
+        """
+        receiving = asyncio.ensure_future(self.source.receive())
+        stopping = asyncio.ensure_future(self.stopping.wait())
+        await asyncio.wait([receiving, stopping], return_when=asyncio.FIRST_COMPLETED)
+        stopping.cancel()
+        if not receiving.done():
+            receiving.cancel()
+            return []
+        return receiving.result()
+
+    async def drain(self):
+        if self.in_flight:
+            await asyncio.wait(list(self.in_flight))
+        await self.source.flush()
+        if self.tracking:
+            log.info("waiting for %d changes to complete", len(self.tracking))
+            _, pending = await asyncio.wait(list(self.tracking), timeout=self.completion.max_wait)
+            for future in pending:
+                future.cancel()
+
+    @staticmethod
+    def start(futures: set, coroutine):
+        future = asyncio.ensure_future(coroutine)
+        futures.add(future)
+        future.add_done_callback(futures.discard)
+        return future
+
+    async def process(self, item_id: str, event: dict):
+        try:
+            if not task_event.is_task_state_change(event):
+                log.error("unsupported event, %s", event.get("detail-type"))
+            elif event_filter.classify(event) == event_filter.IRRELEVANT:
+                metrics.collector.increment("skipped_events")
+            else:
+                await self.process_in_order(event)
+            await self.source.acknowledge(item_id)
+            self.processed += 1
+        except Exception as e:
+            log.exception("failed to process event %s, %s", item_id, e)
+            metrics.collector.increment("failed_events")
+            self.failed += 1
+        finally:
+            self.slots.release()
+
+    async def process_in_order(self, event: dict):
+        """
+        handles the event after the preceding events of the same task. Events older than
+        the last event handled for the task are skipped.
+        """
+        task_arn = event["detail"]["taskArn"]
+        previous = self.tasks.get(task_arn)
+        current = asyncio.get_event_loop().create_future()
+        self.tasks[task_arn] = current
+        try:
+            if previous:
+                await previous
+            latest = self.latest.get(task_arn)
+            if latest is not None and get_event_order(event) < latest:
+                metrics.collector.increment("superseded_events")
+                return
+            self.latest.put(task_arn, get_event_order(event))
+            await self.handle(event)
+        finally:
+            current.set_result(None)
+            if self.tasks.get(task_arn) is current:
+                del self.tasks[task_arn]
+
+    async def handle(self, event: dict):
+        detail = event["detail"]
+        registrator = task_event.create_registrator(event, self.clients)
+        changes = await self.call(registrator.get_changes, detail["desiredStatus"], detail["lastStatus"])
+        if not changes:
+            metrics.collector.increment("skipped_events")
+            return
+        await asyncio.gather(
+            *[
+                self.change(z, c, registrator.get_hosted_zone_role(z))
+                for z, c in task_event.group_changes(changes).items()
+            ]
+        )
+
+    async def change(self, hosted_zone_id: str, changes: List[dict], role_arn: str = None):
+        """
+        submits the changes to the hosted zone, with the role of the labels of the task
+        definition if any, and tracks the completion in the background.
+        """
+        semaphore = self.zones.get(hosted_zone_id)
+        if semaphore is None:
+            semaphore = self.zones.setdefault(hosted_zone_id, asyncio.Semaphore(self.zone_concurrency))
+        route53 = task_event.get_route53(self.clients, hosted_zone_id, role_arn)
+        async with semaphore:
+            response = await self.call(task_event.submit_change_batch, route53, hosted_zone_id, changes)
+        if response:
+            self.start(self.tracking, self.track(route53, response))
+
+    async def track(self, route53, change: dict):
+        """
+        polls the change until it is in sync, for at most the maximum wait time.
+        """
+        change_id = route53_changes.get_change_id(change)
+        submitted_at = route53_changes.get_submitted_at(change)
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.completion.max_wait
+        attempt = 0
+        try:
+            while change["ChangeInfo"]["Status"] != "INSYNC":
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    log.warning("change %s not in sync after %.0fs", change_id, self.completion.max_wait)
+                    return
+                await asyncio.sleep(min(self.completion.get_delay(attempt), remaining))
+                change = await self.call(route53.get_change, Id=change_id)
+                attempt += 1
+            elapsed = route53_changes.propagation_stats.record(change_id, submitted_at)
+            metrics.collector.record("route53_propagation", elapsed * 1000)
+        except Exception as e:
+            log.error("failed to track change %s, %s", change_id, e)
+
+    async def report_metrics(self):
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            metrics.collector.flush()
+
+
+async def serve(service: Service):
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, service.stop)
+    await service.run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="register ECS tasks in Route53 from a queue of task state change events")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--queue-url", default=os.getenv("SERVICE_QUEUE_URL"), help="SQS queue with the events")
+    source.add_argument("--file", help="file with one JSON event per line")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("SERVICE_CONCURRENCY", "100")))
+    parser.add_argument("--zone-concurrency", type=int, default=task_event.zone_concurrency)
+    args = parser.parse_args()
+    if not args.queue_url and not args.file:
+        parser.error("either --queue-url or --file is required")
+
+    service_source = SQSSource(args.queue_url) if args.queue_url else FileSource(args.file)
+    service = Service(
+        service_source,
+        concurrency=args.concurrency,
+        zone_concurrency=args.zone_concurrency,
+        max_wait=float(os.getenv("ROUTE53_CHANGE_MAX_WAIT", "120")),
+    )
+    asyncio.run(serve(service))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -1,98 +1,372 @@
+import contextvars
 import logging
 import os
+import random
+import re
+import sys
 import time
-from typing import NamedTuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, List, NamedTuple, Tuple
 
-import boto3
 from botocore.exceptions import ClientError
 
+import aws_clients
+import container_instances
+import event_filter
+import metrics
+import profiling
+import route53_changes
+from cache import LRUCache
+from record_index import record_index
+
 
 log = logging.getLogger()
 log.setLevel(os.getenv("LOG_LEVEL", logging.INFO))
 
+# parsed DNS entries per task definition revision arn. Revisions are immutable, so the
+# entries can be kept for the lifetime of the container. Unlabelled task definitions
+# are cached as an empty tuple.
+task_definition_cache = LRUCache(int(os.getenv("TASK_DEFINITION_CACHE_SIZE", "1024")))
+
+# build the task from the event payload instead of calling ecs:DescribeTasks.
+use_event_payload = os.getenv("USE_EVENT_PAYLOAD", "true") == "true"
+
+change_completion = route53_changes.from_environment()
+
+# maximum number of hosted zones changed concurrently for a single task.
+zone_concurrency = int(os.getenv("ZONE_CONCURRENCY", "4"))
+
+# maximum number of ip addresses in an aggregated record set.
+aggregate_max_values = int(os.getenv("AGGREGATE_MAX_VALUES", "400"))
+
+# maximum number of attempts to change aggregated record sets, which are retried when they
+# were changed concurrently.
+AGGREGATE_ATTEMPTS = 5
+
+# actions on an aggregated record set, resolved into Route53 changes on submission.
+ADD = "ADD"
+REMOVE = "REMOVE"
+
+# maximum number of ResourceRecord elements in a single change batch. The values of an
+# UPSERT count twice.
+MAX_CHANGE_BATCH_SIZE = 1000
+
+# the InvalidChangeBatch errors of a DELETE or CREATE of a record set which was changed
+# concurrently.
+CONFLICT_PATTERN = re.compile(r"but (it was not found|the values provided do not match|it already exists)")
+
+# executes the task definition and task lookups of an event concurrently.
+lookup_executor = ThreadPoolExecutor(max_workers=int(os.getenv("AWS_MAX_POOL_CONNECTIONS", "10")))
+
+
+def parse_role_arns(value: str) -> Dict[str, str]:
+    """
+    parses a comma separated list of key=role-arn pairs.
+    """
+    result = {}
+    for pair in filter(None, map(str.strip, value.split(","))):
+        key, _, role_arn = pair.partition("=")
+        if role_arn:
+            result[key.strip()] = role_arn.strip()
+    return result
+
+
+# roles assumed to change the hosted zones of other accounts, by hosted zone id. These take
+# precedence over the DNSHostedZoneRoleArn labels of the task definitions.
+hosted_zone_roles = parse_role_arns(os.getenv("HOSTED_ZONE_ROLE_ARNS", ""))
+
+# roles assumed to describe the tasks of clusters in other accounts, by account id.
+account_roles = parse_role_arns(os.getenv("ACCOUNT_ROLE_ARNS", ""))
+
+
+def intern(value: str) -> str:
+    """
+    returns the shared copy of a string which repeats across tasks, such as a cluster arn.
+    """
+    return sys.intern(value) if value else value
+
+
+def get_route53(clients: aws_clients.ClientProvider, hosted_zone_id: str, role_arn: str = None):
+    """
+    returns the route53 client for the hosted zone, with the role configured for it or else
+    `role_arn`, the role of the labels of the task definition.
+    """
+    return clients.get("route53", role_arn=hosted_zone_roles.get(hosted_zone_id, role_arn))
+
+
+def get_cluster_client(clients: aws_clients.ClientProvider, service_name: str, cluster_arn: str):
+    """
+    returns the client for the cluster, in the region of the cluster with the role of its account.
+    """
+    return clients.get(service_name, get_arn_region(cluster_arn), account_roles.get(get_arn_account(cluster_arn)))
+
+
+def get_arn_region(arn: str) -> str:
+    parts = arn.split(":") if arn else []
+    return intern(parts[3]) if len(parts) > 4 and parts[3] else None
+
+
+def get_arn_account(arn: str) -> str:
+    parts = arn.split(":") if arn else []
+    return parts[4] if len(parts) > 4 and parts[4] else None
+
 
 class DNSRegistrator(object):
-    def __init__(self, task_arn: str, cluster_arn: str, task_definition_arn):
+    __slots__ = (
+        "task_arn",
+        "cluster_arn",
+        "task_definition_arn",
+        "task",
+        "task_from_event",
+        "network_interfaces",
+        "dns_entries",
+        "dns_entry",
+        "clients",
+        "region",
+        "role_arn",
+        "timings",
+    )
+
+    def __init__(
+        self,
+        task_arn: str,
+        cluster_arn: str,
+        task_definition_arn,
+        clients: aws_clients.ClientProvider = None,
+        task: dict = None,
+    ):
         self.task_arn = task_arn
-        self.task_id = task_arn.split("/")[-1]
-        self.cluster_arn = cluster_arn
-        self.task_definition_arn = task_definition_arn
-        self.task = {}
-        self.task_definition = {}
-        self.network_interfaces = []
-        self.dns_entries = []
+        self.cluster_arn = intern(cluster_arn)
+        self.task_definition_arn = intern(task_definition_arn)
+        self.task = get_task_view(task)
+        self.task_from_event = bool(task)
+        self.network_interfaces: List[EniView] = ()
+        self.dns_entries = ()
         self.dns_entry: DNSEntry = None
-        self.ecs = boto3.client("ecs")
-        self.ec2 = boto3.client("ec2")
-        self.route53 = boto3.client("route53")
+        self.clients = clients if clients else aws_clients.clients
+        self.region = get_arn_region(cluster_arn)
+        self.role_arn = account_roles.get(get_arn_account(cluster_arn))
+        self.timings = {}
 
-    def get_network_interfaces(self):
-        attachments = list(
-            filter(
-                lambda a: a["type"] == "ElasticNetworkInterface"
-                and a["status"] == "ATTACHED",
-                self.task.get("attachments"),
+    @property
+    def task_id(self) -> str:
+        return self.task_arn.split("/")[-1]
+
+    @contextmanager
+    def timed(self, stage: str):
+        """
+        adds the elapsed time of the block to the timing of `stage`, in seconds, and
+        records it as metric.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[stage] = self.timings.get(stage, 0.0) + elapsed
+            metrics.collector.record(stage, elapsed * 1000)
+
+    @property
+    def ecs(self):
+        return self.clients.get("ecs", self.region, self.role_arn)
+
+    @property
+    def ec2(self):
+        return self.clients.get("ec2", self.region, self.role_arn)
+
+    @property
+    def route53(self):
+        return self.get_route53(self.dns_entry.hosted_zone_id if self.dns_entry else None)
+
+    def get_route53(self, hosted_zone_id: str):
+        return get_route53(self.clients, hosted_zone_id, self.get_hosted_zone_role(hosted_zone_id))
+
+    def get_hosted_zone_role(self, hosted_zone_id: str) -> str:
+        """
+        returns the role of the hosted zone in the labels of the task definition, if any.
+        """
+        return next((e.role_arn for e in self.dns_entries if e.hosted_zone_id == hosted_zone_id and e.role_arn), None)
+
+    @property
+    def container_instance_arn(self) -> str:
+        return self.task.container_instance_arn if self.task else None
+
+    def uses_host_network(self) -> bool:
+        """
+        returns True if the task runs in bridge or host network mode, on the network of its
+        container instance.
+        """
+        return bool(self.container_instance_arn) and not self.task.attachments
+
+    def get_host(self) -> container_instances.HostAddress:
+        with self.timed("container_instance"):
+            return container_instances.container_instance_index.get(
+                self.ecs, self.ec2, self.cluster_arn, self.container_instance_arn
             )
-        )
-        self.network_interfaces = []
-        for attachment in attachments:
-            attachment = attachments[0]
-            eni_id = next(map(lambda d: d["value"], filter(lambda d: d['name'] == 'networkInterfaceId', attachment["details"])), 'none')
-            try:
-                response = self.ec2.describe_network_interfaces(NetworkInterfaceIds=[eni_id])
-                self.network_interfaces.append(response["NetworkInterfaces"][0])
-            except ClientError as e:
-                if e.response['Error']['Code'] != 'InvalidNetworkInterfaceID.NotFound':
-                    raise
-                else:
-                    log.info(
-                        'ignoring network interface %s', eni_id
-                    )
+
+    def get_host_ip_addresses(self, public_ip) -> List[str]:
+        host = self.get_host()
+        ip_address = (host.public_ip if public_ip else host.private_ip) if host else None
+        return [ip_address] if ip_address else []
+
+    def is_host_shared(self, dns_entry: "DNSEntry") -> bool:
+        """
+        returns True if another task running on the container instance registers the host
+        address in the aggregated record of `dns_entry`, or if that cannot be determined.
+        """
+        try:
+            with self.timed("host_tasks"):
+                for page in self.ecs.get_paginator("list_tasks").paginate(
+                    cluster=self.cluster_arn, containerInstance=self.container_instance_arn, desiredStatus="RUNNING"
+                ):
+                    task_arns = [a for a in page["taskArns"] if a != self.task_arn]
+                    if not task_arns:
+                        continue
+                    for task in self.ecs.describe_tasks(cluster=self.cluster_arn, tasks=task_arns)["tasks"]:
+                        other = DNSRegistrator(task["taskArn"], self.cluster_arn, task["taskDefinitionArn"], self.clients)
+                        if not other.get_task_definition():
+                            return True
+                        if any(
+                            e.aggregate
+                            and e.hosted_zone_id == dns_entry.hosted_zone_id
+                            and e.name == dns_entry.name
+                            and e.register_public_ip == dns_entry.register_public_ip
+                            for e in other.dns_entries
+                        ):
+                            return True
+        except ClientError as e:
+            log.error('failed to list the tasks on container instance "%s", %s', self.container_instance_arn, e)
+            return True
+        return False
+
+    def get_eni_attachments(self) -> List["EniView"]:
+        return [a for a in self.task.attachments if a.status == "ATTACHED"] if self.task else []
+
+    def get_network_interfaces(self):
+        eni_ids = [a.eni_id for a in self.get_eni_attachments() if a.eni_id]
+        with self.timed("network_interfaces"):
+            network_interfaces = describe_network_interfaces(self.ec2, eni_ids)
+        for eni_id in eni_ids:
+            if eni_id not in network_interfaces:
+                log.info('ignoring network interface %s', eni_id)
+        self.network_interfaces = [network_interfaces[i] for i in eni_ids if i in network_interfaces]
+
+    def get_attachment_ip_addresses(self):
+        """
+        returns the private ip addresses of the ENI attachments, as reported by ECS.
+        """
+        return [a.private_ip for a in self.get_eni_attachments() if a.private_ip]
+
+    def resolve_ip_addresses(self, public_ip):
+        """
+        returns the ip addresses to register. Private ip addresses are read from the task
+        attachments; the network interfaces are only described for public ip addresses or
+        when the attachments are incomplete. Tasks in bridge or host network mode get the
+        ip address of their container instance.
+        """
+        if self.uses_host_network():
+            return self.get_host_ip_addresses(public_ip)
+
+        if self.task_from_event and not self.get_eni_attachments():
+            log.info('no network attachments in event for task "%s"', self.task_arn)
+            self.get_task()
+
+        if not public_ip:
+            ip_addresses = self.get_attachment_ip_addresses()
+            if ip_addresses:
+                return ip_addresses
+
+        self.get_network_interfaces()
+        return self.get_ip_addresses(public_ip)
+
+    def get_released_ip_addresses(self, public_ip) -> List[str]:
+        """
+        returns the ip addresses of a stopping task. Its attachments may already be detached,
+        so all network attachments are considered. The public ip address can only be found
+        as long as the network interface exists.
+        """
+        if self.uses_host_network():
+            return self.get_host_ip_addresses(public_ip)
+        attachments = self.task.attachments if self.task else ()
+        if not public_ip:
+            return [a.private_ip for a in attachments if a.private_ip]
+        with self.timed("network_interfaces"):
+            network_interfaces = describe_network_interfaces(self.ec2, [a.eni_id for a in attachments if a.eni_id])
+        return [n.public_ip for n in network_interfaces.values() if n.public_ip]
 
     def get_ip_addresses(self, public_ip):
         result = []
         for network_interface in self.network_interfaces:
-            if public_ip:
-                result.append(network_interface.get("Association").get("PublicIp"))
-            else:
-                result.append(network_interface.get("PrivateIpAddress"))
+            result.append(network_interface.public_ip if public_ip else network_interface.private_ip)
         return result
 
-    def get_task_definition(self):
+    def get_task_definition(self) -> bool:
+        """
+        reads the DNS entries of the task definition. Returns False if the task definition
+        could not be described, in which case the entries of the task are unknown.
+        """
+        with self.timed("task_definition"):
+            return self._get_task_definition()
+
+    def _get_task_definition(self) -> bool:
+        dns_entries = task_definition_cache.get(self.task_definition_arn)
+        if dns_entries is not None:
+            metrics.collector.increment("task_definition_cache_hits")
+            self.dns_entries = dns_entries
+            self.dns_entry = self.dns_entries[0] if self.dns_entries else None
+            return True
+
+        metrics.collector.increment("task_definition_cache_misses")
         try:
             response = self.ecs.describe_task_definition(
                 taskDefinition=self.task_definition_arn
             )
-            self.task_definition = response["taskDefinition"]
-            self.get_dns_entries()
+            self.get_dns_entries(response["taskDefinition"])
+            task_definition_cache.put(self.task_definition_arn, self.dns_entries)
+            return True
         except ClientError as e:
             log.error(
                 'no task definition found with id "%s, %s', self.task_definition_arn, e
             )
-            self.task_definition = {}
+            return False
 
     def get_task(self):
+        with self.timed("task"):
+            self._get_task()
+
+    def _get_task(self):
+        self.task_from_event = False
         try:
             response = self.ecs.describe_tasks(
                 cluster=self.cluster_arn, tasks=[self.task_arn]
             )
-            self.task = response["tasks"][0]
-        except ClientError as e:
+            self.task = get_task_view(response["tasks"][0])
+        except (ClientError, IndexError) as e:
             log.error(
                 'no task found with id "%s" on cluster "%s", %s',
                 self.task_arn,
                 self.cluster_arn,
                 e,
             )
-            self.task = {}
+            self.task = None
 
-    def get_dns_entries(self):
-        self.dns_entries = []
-        for c in self.task_definition.get("containerDefinitions", {}):
-            labels = c.get("dockerLabels")
+    def get_dns_entries(self, task_definition: dict):
+        """
+        parses the DNS entries from the container labels of the task definition, which is
+        not kept.
+        """
+        dns_entries = []
+        for c in task_definition.get("containerDefinitions", {}):
+            labels = c.get("dockerLabels", {})
             hosted_zone_id = labels.get("DNSHostedZoneId")
             dns_name = labels.get("DNSName")
             public_ip = "true" == labels.get("DNSRegisterPublicIp", "true")
+            aggregate = "aggregate" == labels.get("DNSRecordMode", "weighted")
+            role_arn = labels.get("DNSHostedZoneRoleArn")
+            srv_name = labels.get("DNSSrvName")
+            srv_port = labels.get("DNSSrvContainerPort")
             if not hosted_zone_id:
                 continue
             if not dns_name:
@@ -102,115 +376,529 @@ class DNSRegistrator(object):
                 )
                 continue
 
-            self.dns_entries.append(
-                DNSEntry(hosted_zone_id, '{}.'.format(dns_name.rstrip('.')), public_ip)
+            dns_entry = DNSEntry(
+                hosted_zone_id,
+                '{}.'.format(dns_name.rstrip('.')),
+                public_ip,
+                aggregate,
+                '{}.'.format(srv_name.rstrip('.')) if srv_name else None,
+                c.get("name") if srv_name else None,
+                int(srv_port) if srv_port and srv_port.isdigit() else None,
+                role_arn,
             )
+            if any(e.hosted_zone_id == dns_entry.hosted_zone_id and e.name == dns_entry.name for e in dns_entries):
+                # a single record per name and task.
+                continue
+            dns_entries.append(dns_entry)
 
+        self.dns_entries = tuple(dns_entries)
         self.dns_entry = self.dns_entries[0] if self.dns_entries else None
 
-    def register_dns_entry(self, ip_address):
-        log.info('registering "%s" for task "%s"', self.dns_entry.name, self.task_arn)
-        response = self.route53.change_resource_record_sets(
-            HostedZoneId=self.dns_entry.hosted_zone_id,
-            ChangeBatch={
-                "Comment": "registration of {by ecs-dns-registrator",
-                "Changes": [
-                    {
-                        "Action": "UPSERT",
-                        "ResourceRecordSet": {
-                            "Name": self.dns_entry.name,
-                            "Type": "A",
-                            "SetIdentifier": self.task_id,
-                            "Weight": 100,
-                            "TTL": 30,
-                            "ResourceRecords": [{"Value": ip_address}],
-                        },
-                    }
-                ],
+    def get_registration_change(self, ip_address, dns_entry: "DNSEntry" = None) -> dict:
+        dns_entry = dns_entry if dns_entry else self.dns_entry
+        return {
+            "Action": "UPSERT",
+            "ResourceRecordSet": {
+                "Name": dns_entry.name,
+                "Type": "A",
+                "SetIdentifier": self.task_id,
+                "Weight": 100,
+                "TTL": 30,
+                "ResourceRecords": [{"Value": ip_address}],
             },
-        )
-        wait_for_route53_change_completion(self.route53, response)
+        }
 
-    def get_resource_record_set(self):
-        for page in self.route53.get_paginator('list_resource_record_sets').paginate(
-            HostedZoneId=self.dns_entry.hosted_zone_id,
-            StartRecordType='A',
-            StartRecordName=self.dns_entry.name
-        ):
-            for rr_set in page['ResourceRecordSets']:
-                if rr_set['Name'] == self.dns_entry.name and rr_set.get('SetIdentifier') == self.task_id:
-                    return rr_set
+    def get_aggregate_change(self, action: str, ip_address: str, dns_entry: "DNSEntry" = None) -> dict:
+        """
+        returns the addition or removal of the ip address to the aggregated record set of
+        the entry, which is resolved against the current record set on submission.
+        """
+        dns_entry = dns_entry if dns_entry else self.dns_entry
+        return {
+            "Action": action,
+            "ResourceRecordSet": {
+                "Name": dns_entry.name,
+                "Type": "A",
+                "TTL": 30,
+                "ResourceRecords": [{"Value": ip_address}],
+            },
+        }
+
+    def get_network_binding(self, dns_entry: "DNSEntry") -> "NetworkBinding":
+        """
+        returns the network binding of the container of the entry, on the port of the label
+        DNSSrvContainerPort or else the first.
+        """
+        for binding in self.task.network_bindings if self.task else ():
+            if binding.container_name != dns_entry.container_name:
+                continue
+            if dns_entry.srv_port is None or binding.container_port == dns_entry.srv_port:
+                return binding
         return None
 
+    def get_srv_registration_change(self, dns_entry: "DNSEntry") -> dict:
+        """
+        returns the weighted SRV record of the host port of the container, pointing to the
+        DNS name of its container instance.
+        """
+        binding = self.get_network_binding(dns_entry)
+        if not binding or not binding.host_port:
+            log.error('no network binding found to register "%s" for task %s', dns_entry.srv_name, self.task_arn)
+            return None
+        host = self.get_host() if self.uses_host_network() else None
+        target = (host.public_dns_name if dns_entry.register_public_ip else host.private_dns_name) if host else None
+        if not target:
+            log.error('no host name found to register "%s" for task %s', dns_entry.srv_name, self.task_arn)
+            return None
+        return {
+            "Action": "UPSERT",
+            "ResourceRecordSet": {
+                "Name": dns_entry.srv_name,
+                "Type": "SRV",
+                "SetIdentifier": self.task_id,
+                "Weight": 100,
+                "TTL": 30,
+                "ResourceRecords": [{"Value": "1 1 {} {}.".format(binding.host_port, target.rstrip("."))}],
+            },
+        }
+
+    def get_srv_deregistration_change(self, dns_entry: "DNSEntry") -> dict:
+        route53 = self.get_route53(dns_entry.hosted_zone_id)
+        rr_set = record_index.lookup(route53, dns_entry.hosted_zone_id, dns_entry.srv_name, "SRV", self.task_id)
+        return {"Action": "DELETE", "ResourceRecordSet": rr_set} if rr_set else None
+
+    def get_deregistration_change(self, dns_entry: "DNSEntry" = None) -> dict:
+        rr_set = self.get_resource_record_set(dns_entry)
+        return {"Action": "DELETE", "ResourceRecordSet": rr_set} if rr_set else None
+
+    def change_resource_record_sets(self, hosted_zone_id: str, changes: List[dict]):
+        change_resource_record_sets(self.get_route53(hosted_zone_id), hosted_zone_id, changes)
+
+    def register_dns_entry(self, ip_address):
+        log.info('registering "%s" for task "%s"', self.dns_entry.name, self.task_arn)
+        self.change_resource_record_sets(self.dns_entry.hosted_zone_id, [self.get_registration_change(ip_address)])
+
+    def get_resource_record_set(self, dns_entry: "DNSEntry" = None):
+        dns_entry = dns_entry if dns_entry else self.dns_entry
+        route53 = self.get_route53(dns_entry.hosted_zone_id)
+        return record_index.lookup(route53, dns_entry.hosted_zone_id, dns_entry.name, "A", self.task_id)
 
     def deregister_dns_entry(self):
         log.info('deregistering "%s" for task "%s"', self.dns_entry.name, self.task_id)
-        rr_set = self.get_resource_record_set()
-        if rr_set:
-            response = self.route53.change_resource_record_sets(
-                HostedZoneId=self.dns_entry.hosted_zone_id,
-                ChangeBatch={
-                    "Comment": "deregistration by ecs-dns-registrator",
-                    "Changes": [
-                        {
-                            "Action": "DELETE",
-                            "ResourceRecordSet": self.get_resource_record_set()
-                        }
-                    ],
-                },
-            )
-            wait_for_route53_change_completion(self.route53, response)
+        change = self.get_deregistration_change()
+        if change:
+            self.change_resource_record_sets(self.dns_entry.hosted_zone_id, [change])
 
         log.info('DNS record name "%s" for set identifier "%s" deregistered', self.dns_entry.name, self.task_id)
 
-    def handle(self, desired_state, last_state):
-        self.get_task_definition()
+    def get_changes(self, desired_state, last_state) -> List[Tuple[str, dict]]:
+        """
+        returns the Route53 changes required for the task state change, as a list of
+        hosted zone id and change.
+        """
+        transition = event_filter.event_filter.get_transition(desired_state, last_state)
+        if transition == event_filter.IRRELEVANT:
+            return []
+        registering = transition == event_filter.REGISTER
+
+        if self.needs_task(registering) and self.task_definition_arn not in task_definition_cache:
+            # look up the task definition and the task concurrently
+            task = lookup_executor.submit(contextvars.copy_context().run, self.get_task)
+            self.get_task_definition()
+            task.result()
+        else:
+            self.get_task_definition()
+
         if not self.dns_entry:
             # skip task definitions without proper labels.
-            return
+            return []
 
-        self.get_task()
         if not self.task:
-            log.error('task "%s" was not found', self.task_arn)
-            return
+            self.get_task()
+            if not self.task:
+                log.error('task "%s" was not found', self.task_arn)
+                return []
 
-        if desired_state == "RUNNING" and last_state == "RUNNING":
-            self.get_network_interfaces()
-            ip_addresses = self.get_ip_addresses(self.dns_entry.register_public_ip)
-            if ip_addresses:
-                self.register_dns_entry(ip_addresses[0])
+        changes = []
+        if registering:
+            ip_addresses = {}
+            for dns_entry in self.dns_entries:
+                if dns_entry.register_public_ip not in ip_addresses:
+                    ip_addresses[dns_entry.register_public_ip] = self.resolve_ip_addresses(dns_entry.register_public_ip)
+                if not ip_addresses[dns_entry.register_public_ip]:
+                    log.error('no ip address was found to register "%s" for task %s', dns_entry.name, self.task_arn)
+                    continue
+                ip_address = ip_addresses[dns_entry.register_public_ip][0]
+                if dns_entry.aggregate:
+                    change = self.get_aggregate_change(ADD, ip_address, dns_entry)
+                else:
+                    change = self.get_registration_change(ip_address, dns_entry)
+                    if record_index.is_current(dns_entry.hosted_zone_id, change["ResourceRecordSet"]):
+                        log.info('"%s" for task "%s" is already registered', dns_entry.name, self.task_arn)
+                        metrics.collector.increment("unchanged_records")
+                        continue
+                log.info('registering "%s" for task "%s"', dns_entry.name, self.task_arn)
+                changes.append((dns_entry.hosted_zone_id, change))
+            for dns_entry in filter(lambda e: e.srv_name, self.dns_entries):
+                change = self.get_srv_registration_change(dns_entry)
+                if change and not record_index.is_current(dns_entry.hosted_zone_id, change["ResourceRecordSet"]):
+                    changes.append((dns_entry.hosted_zone_id, change))
+        else:
+            for dns_entry in self.dns_entries:
+                log.info('deregistering "%s" for task "%s"', dns_entry.name, self.task_id)
+                if dns_entry.srv_name:
+                    with self.timed("route53_lookup"):
+                        change = self.get_srv_deregistration_change(dns_entry)
+                    if change:
+                        changes.append((dns_entry.hosted_zone_id, change))
+                if dns_entry.aggregate:
+                    ip_addresses = self.get_released_ip_addresses(dns_entry.register_public_ip)
+                    if not ip_addresses:
+                        log.warning('no ip address was found to deregister "%s" for task %s', dns_entry.name, self.task_arn)
+                    elif self.uses_host_network() and self.is_host_shared(dns_entry):
+                        log.info('keeping the host address in "%s", another task on the host registers it', dns_entry.name)
+                        continue
+                    for ip_address in ip_addresses[:1]:
+                        changes.append((dns_entry.hosted_zone_id, self.get_aggregate_change(REMOVE, ip_address, dns_entry)))
+                    continue
+                with self.timed("route53_lookup"):
+                    change = self.get_deregistration_change(dns_entry)
+                if change:
+                    changes.append((dns_entry.hosted_zone_id, change))
+        return changes
+
+    def needs_task(self, registering: bool) -> bool:
+        """
+        returns True if the task must be described, because it was not in the event or,
+        for a registration, the event lacks the network attachments.
+        """
+        if not self.task:
+            return True
+        return (
+            registering and self.task_from_event and not self.get_eni_attachments() and not self.uses_host_network()
+        )
+
+    def handle(self, desired_state, last_state):
+        """
+        applies the changes for the task state change, with a single change batch per hosted
+        zone. Multiple hosted zones are changed concurrently. Returns the elapsed time in
+        seconds per stage.
+        """
+        changes = group_changes(self.get_changes(desired_state, last_state))
+        if not changes:
+            metrics.collector.increment("skipped_events")
+            return self.timings
+
+        with self.timed("route53_change"):
+            if len(changes) <= 1:
+                for hosted_zone_id, zone_changes in changes.items():
+                    self.change_resource_record_sets(hosted_zone_id, zone_changes)
             else:
-                log.error('no ip address was found to register task %s', self.task_arn)
-        elif desired_state == "STOPPED":
-            self.deregister_dns_entry()
+                with ThreadPoolExecutor(max_workers=min(len(changes), zone_concurrency)) as executor:
+                    futures = [
+                        executor.submit(contextvars.copy_context().run, self.change_resource_record_sets, z, c)
+                        for z, c in changes.items()
+                    ]
+                    for future in futures:
+                        future.result()
+        return self.timings
+
+
+def group_changes(changes: List[Tuple[str, dict]]) -> Dict[str, List[dict]]:
+    result = OrderedDict()
+    for hosted_zone_id, change in changes:
+        result.setdefault(hosted_zone_id, []).append(change)
+    return result
+
+
+def change_resource_record_sets(route53, hosted_zone_id: str, changes: List[dict]):
+    """
+    submits the `changes` in a single change batch and waits for its completion.
+    """
+    response = submit_change_batch(route53, hosted_zone_id, changes)
+    if response:
+        wait_for_route53_change_completion(route53, response)
+
+
+def submit_change_batch(route53, hosted_zone_id: str, changes: List[dict]) -> dict:
+    """
+    submits the `changes` in a single change batch and returns the change info, or None if
+    the changes to aggregated record sets turned out to be no-ops. The resolved changes are
+    split into as many batches as needed, and the change info of the last one is returned.
+    When an aggregated record set was changed concurrently, Route53 rejects the batch; the
+    record sets are then read again and the remaining changes are retried.
+    """
+    if not any(is_aggregate_change(c) for c in changes):
+        return submit_changes(route53, hosted_zone_id, changes)
+
+    response = None
+    for attempt in range(AGGREGATE_ATTEMPTS):
+        resolved = resolve_aggregate_changes(route53, hosted_zone_id, changes)
+        if not resolved:
+            return response
+        try:
+            for batch in split_changes(resolved):
+                response = submit_changes(route53, hosted_zone_id, batch)
+                # the other changes are in the first batch, the aggregated record sets
+                # already changed are no-ops when resolved again.
+                changes = [c for c in changes if is_aggregate_change(c)]
+            return response
+        except ClientError as e:
+            if not is_conflict(e) or attempt == AGGREGATE_ATTEMPTS - 1:
+                raise
+            log.warning("aggregated records in zone %s changed concurrently, retrying, %s", hosted_zone_id, e)
+            metrics.collector.increment("aggregate_conflicts")
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+
+
+def submit_changes(route53, hosted_zone_id: str, changes: List[dict]) -> dict:
+    """
+    submits the `changes` in a single change batch and keeps the record index up to date.
+    """
+    try:
+        response = route53.change_resource_record_sets(
+            HostedZoneId=hosted_zone_id,
+            ChangeBatch={"Comment": get_change_batch_comment(changes), "Changes": changes},
+        )
+    except ClientError:
+        record_index.invalidate(hosted_zone_id, changes)
+        raise
+    record_index.update(hosted_zone_id, changes)
+    return response
+
+
+def is_aggregate_change(change: dict) -> bool:
+    return change["Action"] in (ADD, REMOVE)
+
+
+def is_conflict(error: ClientError) -> bool:
+    """
+    returns True if the change batch was rejected because a record set was changed concurrently.
+    """
+    return error.response["Error"]["Code"] == "InvalidChangeBatch" and bool(
+        CONFLICT_PATTERN.search(error.response["Error"].get("Message", ""))
+    )
+
+
+def get_change_size(change: dict) -> int:
+    size = len(change["ResourceRecordSet"].get("ResourceRecords", [])) or 1
+    return size * 2 if change["Action"] == "UPSERT" else size
+
+
+def split_changes(changes: List[dict], max_size: int = MAX_CHANGE_BATCH_SIZE) -> List[List[dict]]:
+    """
+    splits resolved changes into change batches of at most `max_size` resource records. The
+    DELETE and CREATE of an aggregated record set are kept in the same batch.
+    """
+    units = []
+    for change in changes:
+        previous = units[-1][-1] if units else None
+        if (
+            change["Action"] == "CREATE"
+            and previous
+            and previous["Action"] == "DELETE"
+            and previous["ResourceRecordSet"]["Name"] == change["ResourceRecordSet"]["Name"]
+        ):
+            units[-1].append(change)
+        else:
+            units.append([change])
+
+    batches, size = [], 0
+    for unit in units:
+        unit_size = sum(get_change_size(c) for c in unit)
+        if batches and size + unit_size <= max_size:
+            batches[-1].extend(unit)
+            size += unit_size
+        else:
+            batches.append(list(unit))
+            size = unit_size
+    return batches
+
+
+def resolve_aggregate_changes(route53, hosted_zone_id: str, changes: List[dict]) -> List[dict]:
+    """
+    replaces the additions and removals of ip addresses by a DELETE of the current record set
+    and a CREATE of the updated record set, per name. The DELETE fails if the record set no
+    longer matches, and the CREATE if another one was created in the meantime, so concurrent
+    updates are never lost. Other changes are passed as is.
+    """
+    result = []
+    aggregated = OrderedDict()
+    for change in changes:
+        if is_aggregate_change(change):
+            aggregated.setdefault(change["ResourceRecordSet"]["Name"], []).append(change)
+        else:
+            result.append(change)
+
+    for name, name_changes in aggregated.items():
+        current = record_index.lookup(route53, hosted_zone_id, name, "A", None)
+        values = sorted(r["Value"] for r in current["ResourceRecords"]) if current else []
+        updated = list(values)
+        for change in name_changes:
+            value = change["ResourceRecordSet"]["ResourceRecords"][0]["Value"]
+            if change["Action"] == REMOVE and value in updated:
+                updated.remove(value)
+            elif change["Action"] == ADD and value not in updated:
+                if len(updated) >= aggregate_max_values:
+                    log.error('not adding %s to "%s", it already has %d values', value, name, len(updated))
+                    continue
+                updated.append(value)
+        if sorted(updated) == values:
+            continue
+        if current:
+            result.append({"Action": "DELETE", "ResourceRecordSet": current})
+        if updated:
+            rr_set = dict(name_changes[0]["ResourceRecordSet"])
+            rr_set["ResourceRecords"] = [{"Value": v} for v in sorted(updated)]
+            result.append({"Action": "CREATE", "ResourceRecordSet": rr_set})
+    return result
 
 
 def wait_for_route53_change_completion(route53: object, change: dict):
-    id = change['ChangeInfo']['Id'].split('/')[-1]
-    while change['ChangeInfo']['Status'] != 'INSYNC':
-        log.info(f'waiting for change {id} to complete')
-        time.sleep(5)
-        change = route53.get_change(Id=id)
+    change_completion(route53, change)
+
+
+def get_change_batch_comment(changes: List[dict]) -> str:
+    if all(c["Action"] == "DELETE" for c in changes):
+        return "deregistration by ecs-dns-registrator"
+    return "registration by ecs-dns-registrator"
+
+
+def describe_network_interfaces(ec2, eni_ids: List[str]) -> Dict[str, "EniView"]:
+    """
+    returns the network interfaces by id, using a single describe_network_interfaces call.
+    Network interfaces which no longer exist are absent from the result.
+    """
+    if not eni_ids:
+        return {}
+    response = ec2.describe_network_interfaces(Filters=[{"Name": "network-interface-id", "Values": eni_ids}])
+    return {n["NetworkInterfaceId"]: EniView.from_network_interface(n) for n in response["NetworkInterfaces"]}
+
+
+def get_attachment_detail(attachment: dict, name: str, default: str = None) -> str:
+    return next(map(lambda d: d["value"], filter(lambda d: d["name"] == name, attachment.get("details", []))), default)
+
 
 class DNSEntry(NamedTuple):
     hosted_zone_id: str
     name: str
     register_public_ip: bool
+    aggregate: bool = False
+    srv_name: str = None
+    container_name: str = None
+    srv_port: int = None
+    role_arn: str = None
+
+
+class EniView(NamedTuple):
+    """
+    the addresses of a network interface, from a task attachment or a network interface
+    description.
+    """
+
+    eni_id: str
+    private_ip: str
+    public_ip: str = None
+    status: str = None
+
+    @classmethod
+    def from_attachment(cls, attachment: dict) -> "EniView":
+        return cls(
+            get_attachment_detail(attachment, "networkInterfaceId"),
+            get_attachment_detail(attachment, "privateIPv4Address"),
+            None,
+            intern(attachment.get("status")),
+        )
+
+    @classmethod
+    def from_network_interface(cls, network_interface: dict) -> "EniView":
+        return cls(
+            network_interface.get("NetworkInterfaceId"),
+            network_interface.get("PrivateIpAddress"),
+            network_interface.get("Association", {}).get("PublicIp"),
+        )
+
+
+class NetworkBinding(NamedTuple):
+    container_name: str
+    container_port: int
+    host_port: int
+
+
+class TaskView(NamedTuple):
+    """
+    the fields of an ECS task used by the registrator, projected from a task description
+    or a task state change event.
+    """
+
+    task_arn: str
+    cluster_arn: str
+    task_definition_arn: str
+    last_status: str
+    container_instance_arn: str = None
+    attachments: Tuple[EniView, ...] = ()
+    network_bindings: Tuple[NetworkBinding, ...] = ()
+
+    @classmethod
+    def from_task(cls, task: dict) -> "TaskView":
+        return cls(
+            task.get("taskArn"),
+            intern(task.get("clusterArn")),
+            intern(task.get("taskDefinitionArn")),
+            intern(task.get("lastStatus")),
+            intern(task.get("containerInstanceArn")),
+            tuple(
+                EniView.from_attachment(a)
+                for a in task.get("attachments", [])
+                if a.get("type") == "ElasticNetworkInterface"
+            ),
+            tuple(
+                NetworkBinding(intern(c.get("name")), b.get("containerPort"), b.get("hostPort"))
+                for c in task.get("containers", [])
+                for b in c.get("networkBindings", [])
+            ),
+        )
+
+
+def get_task_view(task) -> TaskView:
+    """
+    returns the projection of the task, which may already be projected.
+    """
+    if not task:
+        return None
+    return task if isinstance(task, TaskView) else TaskView.from_task(task)
+
+
+def is_task_state_change(event: dict) -> bool:
+    return event.get("detail-type") == "ECS Task State Change"
+
+
+def create_registrator(event: dict, clients: aws_clients.ClientProvider = None) -> DNSRegistrator:
+    detail = event["detail"]
+    return DNSRegistrator(
+        detail["taskArn"],
+        detail["clusterArn"],
+        detail["taskDefinitionArn"],
+        clients,
+        task=detail if use_event_payload else None,
+    )
 
 
 def handler(event, context):
-    if event.get("detail-type") != "ECS Task State Change":
-        log.error("unsupported event, %", event.get("detail-type"))
+    if not is_task_state_change(event):
+        log.error("unsupported event, %s", event.get("detail-type"))
         return
 
-    task_arn = event["detail"]["taskArn"]
-    task_definition_arn = event["detail"]["taskDefinitionArn"]
-    cluster_arn = event["detail"]["clusterArn"]
     desired_state = event["detail"]["desiredStatus"]
     last_state = event["detail"]["lastStatus"]
+    if event_filter.classify(event) == event_filter.IRRELEVANT:
+        log.debug('ignoring %s/%s event of task "%s"', desired_state, last_state, event["detail"].get("taskArn"))
+        return
 
-    registrator = DNSRegistrator(task_arn, cluster_arn, task_definition_arn)
-    registrator.handle(desired_state, last_state)
-
-
-
+    invocation = metrics.collector.invocation(taskArn=event["detail"].get("taskArn"), lastStatus=last_state)
+    with invocation, profiling.profiler.invocation(event):
+        change_completion.verify_pending()
+        registrator = create_registrator(event)
+        timings = registrator.handle(desired_state, last_state)
+    log.debug("timings %s", timings)
+    return timings
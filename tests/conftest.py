@@ -0,0 +1,37 @@
+import os
+import sys
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-central-1")
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(root, "src"))
+sys.path.insert(0, os.path.join(root, "benchmarks"))
+
+import pytest  # noqa: E402
+
+import container_instances  # noqa: E402
+import task_event  # noqa: E402
+from aws_clients import ClientProvider  # noqa: E402
+from fake_aws import FakeAWS  # noqa: E402
+from record_index import record_index  # noqa: E402
+
+
+@pytest.fixture
+def fake_aws(monkeypatch):
+    """
+    a fake of the AWS endpoints, installed on the ecs, ec2 and route53 clients of a client
+    provider, with empty caches. Route53 changes are not waited for.
+    """
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test")
+    monkeypatch.setattr(task_event, "change_completion", task_event.route53_changes.FireAndForget())
+    monkeypatch.setattr(container_instances, "container_instance_index", container_instances.ContainerInstanceIndex())
+    fake = FakeAWS()
+    provider = ClientProvider()
+    for name in ["ecs", "ec2", "route53"]:
+        fake.install(provider.get(name))
+    task_event.task_definition_cache.clear()
+    record_index.records.clear()
+    yield fake, provider
+    task_event.task_definition_cache.clear()
+    record_index.records.clear()
@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta, timezone
+
+from botocore.stub import Stubber
+
+from aws_clients import ClientProvider, client_config
+
+
+def test_client_is_created_once():
+    provider = ClientProvider()
+    ecs = provider.get("ecs")
+    assert ecs is provider.get("ecs")
+    assert ecs is not provider.get("route53")
+
+
+def test_set_client():
+    provider = ClientProvider()
+    client = object()
+    provider.set("ecs", client)
+    assert client is provider.get("ecs")
+    provider.clear()
+    assert client is not provider.get("ecs")
+
+
+def test_client_config(monkeypatch):
+    monkeypatch.setenv("AWS_MAX_POOL_CONNECTIONS", "25")
+    monkeypatch.setenv("AWS_RETRY_MODE", "adaptive")
+    config = client_config()
+    assert config.max_pool_connections == 25
+    assert config.retries["mode"] == "adaptive"
+    assert config.tcp_keepalive
+
+
+def test_client_per_region(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-central-1")
+    provider = ClientProvider()
+    ecs = provider.get("ecs")
+    assert ecs is provider.get("ecs", "eu-central-1")
+    us_east = provider.get("ecs", "us-east-1")
+    assert us_east is not ecs
+    assert us_east.meta.region_name == "us-east-1"
+    assert us_east is provider.get("ecs", "us-east-1")
+
+
+def assume_role_response(access_key: str, expiration: datetime) -> dict:
+    return {
+        "Credentials": {
+            "AccessKeyId": access_key,
+            "SecretAccessKey": "secret",
+            "SessionToken": "token",
+            "Expiration": expiration,
+        },
+        "AssumedRoleUser": {"AssumedRoleId": "AROA0000000000000:session", "Arn": ROLE_ARN + "/session"},
+    }
+
+
+ROLE_ARN = "arn:aws:iam::210987654321:role/dns-registrator"
+
+
+def test_assumed_role_session_is_cached_and_refreshed(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-central-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test")
+    provider = ClientProvider()
+    sts = provider.get("sts")
+    now = datetime.now(timezone.utc)
+    expected = {"RoleArn": ROLE_ARN, "RoleSessionName": "ecs-dns-registrator", "DurationSeconds": 3600}
+    with Stubber(sts) as stubber:
+        route53 = provider.get("route53", role_arn=ROLE_ARN)
+        assert route53 is provider.get("route53", role_arn=ROLE_ARN)
+        ecs = provider.get("ecs", "us-east-1", ROLE_ARN)
+        assert route53 is not provider.get("route53")
+        # the role is not assumed while the clients are created
+        assert provider.sessions.stats()["assumed"] == 0
+
+        credentials = ecs._request_signer._credentials
+        assert credentials is route53._request_signer._credentials
+        stubber.add_response("assume_role", assume_role_response("ASIAFIRST0000000", now + timedelta(hours=1)), expected)
+        assert credentials.get_frozen_credentials().access_key == "ASIAFIRST0000000"
+        stubber.assert_no_pending_responses()
+        assert provider.sessions.stats()["assumed"] == 1
+        assert provider.sessions.stats()["hits"] == 1
+
+        # expires within the refresh window of botocore
+        credentials._expiry_time = now + timedelta(minutes=5)
+        stubber.add_response("assume_role", assume_role_response("ASIASECOND000000", now + timedelta(hours=1)), expected)
+        assert credentials.get_frozen_credentials().access_key == "ASIASECOND000000"
+        stubber.assert_no_pending_responses()
+
+    stats = provider.sessions.stats()
+    assert stats["sessions"] == 1
+    assert stats["assumed"] == 2
+    assert stats["sts_latency_max_ms"] > 0
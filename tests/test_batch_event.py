@@ -0,0 +1,97 @@
+import json
+
+import pytest
+from botocore.stub import Stubber
+
+import batch_event
+import task_event
+from aws_clients import ClientProvider
+from record_index import record_index
+
+CLUSTER_ARN = "arn:aws:ecs:eu-central-1:1234567890:cluster/batch"
+TASK_DEFINITION_ARN = "arn:aws:ecs:eu-central-1:1234567890:task-definition/paas-monitor:25"
+
+INSYNC = {"ChangeInfo": {"Id": "/change/C1", "Status": "INSYNC", "SubmittedAt": "2019-01-01T00:00:00Z"}}
+
+
+def task_state_change(task_id, desired_state, last_state, version, ip_address="10.0.0.1"):
+    return {
+        "detail-type": "ECS Task State Change",
+        "source": "aws.ecs",
+        "detail": {
+            "taskArn": "arn:aws:ecs:eu-central-1:1234567890:task/batch/{}".format(task_id),
+            "clusterArn": CLUSTER_ARN,
+            "taskDefinitionArn": TASK_DEFINITION_ARN,
+            "desiredStatus": desired_state,
+            "lastStatus": last_state,
+            "version": version,
+            "attachments": [
+                {
+                    "type": "ElasticNetworkInterface",
+                    "status": "ATTACHED",
+                    "details": [
+                        {"name": "networkInterfaceId", "value": "eni-{}".format(task_id)},
+                        {"name": "privateIPv4Address", "value": ip_address},
+                    ],
+                }
+            ],
+        },
+    }
+
+
+def sqs_batch(events):
+    return {"Records": [{"messageId": "m{}".format(i), "body": json.dumps(e)} for i, e in enumerate(events)]}
+
+
+@pytest.fixture
+def stubbed():
+    provider = ClientProvider()
+    stubbers = {}
+    for name in ["ecs", "route53"]:
+        stubbers[name] = Stubber(provider.get(name))
+        stubbers[name].activate()
+    task_event.task_definition_cache.clear()
+    task_event.task_definition_cache.put(
+        TASK_DEFINITION_ARN, (task_event.DNSEntry("Z1", "paas-monitor.example.", False),)
+    )
+    record_index.records.clear()
+    yield provider, stubbers
+    task_event.task_definition_cache.clear()
+    record_index.records.clear()
+    for stubber in stubbers.values():
+        stubber.assert_no_pending_responses()
+        stubber.deactivate()
+
+
+def test_get_latest_events():
+    events = [
+        task_state_change("t1", "RUNNING", "PENDING", 1),
+        task_state_change("t1", "RUNNING", "RUNNING", 2),
+        task_state_change("t2", "RUNNING", "RUNNING", 2),
+        {"detail-type": "ECS Container Instance State Change", "detail": {}},
+    ]
+    latest = batch_event.get_latest_events(batch_event.get_items(sqs_batch(events)))
+    assert [item_id for item_id, _ in latest.values()] == ["m1", "m2"]
+
+
+def test_chunk_changes():
+    change = {"Action": "UPSERT", "ResourceRecordSet": {"ResourceRecords": [{"Value": "10.0.0.1"}]}}
+    chunks = list(batch_event.chunk_changes([(str(i), change) for i in range(1001)]))
+    assert [len(c) for c in chunks] == [500, 500, 1]
+
+
+def test_changes_are_grouped_per_zone(stubbed):
+    provider, stubbers = stubbed
+    stubbers["route53"].add_response("change_resource_record_sets", INSYNC)
+    events = [task_state_change("t{}".format(i), "RUNNING", "RUNNING", 2, "10.0.0.{}".format(i)) for i in range(10)]
+    events.append(task_state_change("t0", "RUNNING", "PENDING", 1))
+    assert batch_event.process(batch_event.get_items(events), provider) == []
+
+
+def test_failed_batch_is_retried_per_item(stubbed):
+    provider, stubbers = stubbed
+    stubbers["route53"].add_client_error("change_resource_record_sets", "InvalidChangeBatch")
+    stubbers["route53"].add_response("change_resource_record_sets", INSYNC)
+    stubbers["route53"].add_client_error("change_resource_record_sets", "InvalidChangeBatch")
+    events = [task_state_change("t1", "RUNNING", "RUNNING", 2), task_state_change("t2", "RUNNING", "RUNNING", 2)]
+    assert batch_event.process(batch_event.get_items(sqs_batch(events)), provider) == ["m1"]
@@ -0,0 +1,140 @@
+import pytest
+
+import batch_event
+import task_event
+from container_instances import ContainerInstanceIndex, HostAddress
+
+CLUSTER_ARN = "arn:aws:ecs:eu-central-1:123456789012:cluster/bridge"
+TASK_DEFINITION_ARN = "arn:aws:ecs:eu-central-1:123456789012:task-definition/bridge:1"
+
+
+@pytest.fixture
+def fake(fake_aws):
+    """
+    the fake AWS endpoints with a task definition in bridge network mode, and a client provider.
+    """
+    fake, provider = fake_aws
+    labels = {
+        "DNSHostedZoneId": "Z1",
+        "DNSName": "bridge.example",
+        "DNSRegisterPublicIp": "false",
+        "DNSSrvName": "_http._tcp.bridge.example",
+    }
+    fake.add_task_definition(TASK_DEFINITION_ARN, [{"name": "app", "dockerLabels": labels}])
+    return fake, provider
+
+
+def add_task(fake, container_instance_arn, i):
+    arn = "arn:aws:ecs:eu-central-1:123456789012:task/bridge/{:032x}".format(i)
+    return fake.add_host_task(CLUSTER_ARN, arn, TASK_DEFINITION_ARN, container_instance_arn, {"app": 32768 + i})
+
+
+def test_resolve_in_batches(fake):
+    fake, provider = fake
+    arns = [fake.add_container_instance(CLUSTER_ARN, "10.0.0.{}".format(i)) for i in range(150)]
+    index = ContainerInstanceIndex()
+    hosts = index.resolve(provider.get("ecs"), provider.get("ec2"), CLUSTER_ARN, arns + arns[:10] + [None])
+    assert len(hosts) == 150
+    assert hosts[arns[7]].private_ip == "10.0.0.7"
+    assert hosts[arns[7]].private_dns_name == "ip-10-0-0-7.ec2.internal"
+    assert fake.calls["ecs.DescribeContainerInstances"] == 2
+    assert fake.calls["ec2.DescribeInstances"] == 2
+
+    assert index.get(provider.get("ecs"), provider.get("ec2"), CLUSTER_ARN, arns[0]) == hosts[arns[0]]
+    assert fake.calls["ecs.DescribeContainerInstances"] == 2
+    assert index.hosts.stats()["hits"] == 1
+
+
+def test_expired_and_missing_container_instances(fake):
+    fake, provider = fake
+    arn = fake.add_container_instance(CLUSTER_ARN, "10.0.0.1", "52.1.2.3")
+    index = ContainerInstanceIndex(ttl=0.0)
+    for _ in range(2):
+        host = index.get(provider.get("ecs"), provider.get("ec2"), CLUSTER_ARN, arn)
+        assert host == HostAddress(
+            host.instance_id, "10.0.0.1", "52.1.2.3", "ip-10-0-0-1.ec2.internal", "ec2-52-1-2-3.compute.amazonaws.com"
+        )
+    assert fake.calls["ecs.DescribeContainerInstances"] == 2
+    assert index.get(provider.get("ecs"), provider.get("ec2"), CLUSTER_ARN, arn + "-missing") is None
+
+
+def test_register_and_deregister_bridge_task(fake):
+    fake, provider = fake
+    host = fake.add_container_instance(CLUSTER_ARN, "10.0.0.1")
+    task = add_task(fake, host, 1)
+    event = fake.event(task["taskArn"])
+    task_event.create_registrator(event, provider).handle("RUNNING", "RUNNING")
+
+    records = fake.records("Z1")
+    assert [(r["Name"], r["Type"], r["ResourceRecords"]) for r in records] == [
+        ("_http._tcp.bridge.example.", "SRV", [{"Value": "1 1 32769 ip-10-0-0-1.ec2.internal."}]),
+        ("bridge.example.", "A", [{"Value": "10.0.0.1"}]),
+    ]
+    assert fake.calls["ecs.DescribeTasks"] == 0
+
+    fake.stop_task(task["taskArn"])
+    task_event.create_registrator(fake.event(task["taskArn"]), provider).handle("STOPPED", "STOPPED")
+    assert fake.records("Z1") == []
+
+
+def test_aggregated_host_address_is_kept_for_other_tasks(fake):
+    fake, provider = fake
+    arn = "arn:aws:ecs:eu-central-1:123456789012:task-definition/bridge-aggregate:1"
+    labels = {
+        "DNSHostedZoneId": "Z1",
+        "DNSName": "shared.example",
+        "DNSRegisterPublicIp": "false",
+        "DNSRecordMode": "aggregate",
+    }
+    fake.add_task_definition(arn, [{"name": "app", "dockerLabels": labels}])
+    host = fake.add_container_instance(CLUSTER_ARN, "10.0.0.1")
+    tasks = [
+        fake.add_host_task(
+            CLUSTER_ARN, "arn:aws:ecs:eu-central-1:123456789012:task/bridge/{:032x}".format(i), arn, host, {"app": 32768 + i}
+        )
+        for i in range(2)
+    ]
+    for task in tasks:
+        task_event.create_registrator(fake.event(task["taskArn"]), provider).handle("RUNNING", "RUNNING")
+    assert [r["ResourceRecords"] for r in fake.records("Z1")] == [[{"Value": "10.0.0.1"}]]
+
+    # the other task on the host still registers the address
+    fake.stop_task(tasks[0]["taskArn"])
+    task_event.create_registrator(fake.event(tasks[0]["taskArn"]), provider).handle("STOPPED", "STOPPED")
+    assert [r["ResourceRecords"] for r in fake.records("Z1")] == [[{"Value": "10.0.0.1"}]]
+
+    fake.stop_task(tasks[1]["taskArn"])
+    task_event.create_registrator(fake.event(tasks[1]["taskArn"]), provider).handle("STOPPED", "STOPPED")
+    assert fake.records("Z1") == []
+
+
+def test_batch_resolves_container_instances_once(fake):
+    fake, provider = fake
+    hosts = [fake.add_container_instance(CLUSTER_ARN, "10.0.0.{}".format(i)) for i in range(3)]
+    events = [fake.event(add_task(fake, hosts[i % 3], i)["taskArn"]) for i in range(30)]
+    assert batch_event.process([(str(i), e) for i, e in enumerate(events)], provider) == []
+    assert fake.calls["ecs.DescribeContainerInstances"] == 1
+    assert fake.calls["ec2.DescribeInstances"] == 1
+    assert len(fake.records("Z1")) == 60
+
+
+def test_reconcile_keeps_bridge_task_records(fake):
+    import reconcile
+
+    fake, provider = fake
+    host = fake.add_container_instance(CLUSTER_ARN, "10.0.0.1")
+    task = add_task(fake, host, 1)
+    task_event.create_registrator(fake.event(task["taskArn"]), provider).handle("RUNNING", "RUNNING")
+    report = reconcile.reconcile([CLUSTER_ARN], dry_run=True, clients=provider)
+    assert report["hosted_zones"] == {"Z1": []}
+
+    # the STOPPED event of a task was lost, and ECS no longer knows the task
+    stale = add_task(fake, host, 2)
+    task_event.create_registrator(fake.event(stale["taskArn"]), provider).handle("RUNNING", "RUNNING")
+    del fake.tasks[stale["taskArn"]]
+    report = reconcile.reconcile([CLUSTER_ARN], clients=provider)
+    assert sorted((c["Action"], c["Name"]) for c in report["hosted_zones"]["Z1"]) == [
+        ("DELETE", "_http._tcp.bridge.example."),
+        ("DELETE", "bridge.example."),
+    ]
+    assert len(fake.records("Z1")) == 2
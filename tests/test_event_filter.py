@@ -0,0 +1,90 @@
+import os
+
+import pytest
+
+import aws_clients
+import event_filter
+import task_event
+from event_filter import DEREGISTER, IRRELEVANT, REGISTER, EventFilter
+
+
+def event(desired_status, last_status, cluster="web", family="paas-monitor"):
+    return {
+        "detail-type": "ECS Task State Change",
+        "detail": {
+            "clusterArn": "arn:aws:ecs:eu-central-1:1234567890:cluster/{}".format(cluster),
+            "taskArn": "arn:aws:ecs:eu-central-1:1234567890:task/{}/0123456789abcdef0123456789abcdef".format(cluster),
+            "taskDefinitionArn": "arn:aws:ecs:eu-central-1:1234567890:task-definition/{}:25".format(family),
+            "desiredStatus": desired_status,
+            "lastStatus": last_status,
+        },
+    }
+
+
+@pytest.mark.parametrize(
+    "desired_status,last_status,expected",
+    [
+        ("RUNNING", "PROVISIONING", IRRELEVANT),
+        ("RUNNING", "PENDING", IRRELEVANT),
+        ("RUNNING", "ACTIVATING", IRRELEVANT),
+        ("RUNNING", "RUNNING", REGISTER),
+        ("STOPPED", "RUNNING", DEREGISTER),
+        ("STOPPED", "DEACTIVATING", IRRELEVANT),
+        ("STOPPED", "STOPPING", IRRELEVANT),
+        ("STOPPED", "DEPROVISIONING", IRRELEVANT),
+        ("STOPPED", "STOPPED", DEREGISTER),
+    ],
+)
+def test_classify(desired_status, last_status, expected):
+    assert EventFilter().classify(event(desired_status, last_status)) == expected
+
+
+def test_classify_unsupported_event():
+    assert EventFilter().classify({"detail-type": "EC2 Instance State-change Notification"}) == IRRELEVANT
+
+
+def test_deregister_last_statuses():
+    f = EventFilter(deregister_last_statuses=["DEACTIVATING"])
+    assert f.classify(event("STOPPED", "DEACTIVATING")) == DEREGISTER
+    assert f.classify(event("STOPPED", "STOPPED")) == IRRELEVANT
+
+
+def test_allow_and_deny_lists():
+    f = EventFilter(cluster_allow_list=["web", "api-*"], family_deny_list=["batch-*"])
+    assert f.classify(event("RUNNING", "RUNNING", cluster="web")) == REGISTER
+    assert f.classify(event("RUNNING", "RUNNING", cluster="api-test")) == REGISTER
+    assert f.classify(event("RUNNING", "RUNNING", cluster="worker")) == IRRELEVANT
+    assert f.classify(event("RUNNING", "RUNNING", family="batch-import")) == IRRELEVANT
+
+    f = EventFilter(cluster_deny_list=["test"], family_allow_list=["paas-monitor"])
+    assert f.classify(event("STOPPED", "STOPPED")) == DEREGISTER
+    assert f.classify(event("STOPPED", "STOPPED", cluster="test")) == IRRELEVANT
+    assert f.classify(event("STOPPED", "STOPPED", family="other")) == IRRELEVANT
+
+
+def test_event_pattern():
+    pattern = EventFilter(cluster_allow_list=["web"], family_allow_list=["paas-*"]).event_pattern()
+    assert pattern["source"] == ["aws.ecs"]
+    assert pattern["detail"]["$or"] == [
+        {"desiredStatus": ["RUNNING"], "lastStatus": ["RUNNING"]},
+        {"desiredStatus": ["STOPPED"], "lastStatus": ["RUNNING", "STOPPED"]},
+    ]
+    assert pattern["detail"]["clusterArn"] == [{"wildcard": "*:cluster/web"}]
+    assert pattern["detail"]["taskDefinitionArn"] == [{"wildcard": "*:task-definition/paas-*:*"}]
+
+
+def test_template_event_pattern():
+    with open(os.path.join(os.path.dirname(__file__), "..", "cloudformation", "template.yaml")) as f:
+        template = f.read()
+    assert event_filter.to_yaml(EventFilter().event_pattern(), 8) in template
+
+
+def test_irrelevant_event_creates_no_clients(monkeypatch):
+    class NoClients(object):
+        def get(self, service_name):
+            raise AssertionError("client {} created".format(service_name))
+
+    monkeypatch.setattr(aws_clients, "clients", NoClients())
+    monkeypatch.setattr(task_event, "change_completion", None)
+    assert task_event.handler(event("RUNNING", "PENDING"), None) is None
+    assert task_event.handler(event("STOPPED", "DEPROVISIONING"), None) is None
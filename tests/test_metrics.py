@@ -0,0 +1,117 @@
+import functools
+import io
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import botocore.exceptions
+import pytest
+
+import aws_clients
+import metrics
+import scenarios
+import task_event
+from aws_clients import ClientProvider
+from fake_aws import FakeAWS
+from metrics import Metrics
+
+
+def test_counters_and_timings():
+    collector = Metrics(dimensions={"FunctionName": "registrator"})
+    collector.increment("skipped_events")
+    collector.increment("skipped_events")
+    with collector.span("route53_change"):
+        pass
+    record = collector.to_emf()
+    assert record["skipped_events"] == 2
+    assert len(record["route53_change"]) == 1
+    assert record["FunctionName"] == "registrator"
+    definition = record["_aws"]["CloudWatchMetrics"][0]
+    assert definition["Dimensions"] == [["FunctionName"]]
+    assert {"Name": "route53_change", "Unit": "Milliseconds"} in definition["Metrics"]
+    assert {"Name": "skipped_events", "Unit": "Count"} in definition["Metrics"]
+
+
+def test_flush_writes_a_single_record():
+    collector = Metrics()
+    stream = io.StringIO()
+    collector.set_property("taskArn", "arn:aws:ecs:eu-central-1:123456789012:task/1")
+    for i in range(metrics.MAX_VALUES + 1):
+        collector.record("describe_tasks", float(i))
+    collector.flush(stream)
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 1
+    record = json.loads(lines[0])
+    assert record["taskArn"] == "arn:aws:ecs:eu-central-1:123456789012:task/1"
+    assert len(record["describe_tasks"]) == metrics.MAX_VALUES
+    assert record["describe_tasks"][0] == 0 and record["describe_tasks"][-1] == metrics.MAX_VALUES
+    assert record["dropped_values"] == 1
+    assert not collector.timings
+
+    collector.flush(stream)
+    assert len(stream.getvalue().splitlines()) == 1
+
+
+def test_concurrent_invocations_are_collected_separately():
+    collector = Metrics()
+    stream = io.StringIO()
+    collector.flush = functools.partial(Metrics.flush, collector, stream)
+    started = threading.Barrier(2)
+
+    def invoke(name):
+        with collector.invocation(name=name):
+            collector.increment(name)
+            started.wait()
+            collector.record("describe_tasks", 1.0)
+            started.wait()
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(invoke, ["first", "second"]))
+    records = sorted((json.loads(line) for line in stream.getvalue().splitlines()), key=lambda r: r["name"])
+    assert [r["name"] for r in records] == ["first", "second"]
+    assert records[0]["first"] == 1 and "second" not in records[0]
+    assert records[1]["second"] == 1 and "first" not in records[1]
+    assert all(r["describe_tasks"] == [1.0] for r in records)
+
+
+def test_disabled():
+    collector = Metrics(enabled=False)
+    collector.increment("skipped_events")
+    collector.record("describe_tasks", 1.0)
+    stream = io.StringIO()
+    collector.flush(stream)
+    assert not stream.getvalue()
+
+
+def test_aws_calls_are_timed(monkeypatch):
+    monkeypatch.setattr("botocore.endpoint.time.sleep", lambda seconds: None)
+    collector = Metrics()
+    fake = FakeAWS(throttle_rate=1.0)
+    route53 = fake.install(ClientProvider(metrics=collector).get("route53"))
+    with pytest.raises(botocore.exceptions.ClientError):
+        route53.get_change(Id="/change/C1")
+
+    assert len(collector.timings["get_change"]) == 1
+    assert collector.counters["aws_calls"] == 1
+    assert collector.counters["aws_errors"] == 1
+    assert collector.counters["throttles"] == fake.calls["route53.GetChange"]
+    assert collector.counters["retries"] == fake.calls["route53.GetChange"] - 1
+
+
+def test_handler_emits_one_record_per_invocation(monkeypatch, capsys):
+    monkeypatch.setattr(aws_clients, "clients", aws_clients.clients)
+    fake = FakeAWS()
+    events = scenarios.single_task(fake, 1)
+    scenarios.install(fake)
+
+    task_event.handler(events[0], None)
+    task_event.handler(events[0], None)
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert len(records) == 2
+    assert records[0]["taskArn"] == events[0]["detail"]["taskArn"]
+    assert len(records[0]["describe_task_definition"]) == 1
+    assert len(records[0]["change_resource_record_sets"]) == 1
+    assert records[0]["task_definition_cache_misses"] == 1
+    assert "describe_task_definition" not in records[1]
+    assert records[1]["task_definition_cache_hits"] == 1
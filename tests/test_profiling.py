@@ -0,0 +1,106 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import tracemalloc
+
+import aws_clients
+import profiling
+import task_event
+from profiling import Profiler
+
+CLUSTER_ARN = "arn:aws:ecs:eu-central-1:123456789012:cluster/profiled"
+TASK_DEFINITION_ARN = "arn:aws:ecs:eu-central-1:123456789012:task-definition/profiled:1"
+TASK_ARN = "arn:aws:ecs:eu-central-1:123456789012:task/profiled/0123456789abcdef0123456789abcdef"
+
+
+def inner(n):
+    return [str(i) for i in range(n)]
+
+
+def outer(n):
+    return [inner(n) for _ in range(10)]
+
+
+def task_state_change(last_status="RUNNING"):
+    return {
+        "detail-type": "ECS Task State Change",
+        "detail": {"taskArn": TASK_ARN, "desiredStatus": "RUNNING", "lastStatus": last_status},
+    }
+
+
+def test_disabled(tmp_path):
+    profiler = Profiler(str(tmp_path / "profiles"), sample_rate=0.0)
+    assert profiler.invocation(task_state_change()) is profiling.NOT_PROFILED
+    with profiler.invocation(task_state_change()):
+        assert not tracemalloc.is_tracing()
+        outer(100)
+    assert profiler.profiled == 0
+    assert not os.path.exists(str(tmp_path / "profiles"))
+
+
+def test_profile_is_written(tmp_path):
+    profiler = Profiler(str(tmp_path), sample_rate=1.0, top_allocations=5)
+    with profiler.invocation(task_state_change()):
+        assert tracemalloc.is_tracing()
+        outer(1000)
+    assert not tracemalloc.is_tracing()
+    assert profiler.profiled == 1
+
+    names = sorted(os.listdir(str(tmp_path)))
+    assert len(names) == 4
+    prefix = names[0].split(".")[0]
+    assert "-task-state-change-running-0123456789abcdef0123456789abcdef-" in prefix
+    assert [n[len(prefix) :] for n in names] == [".allocations.txt", ".collapsed", ".json", ".pstats"]
+
+    with open(str(tmp_path / (prefix + ".json"))) as f:
+        assert json.load(f)["taskArn"] == TASK_ARN
+    with open(str(tmp_path / (prefix + ".allocations.txt"))) as f:
+        assert 0 < len(f.readlines()) <= 5
+    stacks = profiling.read_collapsed_stacks(str(tmp_path / (prefix + ".collapsed")))
+    assert any("outer (test_profiling.py" in s and s.split(";")[-1].startswith("inner (") for s in stacks)
+
+
+def test_profiling_modules_are_not_imported_on_start():
+    # the modules of the handler are imported on every cold start.
+    modules = "{'argparse', 'cProfile', 'pstats', 'tracemalloc', 'sqlite3'}"
+    script = "import sys, task_event; print(sorted({} & set(sys.modules)))".format(modules)
+    src = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+    env = dict(os.environ, PYTHONPATH=src)
+    env.pop("RECORD_INDEX_PATH", None)
+    assert subprocess.check_output([sys.executable, "-c", script], env=env).decode().strip() == "[]"
+
+
+def test_get_tags():
+    assert profiling.get_tags(task_state_change("STOPPED")) == (TASK_ARN, "task-state-change-stopped")
+    assert profiling.get_tags({"Records": [{}, {}]}) == (None, "batch-2")
+    assert profiling.get_tags([{}]) == (None, "batch-1")
+
+
+def test_merge(tmp_path):
+    for path, stacks in [("a", {"main;work": 0.5, "main": 0.25}), ("b", {"main;work": 1.0})]:
+        with open(str(tmp_path / (path + ".collapsed")), "w") as f:
+            profiling.write_collapsed_stacks(stacks, f)
+    output = io.StringIO()
+    assert profiling.merge([str(tmp_path)], output) == 2
+    assert output.getvalue() == "main 250000\nmain;work 1500000\n"
+
+
+def test_handler_is_profiled(fake_aws, monkeypatch, tmp_path):
+    fake, provider = fake_aws
+    labels = {"DNSHostedZoneId": "Z1", "DNSName": "profiled.example", "DNSRegisterPublicIp": "false"}
+    fake.add_task_definition(TASK_DEFINITION_ARN, [{"name": "app", "dockerLabels": labels}])
+    fake.add_task(CLUSTER_ARN, TASK_ARN, TASK_DEFINITION_ARN, "10.0.0.1")
+    monkeypatch.setattr(aws_clients, "clients", provider)
+    monkeypatch.setattr(profiling, "profiler", Profiler(str(tmp_path), sample_rate=1.0))
+
+    task_event.handler(fake.event(TASK_ARN), None)
+
+    assert len(fake.records("Z1")) == 1
+    assert profiling.profiler.profiled == 1
+    pstats_output = str(tmp_path / "merged.pstats")
+    output = io.StringIO()
+    assert profiling.merge([str(tmp_path)], output, pstats_output) == 1
+    assert "handle (task_event.py:" in output.getvalue()
+    assert os.path.exists(pstats_output)
@@ -0,0 +1,116 @@
+import pytest
+from botocore.awsrequest import AWSResponse
+
+import rate_limit
+from aws_clients import ClientProvider
+from rate_limit import LocalCounter, RateLimiter, TokenBucket
+
+GET_CHANGE = (
+    b'<?xml version="1.0"?><GetChangeResponse xmlns="https://route53.amazonaws.com/doc/2013-04-01/">'
+    b"<ChangeInfo><Id>/change/C1</Id><Status>INSYNC</Status><SubmittedAt>2019-01-01T00:00:00Z</SubmittedAt>"
+    b"</ChangeInfo></GetChangeResponse>"
+)
+
+THROTTLED = (
+    b'<?xml version="1.0"?><ErrorResponse xmlns="https://route53.amazonaws.com/doc/2013-04-01/">'
+    b"<Error><Type>Sender</Type><Code>Throttling</Code><Message>Rate exceeded</Message></Error></ErrorResponse>"
+)
+
+
+class Raw(object):
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    a fake clock which advances on sleep.
+    """
+    now = [1000.0]
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    monkeypatch.setattr(rate_limit.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(rate_limit.time, "time", lambda: now[0])
+    monkeypatch.setattr(rate_limit.time, "sleep", sleep)
+    return now
+
+
+def test_token_bucket(clock):
+    bucket = TokenBucket(5)
+    for _ in range(5):
+        assert bucket.acquire() == 0
+    assert bucket.acquire() == pytest.approx(0.2)
+
+
+def test_token_bucket_adapts_to_throttling(clock):
+    bucket = TokenBucket(4)
+    bucket.throttled()
+    assert bucket.rate == 2
+    bucket.throttled()
+    bucket.throttled()
+    bucket.throttled()
+    assert bucket.rate == 0.5
+    for _ in range(20):
+        bucket.succeeded()
+    assert bucket.rate == 4
+
+
+def test_shared_counter(clock):
+    limiter = RateLimiter({"route53": 100}, LocalCounter())
+    limiter.limits["route53"] = 2
+    start = clock[0]
+    for _ in range(5):
+        limiter.acquire("route53")
+    assert 2 <= clock[0] - start < 3
+
+
+def test_shared_counter_leases_tokens(clock):
+    counter = LocalCounter()
+    calls = []
+    increment = counter.increment
+
+    def counted(key, expires, count=1):
+        calls.append(count)
+        return increment(key, expires, count)
+
+    counter.increment = counted
+    limiter = RateLimiter({"ecs": 100}, counter)
+    limiter.limits["ecs"] = 10
+    # another invocation took 8 tokens of the current second
+    counter.increment("ecs#{}".format(int(clock[0])), int(clock[0]) + 60, 8)
+    calls.clear()
+    start = clock[0]
+    for _ in range(4):
+        limiter.acquire("ecs")
+    # the first lease takes the last 2 tokens of the second, the next is granted in the next second
+    assert calls == [2, 2, 2]
+    assert 1 <= clock[0] - start < 2
+
+
+def test_parse_limits():
+    assert rate_limit.parse_limits("route53=5, ecs=20") == {"route53": 5.0, "ecs": 20.0}
+    assert rate_limit.parse_limits("") == {}
+
+
+def test_throttled_requests_are_retried(monkeypatch, clock):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test")
+    monkeypatch.setattr("botocore.retries.standard.random.random", lambda: 0.0, raising=False)
+    limiter = RateLimiter({"route53": 5})
+    route53 = ClientProvider(rate_limiter=limiter).get("route53")
+    responses = [(400, THROTTLED), (400, THROTTLED), (200, GET_CHANGE)]
+
+    def endpoint(request, **kwargs):
+        status, body = responses.pop(0)
+        return AWSResponse(request.url, status, {}, Raw(body))
+
+    route53.meta.events.register("before-send", endpoint)
+    assert route53.get_change(Id="C1")["ChangeInfo"]["Status"] == "INSYNC"
+    assert limiter.buckets["route53"].throttles == 2
+    assert limiter.buckets["route53"].rate == pytest.approx(1.75)
@@ -0,0 +1,274 @@
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+import reconcile
+import task_event
+from aws_clients import ClientProvider
+from record_index import record_index
+
+CLUSTER_ARN = "arn:aws:ecs:eu-central-1:1234567890:cluster/reconcile"
+TASK_DEFINITION_ARN = "arn:aws:ecs:eu-central-1:1234567890:task-definition/paas-monitor:25"
+TASK_IDS = ["5568b6f6-78ec-43b2-8c05-be3bc117c96e", "0123456789abcdef0123456789abcdef"]
+STALE_TASK_ID = "ffffffff-78ec-43b2-8c05-be3bc117c96e"
+
+
+def task(task_id, ip_address):
+    return {
+        "taskArn": "arn:aws:ecs:eu-central-1:1234567890:task/reconcile/{}".format(task_id),
+        "taskDefinitionArn": TASK_DEFINITION_ARN,
+        "lastStatus": "RUNNING",
+        "attachments": [
+            {
+                "type": "ElasticNetworkInterface",
+                "status": "ATTACHED",
+                "details": [
+                    {"name": "networkInterfaceId", "value": "eni-{}".format(task_id[:8])},
+                    {"name": "privateIPv4Address", "value": ip_address},
+                ],
+            }
+        ],
+    }
+
+
+def rr_set(task_id, ip_address):
+    return {
+        "Name": "paas-monitor.example.",
+        "Type": "A",
+        "SetIdentifier": task_id,
+        "Weight": 100,
+        "TTL": 30,
+        "ResourceRecords": [{"Value": ip_address}],
+    }
+
+
+def add_running_tasks(stubber: Stubber, tasks: list, task_definition_errors: tuple = (0, 0), cluster: str = CLUSTER_ARN):
+    """
+    adds the responses of listing and describing the running tasks to find the hosted zones,
+    and of listing them again after the records are listed, each followed by the given number
+    of throttled task definition lookups.
+    """
+    for i, errors in enumerate(task_definition_errors):
+        stubber.add_response(
+            "list_tasks",
+            {"taskArns": [t["taskArn"] for t in tasks]},
+            {"cluster": cluster, "desiredStatus": "RUNNING", "maxResults": 100},
+        )
+        if i == 0:
+            stubber.add_response("describe_tasks", {"tasks": tasks})
+        for _ in range(errors):
+            stubber.add_client_error("describe_task_definition", "ThrottlingException", http_status_code=400)
+
+
+def add_stopped_tasks(stubber: Stubber, task_ids: list):
+    tasks = [dict(task(i, ""), lastStatus="STOPPED") for i in task_ids]
+    stubber.add_response("describe_tasks", {"tasks": tasks})
+
+
+@pytest.fixture
+def stubbed():
+    provider = ClientProvider()
+    stubbers = {}
+    for name in ["ecs", "route53"]:
+        stubbers[name] = Stubber(provider.get(name))
+        stubbers[name].activate()
+    task_event.task_definition_cache.clear()
+    task_event.task_definition_cache.put(
+        TASK_DEFINITION_ARN, (task_event.DNSEntry("Z1", "paas-monitor.example.", False),)
+    )
+    record_index.records.clear()
+    stubbers["route53"].add_response(
+        "list_resource_record_sets",
+        {
+            "ResourceRecordSets": [
+                {"Name": "example.", "Type": "SOA", "TTL": 900, "ResourceRecords": [{"Value": "soa"}]},
+                rr_set(TASK_IDS[0], "10.0.0.1"),
+                rr_set(TASK_IDS[1], "10.0.0.3"),
+                rr_set(STALE_TASK_ID, "10.0.0.4"),
+                rr_set("manual", "10.0.0.5"),
+            ],
+            "IsTruncated": False,
+            "MaxItems": "100",
+        },
+    )
+    yield provider, stubbers
+    task_event.task_definition_cache.clear()
+    record_index.records.clear()
+    for stubber in stubbers.values():
+        stubber.assert_no_pending_responses()
+        stubber.deactivate()
+
+
+def test_dry_run(stubbed):
+    provider, stubbers = stubbed
+    add_running_tasks(stubbers["ecs"], [task(TASK_IDS[0], "10.0.0.1"), task(TASK_IDS[1], "10.0.0.2")])
+    add_stopped_tasks(stubbers["ecs"], [STALE_TASK_ID])
+    report = reconcile.reconcile([CLUSTER_ARN], dry_run=True, clients=provider)
+    assert report["hosted_zones"] == {
+        "Z1": [
+            {"Action": "UPSERT", "Name": "paas-monitor.example.", "SetIdentifier": TASK_IDS[1], "Value": "10.0.0.2"},
+            {"Action": "DELETE", "Name": "paas-monitor.example.", "SetIdentifier": STALE_TASK_ID, "Value": "10.0.0.4"},
+        ]
+    }
+
+
+def test_apply(stubbed):
+    provider, stubbers = stubbed
+    add_running_tasks(stubbers["ecs"], [task(TASK_IDS[0], "10.0.0.1"), task(TASK_IDS[1], "10.0.0.2")])
+    add_stopped_tasks(stubbers["ecs"], [STALE_TASK_ID])
+    stubbers["route53"].add_response(
+        "change_resource_record_sets",
+        {"ChangeInfo": {"Id": "/change/C1", "Status": "INSYNC", "SubmittedAt": "2019-01-01T00:00:00Z"}},
+        {
+            "HostedZoneId": "Z1",
+            "ChangeBatch": {
+                "Comment": "registration by ecs-dns-registrator",
+                "Changes": [
+                    {"Action": "UPSERT", "ResourceRecordSet": rr_set(TASK_IDS[1], "10.0.0.2")},
+                    {"Action": "DELETE", "ResourceRecordSet": rr_set(STALE_TASK_ID, "10.0.0.4")},
+                ],
+            },
+        },
+    )
+    reconcile.reconcile([CLUSTER_ARN], clients=provider)
+
+
+def test_task_without_ip_address_is_kept(stubbed):
+    provider, stubbers = stubbed
+    add_running_tasks(stubbers["ecs"], [task(TASK_IDS[0], "10.0.0.1"), task(TASK_IDS[1], "")])
+    add_stopped_tasks(stubbers["ecs"], [STALE_TASK_ID])
+    report = reconcile.reconcile([CLUSTER_ARN], dry_run=True, clients=provider)
+    assert report["hosted_zones"] == {
+        "Z1": [
+            {"Action": "DELETE", "Name": "paas-monitor.example.", "SetIdentifier": STALE_TASK_ID, "Value": "10.0.0.4"},
+        ]
+    }
+
+
+def test_task_definition_failure_keeps_records(stubbed):
+    provider, stubbers = stubbed
+    task_event.task_definition_cache.clear()
+    # described once to find the hosted zones, and once for each task
+    add_running_tasks(stubbers["ecs"], [task(TASK_IDS[0], "10.0.0.1"), task(TASK_IDS[1], "10.0.0.2")], (1, 2))
+    add_stopped_tasks(stubbers["ecs"], [STALE_TASK_ID])
+    report = reconcile.reconcile([CLUSTER_ARN], ["Z1"], dry_run=True, clients=provider)
+    assert report["hosted_zones"] == {
+        "Z1": [
+            {"Action": "DELETE", "Name": "paas-monitor.example.", "SetIdentifier": STALE_TASK_ID, "Value": "10.0.0.4"},
+        ]
+    }
+
+
+def test_unknown_task_is_deleted_under_registered_names(stubbed):
+    provider, stubbers = stubbed
+    running = [task(TASK_IDS[0], "10.0.0.1"), task(TASK_IDS[1], "10.0.0.3")]
+    add_running_tasks(stubbers["ecs"], running)
+    # tasks stopped more than an hour ago are no longer known
+    stubbers["ecs"].add_response("describe_tasks", {"tasks": [], "failures": [{"arn": STALE_TASK_ID, "reason": "MISSING"}]})
+    report = reconcile.reconcile([CLUSTER_ARN], dry_run=True, clients=provider)
+    assert report["hosted_zones"] == {
+        "Z1": [
+            {"Action": "DELETE", "Name": "paas-monitor.example.", "SetIdentifier": STALE_TASK_ID, "Value": "10.0.0.4"},
+        ]
+    }
+
+    # the other name may be registered by a cluster which is not reconciled
+    other = dict(rr_set(STALE_TASK_ID, "10.0.0.6"), Name="other.example.")
+    records = {
+        "ResourceRecordSets": [rr_set(TASK_IDS[0], "10.0.0.1"), rr_set(TASK_IDS[1], "10.0.0.3"), other],
+        "IsTruncated": False,
+        "MaxItems": "100",
+    }
+    stubbers["route53"].add_response("list_resource_record_sets", records)
+    add_running_tasks(stubbers["ecs"], running)
+    stubbers["ecs"].add_response("describe_tasks", {"tasks": [], "failures": [{"arn": STALE_TASK_ID, "reason": "MISSING"}]})
+    report = reconcile.reconcile([CLUSTER_ARN], dry_run=True, clients=provider)
+    assert report["hosted_zones"] == {"Z1": []}
+
+    stubbers["route53"].add_response("list_resource_record_sets", records)
+    add_running_tasks(stubbers["ecs"], running)
+    report = reconcile.reconcile([CLUSTER_ARN], dry_run=True, clients=provider, delete_unknown=True)
+    assert report["hosted_zones"] == {
+        "Z1": [
+            {"Action": "DELETE", "Name": "other.example.", "SetIdentifier": STALE_TASK_ID, "Value": "10.0.0.6"},
+        ]
+    }
+
+
+def test_task_started_during_reconciliation(stubbed):
+    provider, stubbers = stubbed
+    stubbers["ecs"].add_response(
+        "list_tasks",
+        {"taskArns": [task(TASK_IDS[0], "")["taskArn"]]},
+        {"cluster": CLUSTER_ARN, "desiredStatus": "RUNNING", "maxResults": 100},
+    )
+    stubbers["ecs"].add_response("describe_tasks", {"tasks": [task(TASK_IDS[0], "10.0.0.1")]})
+    stubbers["ecs"].add_response(
+        "list_tasks",
+        {"taskArns": [task(i, "")["taskArn"] for i in TASK_IDS]},
+        {"cluster": CLUSTER_ARN, "desiredStatus": "RUNNING", "maxResults": 100},
+    )
+    # only the started task is described
+    started = task(TASK_IDS[1], "10.0.0.3")
+    stubbers["ecs"].add_response("describe_tasks", {"tasks": [started]}, {"cluster": CLUSTER_ARN, "tasks": [started["taskArn"]]})
+    add_stopped_tasks(stubbers["ecs"], [STALE_TASK_ID])
+    report = reconcile.reconcile([CLUSTER_ARN], dry_run=True, clients=provider)
+    assert report["hosted_zones"] == {
+        "Z1": [
+            {"Action": "DELETE", "Name": "paas-monitor.example.", "SetIdentifier": STALE_TASK_ID, "Value": "10.0.0.4"},
+        ]
+    }
+
+
+def test_cluster_in_other_region_and_account(stubbed, monkeypatch):
+    provider, stubbers = stubbed
+    cluster = "arn:aws:ecs:us-east-1:210987654321:cluster/remote"
+    role_arn = "arn:aws:iam::210987654321:role/registrator"
+    monkeypatch.setattr(task_event, "account_roles", {"210987654321": role_arn})
+    ecs = boto3.client("ecs", region_name="us-east-1")
+    provider.set("ecs", ecs, "us-east-1", role_arn)
+    provider.set("ec2", boto3.client("ec2", region_name="us-east-1"), "us-east-1", role_arn)
+    with Stubber(ecs) as stubber:
+        add_running_tasks(stubber, [task(TASK_IDS[0], "10.0.0.1"), task(TASK_IDS[1], "10.0.0.3")], cluster=cluster)
+        add_stopped_tasks(stubber, [STALE_TASK_ID])
+        report = reconcile.reconcile([cluster], dry_run=True, clients=provider)
+        stubber.assert_no_pending_responses()
+    assert report["hosted_zones"] == {
+        "Z1": [
+            {"Action": "DELETE", "Name": "paas-monitor.example.", "SetIdentifier": STALE_TASK_ID, "Value": "10.0.0.4"},
+        ]
+    }
+
+
+def test_managed_records():
+    srv = dict(rr_set(TASK_IDS[0], "1 1 32768 host.example."), Name="_http._tcp.paas-monitor.example.", Type="SRV")
+    assert reconcile.is_managed_record(rr_set(TASK_IDS[0], "10.0.0.1"))
+    assert reconcile.is_managed_record(srv)
+    assert not reconcile.is_managed_record(rr_set("manual", "10.0.0.1"))
+    assert reconcile.get_key(srv) == ("_http._tcp.paas-monitor.example.", "SRV", TASK_IDS[0])
+
+
+def test_aggregated_records():
+    desired = {}
+    entry = task_event.DNSEntry("Z1", "aggregate.example.", False, True)
+    for ip_address in ["10.0.0.2", "10.0.0.1", "10.0.0.2"]:
+        reconcile.add_aggregated_value(desired, entry, ip_address)
+    assert desired[("aggregate.example.", "A", None)]["ResourceRecords"] == [{"Value": "10.0.0.1"}, {"Value": "10.0.0.2"}]
+
+    actual = {"Name": "aggregate.example.", "Type": "A", "TTL": 30, "ResourceRecords": [{"Value": "10.0.0.3"}]}
+    assert reconcile.is_aggregated_record(actual, {"aggregate.example."})
+    assert not reconcile.is_aggregated_record(actual, {"other.example."})
+    assert not reconcile.is_aggregated_record(rr_set(TASK_IDS[0], "10.0.0.1"), {"paas-monitor.example."})
+
+    changes = reconcile.get_changes(desired, {reconcile.get_key(actual): actual})
+    assert changes == [{"Action": "UPSERT", "ResourceRecordSet": desired[("aggregate.example.", "A", None)]}]
+
+    actual["ResourceRecords"] = [{"Value": "10.0.0.2"}, {"Value": "10.0.0.1"}]
+    assert reconcile.get_changes(desired, {reconcile.get_key(actual): actual}) == []
+
+    # an aggregated record missing the ip address of a task, or of a task whose task definition
+    # could not be described, is left as it is
+    actual["ResourceRecords"] = [{"Value": "10.0.0.3"}]
+    assert reconcile.get_changes(desired, {reconcile.get_key(actual): actual}, {("aggregate.example.", "A", None)}) == []
+    assert reconcile.get_changes(desired, {reconcile.get_key(actual): actual}, {None}) == []
+
@@ -0,0 +1,120 @@
+import sqlite3
+
+import pytest
+from botocore.stub import Stubber
+
+import cache
+import record_index
+from aws_clients import ClientProvider
+from record_index import RecordIndex, SQLiteStore
+
+
+def rr_set(set_identifier, ip_address="10.0.0.1"):
+    return {
+        "Name": "paas-monitor.example.",
+        "Type": "A",
+        "SetIdentifier": set_identifier,
+        "Weight": 100,
+        "TTL": 30,
+        "ResourceRecords": [{"Value": ip_address}],
+    }
+
+
+@pytest.fixture
+def route53():
+    client = ClientProvider().get("route53")
+    with Stubber(client) as stubber:
+        yield client, stubber
+        stubber.assert_no_pending_responses()
+
+
+def test_lookup(route53):
+    client, stubber = route53
+    stubber.add_response(
+        "list_resource_record_sets",
+        {"ResourceRecordSets": [rr_set("t1")], "IsTruncated": True, "MaxItems": "1"},
+        {
+            "HostedZoneId": "Z1",
+            "StartRecordName": "paas-monitor.example.",
+            "StartRecordType": "A",
+            "StartRecordIdentifier": "t1",
+            "MaxItems": "1",
+        },
+    )
+    index = RecordIndex()
+    assert index.lookup(client, "Z1", "paas-monitor.example.", "A", "t1") == rr_set("t1")
+    assert index.lookup(client, "Z1", "paas-monitor.example.", "A", "t1") == rr_set("t1")
+
+
+def test_lookup_missing(route53):
+    client, stubber = route53
+    stubber.add_response(
+        "list_resource_record_sets", {"ResourceRecordSets": [rr_set("t2")], "IsTruncated": True, "MaxItems": "1"}
+    )
+    assert RecordIndex().lookup(client, "Z1", "paas-monitor.example.", "A", "t1") is None
+
+
+def test_update(route53):
+    client, stubber = route53
+    index = RecordIndex()
+    index.update("Z1", [{"Action": "UPSERT", "ResourceRecordSet": rr_set("t1")}])
+    assert index.lookup(client, "Z1", "paas-monitor.example.", "A", "t1") == rr_set("t1")
+
+    index.update("Z1", [{"Action": "DELETE", "ResourceRecordSet": rr_set("t1")}])
+    stubber.add_response(
+        "list_resource_record_sets", {"ResourceRecordSets": [], "IsTruncated": False, "MaxItems": "1"}
+    )
+    assert index.lookup(client, "Z1", "paas-monitor.example.", "A", "t1") is None
+
+
+def test_is_current():
+    index = RecordIndex()
+    assert not index.is_current("Z1", rr_set("t1"))
+    index.update("Z1", [{"Action": "UPSERT", "ResourceRecordSet": rr_set("t1")}])
+    assert index.is_current("Z1", rr_set("t1"))
+    assert not index.is_current("Z1", rr_set("t1", "10.0.0.2"))
+    assert not index.is_current("Z2", rr_set("t1"))
+
+
+def test_sqlite_store(route53, tmp_path):
+    client, _ = route53
+    path = str(tmp_path / "records.db")
+    index = RecordIndex(store=SQLiteStore(path))
+    index.update("Z1", [{"Action": "UPSERT", "ResourceRecordSet": rr_set("t1")}])
+    index.update("Z1", [{"Action": "UPSERT", "ResourceRecordSet": rr_set("t2")}])
+    index.update("Z1", [{"Action": "DELETE", "ResourceRecordSet": rr_set("t2")}])
+
+    index = RecordIndex(store=SQLiteStore(path))
+    assert len(index.records) == 1
+    assert index.is_current("Z1", rr_set("t1"))
+    assert index.lookup(client, "Z1", "paas-monitor.example.", "A", "t1") == rr_set("t1")
+
+    index.records.clear()
+    assert len(index.records) == 0
+
+
+def test_entries_expire_for_updates_only(monkeypatch, tmp_path, route53):
+    client, _ = route53
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(record_index.time, "time", lambda: now[0])
+    for index in [RecordIndex(ttl=300), RecordIndex(store=SQLiteStore(str(tmp_path / "records.db")), ttl=300)]:
+        index.update("Z1", [{"Action": "UPSERT", "ResourceRecordSet": rr_set("t1")}])
+        now[0] += 300
+        assert index.is_current("Z1", rr_set("t1"))
+        now[0] += 1
+        # the record may have been changed outside of the registrator
+        assert not index.is_current("Z1", rr_set("t1"))
+        # but is still deleted without a lookup, a stale entry fails the DELETE
+        assert index.lookup(client, "Z1", "paas-monitor.example.", "A", "t1") == rr_set("t1")
+
+
+def test_sqlite_store_without_expiry_is_replaced(tmp_path):
+    path = str(tmp_path / "records.db")
+    with sqlite3.connect(path) as connection:
+        connection.execute("CREATE TABLE records (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        connection.execute("INSERT INTO records VALUES ('[]', '{}')")
+    store = SQLiteStore(path)
+    assert len(store) == 0
+    store.put(("Z1",), rr_set("t1"))
+    assert store.get(("Z1",)) == rr_set("t1")
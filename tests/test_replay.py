@@ -0,0 +1,69 @@
+import json
+import time
+
+import aws_clients
+import replay
+from replay import Capture, Replay
+
+
+def capture_scenario(path, tasks=20, rate=1000.0):
+    capture = Capture(str(path))
+    replay.capture_scenario(capture, "rolling_deploy", tasks, rate)
+    capture.close()
+    return str(path)
+
+
+def test_capture(tmp_path):
+    path = capture_scenario(tmp_path / "capture.jsonl.gz")
+    items = list(replay.read_capture(path))
+    assert [i["type"] for i in items].count("task_definition") == 2
+    events = [i for i in items if i["type"] == "event"]
+    assert len(events) == 100
+    assert abs(events[1]["time"] - events[0]["time"] - 0.001) < 1e-6
+
+
+def test_capture_files(tmp_path):
+    source = tmp_path / "events.jsonl"
+    source.write_text(json.dumps({"time": "2019-01-01T00:00:00Z", "detail": {}}) + "\n\n")
+    capture = Capture(str(tmp_path / "capture.jsonl.gz"))
+    replay.capture_files(capture, [str(source)])
+    capture.close()
+    assert capture.events == 1
+
+
+def test_replay(monkeypatch, tmp_path):
+    monkeypatch.setattr(aws_clients, "clients", aws_clients.clients)
+    path = capture_scenario(tmp_path / "capture.jsonl.gz")
+
+    flat_out = Replay(path).run(speed=0.0, concurrency=4)
+    assert flat_out["events"] == 100
+    assert flat_out["failures"] == 0
+    assert flat_out["records"] == {"ZBENCHMARK": 20}
+
+    batched = Replay(path).run(speed=0.0, mode="batch", batch_size=10)
+    assert batched["failures"] == 0
+    assert batched["dns_state_digest"] == flat_out["dns_state_digest"]
+    assert batched["calls"] < flat_out["calls"]
+
+
+def test_replay_at_original_timing(monkeypatch, tmp_path):
+    monkeypatch.setattr(aws_clients, "clients", aws_clients.clients)
+    path = capture_scenario(tmp_path / "capture.jsonl.gz", tasks=2, rate=50.0)
+
+    start = time.perf_counter()
+    report = Replay(path).run(speed=2.0)
+    assert time.perf_counter() - start >= 9 / 50.0 / 2
+    assert report["records"] == {"ZBENCHMARK": 2}
+
+
+def test_replay_uncaptured_task_definition(monkeypatch, tmp_path):
+    monkeypatch.setattr(aws_clients, "clients", aws_clients.clients)
+    path = tmp_path / "capture.jsonl.gz"
+    items = [i for i in replay.read_capture(capture_scenario(path, tasks=1)) if i["type"] == "event"]
+    capture = Capture(str(path))
+    for item in items:
+        capture.add_event(item["event"], item["time"])
+    capture.close()
+
+    report = Replay(str(path)).run(speed=0.0)
+    assert report["records"] == {"ZREPLAY": 1}
@@ -0,0 +1,132 @@
+import json
+import time
+from datetime import datetime, timezone
+
+import pytest
+from botocore.stub import Stubber
+
+import route53_changes
+from aws_clients import ClientProvider
+from route53_changes import BoundedWait, DeferredVerification, FireAndForget, InProcessChangeQueue
+
+
+def change(status):
+    return {"ChangeInfo": {"Id": "/change/C1", "Status": status, "SubmittedAt": datetime.now(timezone.utc)}}
+
+
+@pytest.fixture
+def route53(monkeypatch):
+    provider = ClientProvider()
+    monkeypatch.setattr(route53_changes.aws_clients, "clients", provider)
+    monkeypatch.setattr(route53_changes.time, "sleep", lambda seconds: None)
+    client = provider.get("route53")
+    with Stubber(client) as stubber:
+        yield client, stubber
+        stubber.assert_no_pending_responses()
+
+
+def test_fire_and_forget(route53):
+    client, _ = route53
+    FireAndForget()(client, change("PENDING"))
+
+
+def test_bounded_wait(route53):
+    client, stubber = route53
+    stubber.add_response("get_change", change("PENDING"), {"Id": "C1"})
+    stubber.add_response("get_change", change("INSYNC"), {"Id": "C1"})
+    count = route53_changes.propagation_stats.stats()["count"]
+    BoundedWait()(client, change("PENDING"))
+    assert route53_changes.propagation_stats.stats()["count"] == count + 1
+
+
+def test_bounded_wait_gives_up(route53, monkeypatch):
+    client, stubber = route53
+    now = [0.0]
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    monkeypatch.setattr(route53_changes.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(route53_changes.time, "sleep", sleep)
+    monkeypatch.setattr(route53_changes.random, "uniform", lambda a, b: b)
+    for _ in range(3):
+        stubber.add_response("get_change", change("PENDING"))
+    BoundedWait(max_wait=10, initial_delay=2, max_delay=4)(client, change("PENDING"))
+    assert now[0] == 10
+
+
+def test_deferred_verification_in_process(route53):
+    client, stubber = route53
+    queue = InProcessChangeQueue()
+    completion = DeferredVerification(queue)
+    completion(client, change("PENDING"))
+    assert "C1" in queue.pending
+
+    stubber.add_response("get_change", change("PENDING"), {"Id": "C1"})
+    completion.verify_pending()
+    assert "C1" in queue.pending
+
+    stubber.add_response("get_change", change("INSYNC"), {"Id": "C1"})
+    completion.verify_pending()
+    assert not queue.pending
+
+
+def test_deferred_verification_errors(route53, monkeypatch):
+    client, stubber = route53
+    queue = InProcessChangeQueue(max_age=60)
+    queue.put("C1", time.time(), client)
+    queue.put("C2", time.time(), client)
+    queue.put("C3", time.time() - 120, client)
+    stubber.add_client_error("get_change", "NoSuchChange", http_status_code=404, expected_params={"Id": "C1"})
+    stubber.add_client_error("get_change", "Throttling", http_status_code=400, expected_params={"Id": "C2"})
+    stubber.add_response("get_change", change("PENDING"), {"Id": "C3"})
+    queue.verify()
+    assert list(queue.pending.keys()) == ["C2"]
+
+    monkeypatch.setattr(route53_changes.time, "time", lambda: queue.pending["C2"][1] + 61)
+    stubber.add_client_error("get_change", "Throttling", http_status_code=400, expected_params={"Id": "C2"})
+    queue.verify()
+    assert not queue.pending
+
+
+def test_sqs_queue_errors_do_not_fail(route53):
+    client, _ = route53
+    queue_url = "https://sqs.eu-central-1.amazonaws.com/1234567890/changes"
+    sqs = route53_changes.aws_clients.clients.get("sqs")
+    with Stubber(sqs) as stubber:
+        stubber.add_client_error("send_message", "AccessDenied", http_status_code=403)
+        DeferredVerification(route53_changes.SQSChangeQueue(queue_url))(client, change("PENDING"))
+        stubber.assert_no_pending_responses()
+
+
+def test_change_completion_is_abstract():
+    with pytest.raises(TypeError):
+        route53_changes.ChangeCompletion()
+
+
+def test_verification_handler(route53):
+    _, stubber = route53
+    stubber.add_response("get_change", change("INSYNC"), {"Id": "C1"})
+    stubber.add_response("get_change", change("PENDING"), {"Id": "C2"})
+    stubber.add_client_error("get_change", "NoSuchChange", http_status_code=404, expected_params={"Id": "C3"})
+    stubber.add_client_error("get_change", "Throttling", http_status_code=400, expected_params={"Id": "C4"})
+    event = {
+        "Records": [
+            {"messageId": "m{}".format(i), "body": json.dumps({"ChangeId": "C{}".format(i), "SubmittedAt": 0})}
+            for i in range(1, 5)
+        ]
+    }
+    assert route53_changes.handler(event, None) == {
+        "batchItemFailures": [{"itemIdentifier": "m2"}, {"itemIdentifier": "m4"}]
+    }
+
+
+def test_from_environment(monkeypatch):
+    monkeypatch.setenv("ROUTE53_CHANGE_COMPLETION", "none")
+    assert isinstance(route53_changes.from_environment(), FireAndForget)
+    monkeypatch.setenv("ROUTE53_CHANGE_COMPLETION", "deferred")
+    assert isinstance(route53_changes.from_environment().queue, InProcessChangeQueue)
+    monkeypatch.setenv("ROUTE53_CHANGE_QUEUE_URL", "https://sqs.eu-central-1.amazonaws.com/1234567890/changes")
+    assert isinstance(route53_changes.from_environment().queue, route53_changes.SQSChangeQueue)
+    monkeypatch.delenv("ROUTE53_CHANGE_COMPLETION")
+    assert route53_changes.from_environment().max_wait == 120
@@ -0,0 +1,57 @@
+import aws_clients
+import scenarios
+
+
+def test_scenarios(monkeypatch):
+    monkeypatch.setattr(aws_clients, "clients", aws_clients.clients)
+    for name, (create, _) in scenarios.SCENARIOS.items():
+        for mode in ["event", "batch"]:
+            result = scenarios.run(name, create, 5, 0.0, 0.0, mode, 10)
+            assert result["failures"] == 0, name
+            assert result["calls"] > 0, name
+
+
+def test_metrics_are_not_written_by_default(monkeypatch, capsys):
+    import metrics
+
+    monkeypatch.setattr(aws_clients, "clients", aws_clients.clients)
+    monkeypatch.setattr(metrics.collector, "enabled", True)
+    scenarios.run("single_task", scenarios.single_task, 1, 0.0, 0.0, "event", 10)
+    assert "_aws" not in capsys.readouterr().out
+    assert metrics.collector.enabled
+
+    scenarios.run("single_task", scenarios.single_task, 1, 0.0, 0.0, "event", 10, emit_metrics=True)
+    assert "_aws" in capsys.readouterr().out
+
+
+def test_rolling_deploy_records(monkeypatch):
+    monkeypatch.setattr(aws_clients, "clients", aws_clients.clients)
+    result = scenarios.run("rolling_deploy", scenarios.rolling_deploy, 10, 0.0, 0.0, "batch", 10)
+    assert result["records"] == 10
+
+
+def test_throttled_calls_are_retried(monkeypatch):
+    monkeypatch.setattr(aws_clients, "clients", aws_clients.clients)
+    monkeypatch.setattr("botocore.endpoint.time.sleep", lambda seconds: None)
+    monkeypatch.setattr("random.random", lambda: 0.1)
+    result = scenarios.run("single_task", scenarios.single_task, 1, 0.0, 0.2, "event", 10)
+    assert result["throttled"] == result["calls"]
+    assert result["calls"] > len(result["calls_by_operation"])
+    assert result["records"] == 0
+
+
+def test_timed_run_is_not_traced(monkeypatch):
+    import tracemalloc
+
+    monkeypatch.setattr(aws_clients, "clients", aws_clients.clients)
+    replay = scenarios.replay
+    tracing = []
+
+    def traced_replay(events, mode, batch_size):
+        tracing.append(tracemalloc.is_tracing())
+        return replay(events, mode, batch_size)
+
+    monkeypatch.setattr(scenarios, "replay", traced_replay)
+    result = scenarios.run("single_task", scenarios.single_task, 1, 0.0, 0.0, "event", 10)
+    assert tracing == [False, True]
+    assert result["peak_memory_kb"] > 0
@@ -0,0 +1,125 @@
+import asyncio
+import json
+
+import pytest
+
+from fake_aws import FakeAWS
+from service import FileSource, Service
+
+CLUSTER_ARN = "arn:aws:ecs:eu-central-1:123456789012:cluster/service"
+TASK_DEFINITION_ARN = "arn:aws:ecs:eu-central-1:123456789012:task-definition/service:1"
+LABELS = {"DNSHostedZoneId": "Z1", "DNSName": "service.example", "DNSRegisterPublicIp": "false"}
+
+
+@pytest.fixture
+def fake(fake_aws):
+    fake, _ = fake_aws
+    fake.add_task_definition(TASK_DEFINITION_ARN, [{"name": "app", "dockerLabels": LABELS}])
+    return fake
+
+
+@pytest.fixture
+def provider(fake_aws):
+    _, provider = fake_aws
+    return provider
+
+
+def task_arn(i: int) -> str:
+    return "arn:aws:ecs:eu-central-1:123456789012:task/service/{:032x}".format(i)
+
+
+def write_events(path, events):
+    with open(str(path), "w") as f:
+        for event in events:
+            f.write(json.dumps(event) + "\n")
+    return str(path)
+
+
+def test_registers_all_events(fake, provider, tmp_path):
+    events = []
+    for i in range(50):
+        fake.add_task(CLUSTER_ARN, task_arn(i), TASK_DEFINITION_ARN, "10.0.0.{}".format(i))
+        events.append(fake.event(task_arn(i)))
+    path = write_events(tmp_path / "events.jsonl", events)
+
+    service = Service(FileSource(path), provider, concurrency=10, zone_concurrency=2)
+    asyncio.run(service.run())
+
+    assert service.processed == 50
+    assert service.failed == 0
+    assert len(fake.records("Z1")) == 50
+    assert fake.calls["ecs.DescribeTaskDefinition"] <= 10
+    assert not service.tracking
+
+
+def test_events_of_a_task_are_processed_in_order(fake, provider, tmp_path):
+    fake.add_task(CLUSTER_ARN, task_arn(1), TASK_DEFINITION_ARN, "10.0.0.1")
+    running = fake.event(task_arn(1))
+    fake.stop_task(task_arn(1))
+    stopped = fake.event(task_arn(1))
+    path = write_events(tmp_path / "events.jsonl", [running, stopped, running])
+
+    service = Service(FileSource(path), provider)
+    asyncio.run(service.run())
+
+    assert service.processed == 3
+    assert fake.records("Z1") == []
+
+
+def test_invalid_events_are_skipped(fake, provider, tmp_path):
+    path = tmp_path / "events.jsonl"
+    path.write_text('not json\n\n{"detail-type": "EC2 Instance State-change Notification"}\n')
+
+    service = Service(FileSource(str(path)), provider)
+    asyncio.run(service.run())
+
+    assert service.processed == 1
+    assert sum(fake.calls.values()) == 0
+
+
+class EndlessSource(object):
+    """
+    returns events forever, and records the acknowledged items.
+    """
+
+    def __init__(self, fake: FakeAWS):
+        self.fake = fake
+        self.exhausted = False
+        self.received = 0
+        self.acknowledged = []
+
+    async def receive(self):
+        items = []
+        for _ in range(5):
+            self.received += 1
+            self.fake.add_task(CLUSTER_ARN, task_arn(self.received), TASK_DEFINITION_ARN, "10.0.1.1")
+            items.append((str(self.received), self.fake.event(task_arn(self.received))))
+        await asyncio.sleep(0)
+        return items
+
+    async def acknowledge(self, item_id):
+        self.acknowledged.append(item_id)
+
+    async def flush(self):
+        pass
+
+
+def test_stop_drains_events_in_flight(fake, provider):
+    fake.propagation_delay = 0.2
+    source = EndlessSource(fake)
+    service = Service(source, provider, max_wait=5)
+
+    async def stop_later():
+        await asyncio.sleep(0.2)
+        service.stop()
+
+    async def run():
+        await asyncio.gather(service.run(), stop_later())
+
+    asyncio.run(run())
+
+    assert source.received > 0
+    assert len(source.acknowledged) == source.received
+    assert len(fake.records("Z1")) == source.received
+    assert not service.in_flight
+    assert not service.tracking
@@ -1,9 +1,19 @@
+import gc
+import json
+import logging
+import threading
+import tracemalloc
 from uuid import uuid4
 
 import boto3
 import pytest
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
 
-from task_event import DNSEntry, DNSRegistrator, wait_for_route53_change_completion
+import task_event
+from aws_clients import ClientProvider
+from record_index import record_index
+from task_event import DNSEntry, DNSRegistrator, EniView, TaskView, wait_for_route53_change_completion
 
 __data = {
     "task_definition": {
@@ -242,7 +252,7 @@ def hosted_zone():
 
 def test_get_ip_addresses():
     registrator = DNSRegistrator("task-arn", "cluster-arn", "task-definition-arn")
-    registrator.network_interfaces = __data["network_interfaces"].copy()
+    registrator.network_interfaces = [EniView.from_network_interface(n) for n in __data["network_interfaces"]]
 
     ip_addresses = registrator.get_ip_addresses(True)
     assert ["18.194.71.107", "18.184.214.52"] == ip_addresses
@@ -257,7 +267,7 @@ def test_get_network_interface():
         __data["task"]["clusterArn"],
         __data["task"]["taskDefinitionArn"],
     )
-    registrator.task = __data["task"].copy()
+    registrator.task = TaskView.from_task(__data["task"])
     registrator.get_network_interfaces()
 
 
@@ -283,9 +293,7 @@ def test_get_dns_entries():
         __data["task"]["clusterArn"],
         __data["task"]["taskDefinitionArn"],
     )
-    registrator.task_definition = __data["task_definition"].copy()
-
-    registrator.get_dns_entries()
+    registrator.get_dns_entries(__data["task_definition"])
     assert registrator.dns_entries
     assert registrator.dns_entry.hosted_zone_id == "Z3AUN8X7OGVNVQ"
     assert registrator.dns_entry.name == "paas-monitor.fargate.example."
@@ -301,7 +309,7 @@ def test_get_task():
 
     # will not find the specified task
     registrator.get_task()
-    assert {} == registrator.task
+    assert registrator.task is None
 
 
 def test_get_task_definition():
@@ -313,7 +321,7 @@ def test_get_task_definition():
 
     # will not find the specified task
     registrator.get_task_definition()
-    assert {} == registrator.task
+    assert registrator.task is None
 
 
 def test_register_dns_entry(hosted_zone):
@@ -323,11 +331,511 @@ def test_register_dns_entry(hosted_zone):
         __data["task"]["taskDefinitionArn"],
     )
 
-    registrator.task = __data["task"].copy()
-    registrator.task_definition = __data["task_definition"].copy()
-    registrator.get_dns_entries()
+    registrator.task = TaskView.from_task(__data["task"])
+    registrator.get_dns_entries(__data["task_definition"])
     registrator.dns_entry = DNSEntry(hosted_zone, registrator.dns_entry.name, True)
     registrator.register_dns_entry("1.1.1.1")
     rr_set = registrator.get_resource_record_set()
     assert rr_set is not None
     registrator.deregister_dns_entry()
+
+
+@pytest.fixture
+def stubbed():
+    """
+    a client provider with stubbed ecs, ec2 and route53 clients.
+    """
+    provider = ClientProvider()
+    stubbers = {}
+    for name in ["ecs", "ec2", "route53"]:
+        stubbers[name] = Stubber(provider.get(name))
+        stubbers[name].activate()
+    task_event.task_definition_cache.clear()
+    record_index.records.clear()
+    yield provider, stubbers
+    task_event.task_definition_cache.clear()
+    record_index.records.clear()
+    for stubber in stubbers.values():
+        stubber.assert_no_pending_responses()
+        stubber.deactivate()
+
+
+def test_task_definition_cache(stubbed):
+    provider, stubbers = stubbed
+    stubbers["ecs"].add_response(
+        "describe_task_definition",
+        {"taskDefinition": __data["task_definition"]},
+        {"taskDefinition": __data["task"]["taskDefinitionArn"]},
+    )
+    for _ in range(2):
+        registrator = DNSRegistrator(
+            __data["task"]["taskArn"],
+            __data["task"]["clusterArn"],
+            __data["task"]["taskDefinitionArn"],
+            provider,
+        )
+        registrator.get_task_definition()
+        assert registrator.dns_entry.name == "paas-monitor.fargate.example."
+
+    assert task_event.task_definition_cache.hits == 1
+    assert task_event.task_definition_cache.misses == 1
+
+
+def test_task_definition_cache_unlabelled(stubbed):
+    provider, stubbers = stubbed
+    task_definition = {
+        "taskDefinitionArn": "arn:aws:ecs:eu-central-1:1234567890:task-definition/unlabelled:1",
+        "containerDefinitions": [{"name": "unlabelled"}],
+    }
+    stubbers["ecs"].add_response("describe_task_definition", {"taskDefinition": task_definition})
+    for _ in range(3):
+        registrator = DNSRegistrator(
+            __data["task"]["taskArn"],
+            __data["task"]["clusterArn"],
+            task_definition["taskDefinitionArn"],
+            provider,
+            task=__data["task"],
+        )
+        registrator.handle("RUNNING", "RUNNING")
+        assert registrator.dns_entry is None
+
+    assert task_event.task_definition_cache.stats() == {"size": 1, "hits": 2, "misses": 1}
+
+
+def task_definition_with_labels(**labels):
+    task_definition = __data["task_definition"].copy()
+    task_definition["containerDefinitions"] = [{"name": "paas-monitor", "dockerLabels": labels}]
+    return task_definition
+
+
+def task_network_interface():
+    return dict(__data["network_interfaces"][1], NetworkInterfaceId="eni-9890d6c7")
+
+
+def test_register_private_ip_from_event(stubbed):
+    provider, stubbers = stubbed
+    stubbers["ecs"].add_response(
+        "describe_task_definition",
+        {
+            "taskDefinition": task_definition_with_labels(
+                DNSHostedZoneId="Z3AUN8X7OGVNVQ", DNSName="paas-monitor.fargate.example", DNSRegisterPublicIp="false"
+            )
+        },
+    )
+    stubbers["route53"].add_response(
+        "change_resource_record_sets",
+        {"ChangeInfo": {"Id": "/change/C1", "Status": "INSYNC", "SubmittedAt": "2019-01-01T00:00:00Z"}},
+        {
+            "HostedZoneId": "Z3AUN8X7OGVNVQ",
+            "ChangeBatch": {
+                "Comment": "registration by ecs-dns-registrator",
+                "Changes": [
+                    {
+                        "Action": "UPSERT",
+                        "ResourceRecordSet": {
+                            "Name": "paas-monitor.fargate.example.",
+                            "Type": "A",
+                            "SetIdentifier": "5568b6f6-78ec-43b2-8c05-be3bc117c96e",
+                            "Weight": 100,
+                            "TTL": 30,
+                            "ResourceRecords": [{"Value": "172.31.93.207"}],
+                        },
+                    }
+                ],
+            },
+        },
+    )
+    task = __data["task"]
+    registrator = DNSRegistrator(task["taskArn"], task["clusterArn"], task["taskDefinitionArn"], provider, task=task)
+    registrator.handle("RUNNING", "RUNNING")
+
+
+def test_register_public_ip_from_event(stubbed):
+    provider, stubbers = stubbed
+    stubbers["ecs"].add_response(
+        "describe_task_definition", {"taskDefinition": __data["task_definition"]}
+    )
+    stubbers["ec2"].add_response(
+        "describe_network_interfaces",
+        {"NetworkInterfaces": [task_network_interface()]},
+        {"Filters": [{"Name": "network-interface-id", "Values": ["eni-9890d6c7"]}]},
+    )
+    stubbers["route53"].add_response(
+        "change_resource_record_sets",
+        {"ChangeInfo": {"Id": "/change/C1", "Status": "INSYNC", "SubmittedAt": "2019-01-01T00:00:00Z"}},
+    )
+    task = __data["task"]
+    registrator = DNSRegistrator(task["taskArn"], task["clusterArn"], task["taskDefinitionArn"], provider, task=task)
+    registrator.handle("RUNNING", "RUNNING")
+
+
+def test_incomplete_event_falls_back_to_describe_tasks(stubbed):
+    provider, stubbers = stubbed
+    stubbers["ecs"].add_response(
+        "describe_task_definition",
+        {
+            "taskDefinition": task_definition_with_labels(
+                DNSHostedZoneId="Z3AUN8X7OGVNVQ", DNSName="paas-monitor.fargate.example", DNSRegisterPublicIp="false"
+            )
+        },
+    )
+    stubbers["ecs"].add_response("describe_tasks", {"tasks": [__data["task"]]})
+    task = {k: v for k, v in __data["task"].items() if k != "attachments"}
+    registrator = DNSRegistrator(task["taskArn"], task["clusterArn"], task["taskDefinitionArn"], provider, task=task)
+    registrator.get_task_definition()
+    assert ["172.31.93.207"] == registrator.resolve_ip_addresses(False)
+
+
+def test_deregister_from_event(stubbed):
+    provider, stubbers = stubbed
+    rr_set = {
+        "Name": "paas-monitor.fargate.example.",
+        "Type": "A",
+        "SetIdentifier": "5568b6f6-78ec-43b2-8c05-be3bc117c96e",
+        "Weight": 100,
+        "TTL": 30,
+        "ResourceRecords": [{"Value": "172.31.93.207"}],
+    }
+    stubbers["ecs"].add_response("describe_task_definition", {"taskDefinition": __data["task_definition"]})
+    stubbers["route53"].add_response(
+        "list_resource_record_sets",
+        {"ResourceRecordSets": [rr_set], "IsTruncated": False, "MaxItems": "1"},
+        {
+            "HostedZoneId": "Z3AUN8X7OGVNVQ",
+            "StartRecordName": "paas-monitor.fargate.example.",
+            "StartRecordType": "A",
+            "StartRecordIdentifier": "5568b6f6-78ec-43b2-8c05-be3bc117c96e",
+            "MaxItems": "1",
+        },
+    )
+    stubbers["route53"].add_response(
+        "change_resource_record_sets",
+        {"ChangeInfo": {"Id": "/change/C1", "Status": "INSYNC", "SubmittedAt": "2019-01-01T00:00:00Z"}},
+        {
+            "HostedZoneId": "Z3AUN8X7OGVNVQ",
+            "ChangeBatch": {
+                "Comment": "deregistration by ecs-dns-registrator",
+                "Changes": [{"Action": "DELETE", "ResourceRecordSet": rr_set}],
+            },
+        },
+    )
+    task = __data["task"]
+    registrator = DNSRegistrator(task["taskArn"], task["clusterArn"], task["taskDefinitionArn"], provider, task=task)
+    registrator.handle("STOPPED", "STOPPED")
+
+
+def test_register_all_dns_entries(stubbed):
+    provider, stubbers = stubbed
+    task_definition = __data["task_definition"].copy()
+    task_definition["containerDefinitions"] = [
+        {"name": "app", "dockerLabels": {"DNSHostedZoneId": "Z1", "DNSName": "a.example", "DNSRegisterPublicIp": "false"}},
+        {"name": "sidecar", "dockerLabels": {"DNSHostedZoneId": "Z1", "DNSName": "b.example", "DNSRegisterPublicIp": "false"}},
+        {"name": "admin", "dockerLabels": {"DNSHostedZoneId": "Z2", "DNSName": "c.example.", "DNSRegisterPublicIp": "false"}},
+        {"name": "duplicate", "dockerLabels": {"DNSHostedZoneId": "Z2", "DNSName": "c.example"}},
+    ]
+    stubbers["ecs"].add_response("describe_task_definition", {"taskDefinition": task_definition})
+    for _ in range(2):
+        stubbers["route53"].add_response(
+            "change_resource_record_sets",
+            {"ChangeInfo": {"Id": "/change/C1", "Status": "INSYNC", "SubmittedAt": "2019-01-01T00:00:00Z"}},
+        )
+    task = __data["task"]
+    registrator = DNSRegistrator(task["taskArn"], task["clusterArn"], task["taskDefinitionArn"], provider, task=task)
+    registrator.get_task_definition()
+    changes = task_event.group_changes(registrator.get_changes("RUNNING", "RUNNING"))
+    assert {z: [c["ResourceRecordSet"]["Name"] for c in changes[z]] for z in changes} == {
+        "Z1": ["a.example.", "b.example."],
+        "Z2": ["c.example."],
+    }
+
+    registrator.handle("RUNNING", "RUNNING")
+    for hosted_zone_id, name in [("Z1", "a.example."), ("Z1", "b.example."), ("Z2", "c.example.")]:
+        assert (hosted_zone_id, name, "A", registrator.task_id) in record_index.records
+
+
+def test_lookups_are_concurrent(stubbed):
+    provider, stubbers = stubbed
+    barrier = threading.Barrier(2, timeout=5)
+    task_definition, task = __data["task_definition"], __data["task"]
+
+    class ECS(object):
+        def describe_task_definition(self, **kwargs):
+            barrier.wait()
+            return {"taskDefinition": task_definition}
+
+        def describe_tasks(self, **kwargs):
+            barrier.wait()
+            return {"tasks": [task]}
+
+    provider.set("ecs", ECS())
+    stubbers["ec2"].add_response("describe_network_interfaces", {"NetworkInterfaces": [task_network_interface()]})
+    stubbers["route53"].add_response(
+        "change_resource_record_sets",
+        {"ChangeInfo": {"Id": "/change/C1", "Status": "INSYNC", "SubmittedAt": "2019-01-01T00:00:00Z"}},
+    )
+    task = __data["task"]
+    registrator = DNSRegistrator(task["taskArn"], task["clusterArn"], task["taskDefinitionArn"], provider)
+    timings = registrator.handle("RUNNING", "RUNNING")
+    assert set(timings.keys()) == {"task_definition", "task", "network_interfaces", "route53_change"}
+
+
+def test_irrelevant_state_change(stubbed):
+    provider, _ = stubbed
+    task = __data["task"]
+    registrator = DNSRegistrator(task["taskArn"], task["clusterArn"], task["taskDefinitionArn"], provider)
+    assert registrator.handle("RUNNING", "PENDING") == {}
+
+
+AGGREGATE_TASK_DEFINITION_ARN = "arn:aws:ecs:eu-central-1:123456789012:task-definition/aggregate:1"
+AGGREGATE_CLUSTER_ARN = "arn:aws:ecs:eu-central-1:123456789012:cluster/aggregate"
+
+
+@pytest.fixture
+def aggregate(fake_aws):
+    """
+    the fake AWS endpoints with a task definition in aggregate mode, and a client provider.
+    """
+    fake, provider = fake_aws
+    labels = {
+        "DNSHostedZoneId": "Z1",
+        "DNSName": "aggregate.example",
+        "DNSRegisterPublicIp": "false",
+        "DNSRecordMode": "aggregate",
+    }
+    fake.add_task_definition(AGGREGATE_TASK_DEFINITION_ARN, [{"name": "app", "dockerLabels": labels}])
+    return fake, provider
+
+
+def add_aggregate_task(fake, i):
+    arn = "arn:aws:ecs:eu-central-1:123456789012:task/aggregate/{:032x}".format(i)
+    fake.add_task(AGGREGATE_CLUSTER_ARN, arn, AGGREGATE_TASK_DEFINITION_ARN, "10.0.0.{}".format(i))
+    return arn
+
+
+def aggregate_values(fake):
+    return [[r["Value"] for r in rr_set["ResourceRecords"]] for rr_set in fake.records("Z1")]
+
+
+def test_aggregate_dns_entries(aggregate):
+    fake, provider = aggregate
+    registrator = DNSRegistrator("task", AGGREGATE_CLUSTER_ARN, AGGREGATE_TASK_DEFINITION_ARN, provider)
+    registrator.get_task_definition()
+    assert registrator.dns_entries == (DNSEntry("Z1", "aggregate.example.", False, True),)
+
+
+def test_aggregate_registration(aggregate):
+    fake, provider = aggregate
+    arns = [add_aggregate_task(fake, i) for i in range(1, 4)]
+    for arn in arns:
+        task_event.create_registrator(fake.event(arn), provider).handle("RUNNING", "RUNNING")
+    assert aggregate_values(fake) == [["10.0.0.1", "10.0.0.2", "10.0.0.3"]]
+    assert "SetIdentifier" not in fake.records("Z1")[0]
+
+    fake.stop_task(arns[1])
+    task_event.create_registrator(fake.event(arns[1]), provider).handle("STOPPED", "STOPPED")
+    assert aggregate_values(fake) == [["10.0.0.1", "10.0.0.3"]]
+
+    calls = fake.calls["route53.ChangeResourceRecordSets"]
+    task_event.create_registrator(fake.event(arns[1]), provider).handle("STOPPED", "STOPPED")
+    assert fake.calls["route53.ChangeResourceRecordSets"] == calls
+
+    for arn in [arns[0], arns[2]]:
+        fake.stop_task(arn)
+        task_event.create_registrator(fake.event(arn), provider).handle("STOPPED", "STOPPED")
+    assert fake.records("Z1") == []
+
+
+def test_aggregate_changes_are_absorbed_in_a_single_write(aggregate):
+    import batch_event
+
+    fake, provider = aggregate
+    events = [("{}".format(i), fake.event(add_aggregate_task(fake, i))) for i in range(1, 11)]
+    assert batch_event.process(events, provider) == []
+    assert fake.calls["route53.ChangeResourceRecordSets"] == 1
+    assert len(aggregate_values(fake)[0]) == 10
+
+
+def test_aggregate_concurrent_update(aggregate):
+    fake, provider = aggregate
+    first, second = add_aggregate_task(fake, 1), add_aggregate_task(fake, 2)
+    task_event.create_registrator(fake.event(first), provider).handle("RUNNING", "RUNNING")
+
+    # another invocation added a value, the record index is stale.
+    rr_set = dict(fake.records("Z1")[0])
+    rr_set["ResourceRecords"] = rr_set["ResourceRecords"] + [{"Value": "10.0.0.99"}]
+    fake.add_record("Z1", rr_set)
+
+    task_event.create_registrator(fake.event(second), provider).handle("RUNNING", "RUNNING")
+    assert aggregate_values(fake) == [["10.0.0.1", "10.0.0.2", "10.0.0.99"]]
+    assert fake.calls["route53.ChangeResourceRecordSets"] == 3
+
+
+def test_aggregate_changes_are_split_into_batches(aggregate):
+    fake, provider = aggregate
+    arn = "arn:aws:ecs:eu-central-1:123456789012:task-definition/aggregates:1"
+    containers = [
+        {
+            "name": name,
+            "dockerLabels": {
+                "DNSHostedZoneId": "Z1",
+                "DNSName": "{}.example".format(name),
+                "DNSRegisterPublicIp": "false",
+                "DNSRecordMode": "aggregate",
+            },
+        }
+        for name in ["first", "second"]
+    ]
+    fake.add_task_definition(arn, containers)
+    for name in ["first", "second"]:
+        values = [{"Value": "10.1.{}.{}".format(i // 250, i % 250)} for i in range(300)]
+        fake.add_record("Z1", {"Name": "{}.example.".format(name), "Type": "A", "TTL": 30, "ResourceRecords": values})
+    task_arn = "arn:aws:ecs:eu-central-1:123456789012:task/aggregate/{:032x}".format(1)
+    fake.add_task(AGGREGATE_CLUSTER_ARN, task_arn, arn, "10.0.0.1")
+
+    # a DELETE and CREATE of 300 and 301 values per name do not fit in a single batch
+    task_event.create_registrator(fake.event(task_arn), provider).handle("RUNNING", "RUNNING")
+    assert [len(values) for values in aggregate_values(fake)] == [301, 301]
+    assert fake.calls["route53.ChangeResourceRecordSets"] == 2
+
+
+def test_aggregate_changes_are_only_retried_on_conflict(aggregate, monkeypatch):
+    from fake_aws import FakeError
+
+    fake, provider = aggregate
+    task_arn = add_aggregate_task(fake, 1)
+
+    def rejected(params):
+        raise FakeError(400, "InvalidChangeBatch", "RRSet with DNS name aggregate.example. is not permitted in zone")
+
+    monkeypatch.setattr(fake, "route53_ChangeResourceRecordSets", rejected)
+    with pytest.raises(ClientError):
+        task_event.create_registrator(fake.event(task_arn), provider).handle("RUNNING", "RUNNING")
+    assert fake.calls["route53.ChangeResourceRecordSets"] == 1
+
+
+def test_unchanged_registration_is_skipped(aggregate):
+    fake, provider = aggregate
+    arn = "arn:aws:ecs:eu-central-1:123456789012:task-definition/weighted:1"
+    labels = {"DNSHostedZoneId": "Z1", "DNSName": "weighted.example", "DNSRegisterPublicIp": "false"}
+    fake.add_task_definition(arn, [{"name": "app", "dockerLabels": labels}])
+    task_arn = "arn:aws:ecs:eu-central-1:123456789012:task/aggregate/{:032x}".format(1)
+    fake.add_task(AGGREGATE_CLUSTER_ARN, task_arn, arn, "10.0.0.1")
+
+    for _ in range(3):
+        task_event.create_registrator(fake.event(task_arn), provider).handle("RUNNING", "RUNNING")
+    assert fake.calls["route53.ChangeResourceRecordSets"] == 1
+    assert fake.calls["ecs.DescribeTaskDefinition"] == 1
+
+    fake.stop_task(task_arn)
+    task_event.create_registrator(fake.event(task_arn), provider).handle("STOPPED", "STOPPED")
+    assert fake.records("Z1") == []
+    assert fake.calls["route53.ListResourceRecordSets"] == 0
+
+
+def test_parse_role_arns():
+    assert task_event.parse_role_arns(" Z1=arn:aws:iam::1:role/a, ,Z2=arn:aws:iam::2:role/b,Z3=") == {
+        "Z1": "arn:aws:iam::1:role/a",
+        "Z2": "arn:aws:iam::2:role/b",
+    }
+
+
+def test_cross_account_and_region(stubbed, monkeypatch):
+    provider, stubbers = stubbed
+    account_role = "arn:aws:iam::210987654321:role/ecs-reader"
+    zone_role = "arn:aws:iam::111122223333:role/dns-writer"
+    monkeypatch.setattr(task_event, "account_roles", {"210987654321": account_role})
+    monkeypatch.setattr(task_event, "hosted_zone_roles", {})
+    ecs = boto3.client("ecs", region_name="us-east-1")
+    route53 = boto3.client("route53", region_name="us-east-1")
+    provider.set("ecs", ecs, "us-east-1", account_role)
+    provider.set("route53", route53, role_arn=zone_role)
+
+    task = dict(
+        __data["task"],
+        clusterArn="arn:aws:ecs:us-east-1:210987654321:cluster/remote",
+        taskArn="arn:aws:ecs:us-east-1:210987654321:task/5568b6f6-78ec-43b2-8c05-be3bc117c96e",
+    )
+    registrator = DNSRegistrator(task["taskArn"], task["clusterArn"], task["taskDefinitionArn"], provider, task=task)
+    assert registrator.region == "us-east-1"
+    assert registrator.ecs is ecs
+
+    with Stubber(ecs) as remote_ecs, Stubber(route53) as remote_route53:
+        remote_ecs.add_response(
+            "describe_task_definition",
+            {
+                "taskDefinition": task_definition_with_labels(
+                    DNSHostedZoneId="ZREMOTE",
+                    DNSName="remote.example",
+                    DNSRegisterPublicIp="false",
+                    DNSHostedZoneRoleArn=zone_role,
+                )
+            },
+        )
+        remote_route53.add_response(
+            "change_resource_record_sets",
+            {"ChangeInfo": {"Id": "/change/C1", "Status": "INSYNC", "SubmittedAt": "2019-01-01T00:00:00Z"}},
+        )
+        registrator.handle("RUNNING", "RUNNING")
+        remote_ecs.assert_no_pending_responses()
+        remote_route53.assert_no_pending_responses()
+
+    # the label applies to the hosted zone of the task definition only
+    assert task_event.hosted_zone_roles == {}
+    assert registrator.dns_entry.role_arn == zone_role
+    assert registrator.get_route53("ZREMOTE") is route53
+    assert task_event.get_route53(provider, "ZREMOTE") is provider.get("route53")
+
+    # the configured role takes precedence over the label
+    configured = boto3.client("route53", region_name="us-east-1")
+    provider.set("route53", configured, role_arn="arn:aws:iam::111122223333:role/configured")
+    monkeypatch.setattr(task_event, "hosted_zone_roles", {"ZREMOTE": "arn:aws:iam::111122223333:role/configured"})
+    assert registrator.get_route53("ZREMOTE") is configured
+
+
+# maximum memory retained per task by a registrator, after its event is released. The full
+# event would take over 10 KiB.
+TASK_MEMORY_BUDGET = 2048
+
+
+def test_memory_per_task(aggregate, caplog):
+    # captured log records would be retained as well
+    caplog.set_level(logging.WARNING)
+    fake, provider = aggregate
+    template = {
+        "taskArn": "",
+        "clusterArn": "arn:aws:ecs:eu-central-1:123456789012:cluster/aggregate",
+        "taskDefinitionArn": AGGREGATE_TASK_DEFINITION_ARN,
+        "desiredStatus": "RUNNING",
+        "lastStatus": "RUNNING",
+        "attachments": [__data["task"]["attachments"][0]],
+        "containers": [
+            {"name": "app", "image": "example/app:latest", "networkInterfaces": [], "networkBindings": []}
+        ],
+        "overrides": {
+            "containerOverrides": [
+                {"name": "app", "environment": [{"name": "VARIABLE_{}".format(i), "value": "x" * 64} for i in range(20)]}
+            ]
+        },
+    }
+    payload = json.dumps({"detail-type": "ECS Task State Change", "detail": template})
+    task_event.create_registrator(json.loads(payload), provider).get_changes("RUNNING", "RUNNING")
+
+    tasks = 1000
+    registrators = []
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        for i in range(tasks):
+            event = json.loads(payload)
+            event["detail"]["taskArn"] = "arn:aws:ecs:eu-central-1:123456789012:task/aggregate/{:032x}".format(i)
+            registrator = task_event.create_registrator(event, provider)
+            registrator.get_changes("RUNNING", "RUNNING")
+            registrators.append(registrator)
+            del event
+        gc.collect()
+        retained = (tracemalloc.get_traced_memory()[0] - start) / float(tasks)
+    finally:
+        tracemalloc.stop()
+    assert registrators[-1].dns_entry
+    assert retained < TASK_MEMORY_BUDGET, "{:.0f} bytes retained per task".format(retained)